@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Importa uma base nacional de CEPs (CSV ou JSON lines) para a colecao
+`ceps`, sem depender das consultas aos provedores externos.
+
+O arquivo e lido em streaming e cada linha vira o mesmo registro gravado
+pelo `CepTracker.track`. As linhas sao gravadas em lotes com
+`bulk_write`, varios lotes em paralelo.
+
+Uso:
+
+    $ python CepImporter.py ceps.csv
+    $ python CepImporter.py ceps.jsonl.gz --batch-size 5000 --workers 8
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+import argparse
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+from CepTracker import _notfound_key, to_record
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# a `v_date` de cada registro recua ate este tempo a partir do inicio da
+# importacao, para que a base importada nao expire toda de uma vez
+SPREAD = timedelta(
+    seconds=int(os.environ.get('POSTMON_IMPORT_SPREAD', 90 * 86400)))
+
+PY2 = sys.version_info[0] == 2
+
+CSV = 'csv'
+JSONL = 'jsonl'
+
+# nome do campo no registro -> colunas aceitas no arquivo
+_columns = {
+    'cep': ('cep',),
+    'logradouro': ('logradouro', 'endereco'),
+    'bairro': ('bairro',),
+    'localidade': ('cidade', 'localidade', 'municipio'),
+    'uf': ('estado', 'uf'),
+    'complemento': ('complemento',),
+}
+
+_non_digits = re.compile(r'\D')
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.csv'):
+        return CSV
+    # um `.json` costuma ser um array, que nao e lido em streaming
+    if name.endswith(('.jsonl', '.ndjson')):
+        return JSONL
+    raise ValueError(u"Formato desconhecido: %s" % path)
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _iter_csv(f, delimiter=','):
+    if PY2:
+        reader = csv.DictReader(f, delimiter=delimiter.encode('utf-8'))
+    else:
+        text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+        reader = csv.DictReader(text, delimiter=delimiter)
+    for row in reader:
+        yield dict((_decode(k), _decode(v)) for k, v in row.items()
+                   if k is not None)
+
+
+def _iter_jsonl(f):
+    """Linhas do arquivo decodificadas; None para as linhas invalidas"""
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line.decode('utf-8'))
+        except ValueError as e:
+            logger.warning("Linha %d invalida: %s", number, e)
+            yield None
+
+
+def iter_rows(path, fmt=None, delimiter=','):
+    """Itera sobre as linhas do arquivo, uma por vez"""
+    if fmt is None:
+        fmt = _detect_format(path)
+    with _open(path) as f:
+        if fmt == CSV:
+            rows = _iter_csv(f, delimiter)
+        else:
+            rows = _iter_jsonl(f)
+        for row in rows:
+            yield row
+
+
+def normalize_cep(value):
+    cep = _non_digits.sub('', u'%s' % (value or ''))
+    if not cep or len(cep) > 8:
+        return None
+    # planilhas costumam perder o zero a esquerda
+    return cep.zfill(8)
+
+
+def normalize(row, now=None):
+    """
+    Converte uma linha do arquivo para o registro da colecao `ceps`.
+
+    Retorna None se a linha nao tem um CEP valido ou se o CEP seria
+    gravado como nao encontrado.
+    """
+    fields = dict(((k or '').strip().lower(), v) for k, v in row.items())
+    data = {}
+    for name, columns in _columns.items():
+        for column in columns:
+            value = fields.get(column)
+            if value is not None:
+                value = (u'%s' % value).strip()
+            if value:
+                data[name] = value
+                break
+
+    cep = normalize_cep(data.pop('cep', None))
+    if cep is None:
+        return None
+    data['cep'] = cep
+    if 'uf' in data:
+        data['uf'] = data['uf'].upper()
+
+    record = to_record(data, cep, now)
+    if record['_meta'].get(_notfound_key):
+        return None
+    return record
+
+
+def _v_date(now, spread):
+    return now - timedelta(seconds=random.uniform(
+        0, spread.total_seconds()))
+
+
+def _batches(rows, size, counts, now, spread):
+    batch = []
+    for row in rows:
+        counts['read'] += 1
+        if row is None:
+            counts['skipped'] += 1
+            continue
+        try:
+            record = normalize(row, _v_date(now, spread))
+        except Exception:
+            logger.exception("Linha invalida: %s", row)
+            record = None
+        if record is None:
+            counts['skipped'] += 1
+            continue
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class CepImporter(object):
+    """
+    Carrega um arquivo de CEPs na colecao `ceps`.
+
+    `batch_size` e a quantidade de registros por `bulk_write` e
+    `workers` a quantidade de lotes gravados em paralelo (padrao:
+    `POSTMON_IMPORT_BATCH_SIZE` e `POSTMON_IMPORT_WORKERS`). O progresso e
+    registrado no log a cada `progress_interval` segundos. A `v_date` dos
+    registros e distribuida nos `spread` anteriores ao inicio.
+    """
+
+    def __init__(self, db, batch_size=None, workers=None,
+                 progress_interval=10, spread=SPREAD):
+        if batch_size is None:
+            batch_size = int(
+                os.environ.get('POSTMON_IMPORT_BATCH_SIZE', 1000))
+        if workers is None:
+            workers = int(os.environ.get('POSTMON_IMPORT_WORKERS', 4))
+        self.db = db
+        self.batch_size = batch_size
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.spread = spread
+
+    def _collect(self, done, pending, counts):
+        for future in done:
+            size = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception("Falha ao gravar lote")
+                counts['failed'] += size
+                continue
+            counts['written'] += size
+            for key, value in result.items():
+                counts[key] += value
+
+    def _report(self, counts, start):
+        elapsed = time.time() - start
+        report = dict(counts)
+        report['elapsed'] = elapsed
+        report['rate'] = counts['read'] / elapsed if elapsed else 0.0
+        return report
+
+    def run(self, rows):
+        """
+        Grava as linhas de `rows` e retorna as quantidades de linhas
+        lidas, ignoradas e gravadas, o tempo gasto e a vazao (linhas/s)
+        """
+        counts = dict.fromkeys(
+            ('read', 'skipped', 'written', 'failed',
+             'inserted', 'modified', 'unchanged'), 0)
+        start = last_progress = time.time()
+        now = datetime.now()
+        # limita os lotes em memoria aguardando gravacao
+        max_pending = self.workers * 2
+
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        pending = {}
+        try:
+            for batch in _batches(rows, self.batch_size, counts, now,
+                                  self.spread):
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    self._collect(done, pending, counts)
+                future = executor.submit(self.db.bulk_insert_or_update, batch)
+                pending[future] = len(batch)
+
+                if time.time() - last_progress >= self.progress_interval:
+                    last_progress = time.time()
+                    report = self._report(counts, start)
+                    logger.info(
+                        "Importacao: %(read)d lidas, %(written)d gravadas, "
+                        "%(skipped)d ignoradas (%(rate).0f linhas/s)",
+                        report)
+            done, _ = wait(pending)
+            self._collect(done, pending, counts)
+        finally:
+            executor.shutdown(wait=True)
+
+        report = self._report(counts, start)
+        logger.info("Importacao concluida: %s", report)
+        return report
+
+    def import_file(self, path, fmt=None, delimiter=','):
+        return self.run(iter_rows(path, fmt, delimiter))
+
+
+def _standalone(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Importa uma base de CEPs para o banco")
+    parser.add_argument('path', help="arquivo .csv ou .jsonl (ou .gz)")
+    parser.add_argument('--format', choices=(CSV, JSONL), default=None)
+    parser.add_argument('--delimiter', default=',')
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    importer = CepImporter(Database(), batch_size=args.batch_size,
+                           workers=args.workers)
+    report = importer.import_file(args.path, args.format, args.delimiter)
+
+    print("Linhas lidas: {}".format(report['read']))
+    print("Linhas ignoradas: {}".format(report['skipped']))
+    print("Registros gravados: {} ({} novos, {} alterados)".format(
+        report['written'], report['inserted'], report['modified']))
+    if report['failed']:
+        print("Registros com falha: {}".format(report['failed']))
+    print("Tempo: {:.1f}s ({:.0f} linhas/s)".format(
+        report['elapsed'], report['rate']))
+
+
+if __name__ == "__main__":
+    _standalone()
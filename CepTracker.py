@@ -1,20 +1,245 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 import logging
 import os
 import re
+import threading
+import time
 
 import requests
 
+import http_client
+
 logger = logging.getLogger(__name__)
 _notfound_key = '__notfound__'
 
 # Configurar logging para debug
 logging.basicConfig(level=logging.INFO)
 
+SEQUENTIAL = 'sequential'
+HEDGED = 'hedged'
+RACE = 'race'
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('POSTMON_CEP_WORKERS', 20)))
+
+
+def _notfound_record(cep, now):
+    return {
+        'cep': cep,
+        '_meta': {
+            "v_date": now,
+            _notfound_key: True,
+        },
+    }
+
+
+def to_record(data, cep, now=None):
+    """
+    Converte a resposta de um provedor (formato ViaCEP) para o
+    registro gravado na colecao `ceps`
+    """
+    if now is None:
+        now = datetime.now()
+
+    # Verificar se API retornou erro
+    if data.get('erro') or not data.get('localidade'):
+        logger.debug("CEP não encontrado na API")
+        return _notfound_record(cep, now)
+
+    logger.debug("CEP encontrado, processando dados")
+
+    # Verificar se bairro está vazio ou em branco
+    bairro = (data.get('bairro') or '').strip()
+    if not bairro:
+        logger.debug("CEP com bairro em branco, marcando como not found")
+        return _notfound_record(cep, now)
+
+    # Converter formato da API para formato Postmon
+    result_data = {
+        "_meta": {
+            "v_date": now,
+        },
+        "cep": (data.get('cep') or cep).replace('-', ''),
+        "logradouro": data.get('logradouro', ''),
+        "bairro": bairro,
+        "cidade": data.get('localidade', ''),
+        "estado": data.get('uf', ''),
+    }
+
+    # Complemento da API
+    if data.get('complemento'):
+        result_data['complemento'] = data.get('complemento')
+
+    logger.debug("Dados processados: %s", result_data)
+    return result_data
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker de um provedor.
+
+    Apos `failure_threshold` falhas seguidas o circuito abre e o provedor
+    deixa de ser consultado. Passados `reset_timeout` segundos uma unica
+    consulta de teste e liberada (half-open): se der certo o circuito
+    fecha, se falhar volta a abrir.
+    """
+
+    def __init__(self, name, failure_threshold=None, reset_timeout=None):
+        if failure_threshold is None:
+            failure_threshold = int(
+                os.environ.get('POSTMON_CEP_BREAKER_FAILURES', 5))
+        if reset_timeout is None:
+            reset_timeout = float(
+                os.environ.get('POSTMON_CEP_BREAKER_RESET', 30))
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Indica, sem alterar o estado, se uma consulta seria liberada"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return time.time() - self.opened_at >= self.reset_timeout
+        return False
+
+    def allow(self):
+        with self._lock:
+            if self.state == OPEN and self.available():
+                self.state = HALF_OPEN
+                return True
+            return self.state == CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                if self.state != OPEN:
+                    logger.warning('Circuito da API %s aberto apos %d '
+                                   'falhas', self.name, self.failures)
+                self.state = OPEN
+                self.opened_at = time.time()
+
+
+class ProviderStats(object):
+    """
+    Latencia e taxa de sucesso das ultimas consultas a um provedor de CEP.
+
+    Alem dos percentis, mantem medias moveis exponenciais da latencia e
+    do sucesso, usadas para ordenar os provedores.
+    """
+
+    def __init__(self, name, samples=1000, alpha=0.2):
+        self._latencies = deque(maxlen=samples)
+        self._lock = threading.Lock()
+        self.alpha = alpha
+        self.requests = 0
+        self.failures = 0
+        self.ewma_latency = None
+        self.ewma_success = None
+        self.breaker = CircuitBreaker(name)
+
+    def _ewma(self, current, value):
+        if current is None:
+            return value
+        return self.alpha * value + (1 - self.alpha) * current
+
+    def record(self, latency, ok):
+        with self._lock:
+            self._latencies.append(latency)
+            self.requests += 1
+            if not ok:
+                self.failures += 1
+            self.ewma_latency = self._ewma(self.ewma_latency, latency)
+            self.ewma_success = self._ewma(self.ewma_success,
+                                           1.0 if ok else 0.0)
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def expected_cost(self, penalty):
+        """
+        Tempo esperado ate uma resposta: a latencia media mais, para cada
+        falha, o tempo perdido (`penalty`). Provedores ainda nao
+        consultados vem primeiro.
+        """
+        if self.ewma_latency is None:
+            return 0
+        return self.ewma_latency + (1 - self.ewma_success) * penalty
+
+    def percentile(self, p):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * p / 100.0))
+        return latencies[index]
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'ewma_latency': self.ewma_latency,
+            'ewma_success': self.ewma_success,
+            'circuit': self.breaker.state,
+        }
+
+
+_provider_stats = {}
+_provider_stats_lock = threading.Lock()
+
+
+def _get_provider_stats(name):
+    with _provider_stats_lock:
+        if name not in _provider_stats:
+            _provider_stats[name] = ProviderStats(name)
+        return _provider_stats[name]
+
+
+def provider_stats():
+    return dict((name, stats.as_dict())
+                for name, stats in _provider_stats.items())
+
 
 class CepTracker(object):
+    """
+    Consulta o CEP nos provedores externos.
+
+    A estrategia define como os provedores sao consultados:
+
+    * `sequential`: um de cada vez, o proximo so apos falha do anterior;
+    * `hedged`: o proximo provedor tambem e consultado se o anterior nao
+      responder em `hedge_delay` segundos;
+    * `race`: todos ao mesmo tempo.
+
+    Nos dois ultimos casos vale a primeira resposta valida.
+    """
     # APIs alternativas para consulta de CEP
     apis = [
         {
@@ -34,6 +259,20 @@ class CepTracker(object):
         }
     ]
 
+    def __init__(self, strategy=None, hedge_delay=None, adaptive=None):
+        if adaptive is None:
+            adaptive = os.environ.get('POSTMON_CEP_ADAPTIVE', '1') != '0'
+        if strategy is None:
+            strategy = os.environ.get('POSTMON_CEP_STRATEGY', SEQUENTIAL)
+        if strategy not in (SEQUENTIAL, HEDGED, RACE):
+            raise ValueError(u"Estrategia invalida: %s" % strategy)
+        if hedge_delay is None:
+            hedge_delay = float(
+                os.environ.get('POSTMON_CEP_HEDGE_DELAY', 0.5))
+        self.strategy = strategy
+        self.hedge_delay = hedge_delay
+        self.adaptive = adaptive
+
     def _request_viacep(self, cep):
         """Consultar ViaCEP"""
         clean_cep = cep.replace('-', '').replace('.', '')
@@ -41,7 +280,7 @@ class CepTracker(object):
         
         logger.info("Tentando ViaCEP: %s", url)
         
-        response = requests.get(url, timeout=10)
+        response = http_client.get(url, timeout=10, retry=False)
         response.raise_for_status()
         return response.json()
 
@@ -52,7 +291,7 @@ class CepTracker(object):
         
         logger.info("Tentando BrasilAPI: %s", url)
         
-        response = requests.get(url, timeout=10)
+        response = http_client.get(url, timeout=10, retry=False)
         response.raise_for_status()
         data = response.json()
         
@@ -79,7 +318,8 @@ class CepTracker(object):
             'User-Agent': 'Postmon/1.0'
         }
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = http_client.get(url, headers=headers, timeout=10,
+                                   retry=False)
         response.raise_for_status()
         data = response.json()
         
@@ -93,58 +333,127 @@ class CepTracker(object):
             'uf': data.get('state', {}).get('code', ''),
         }
 
-    def _request(self, cep):
-        clean_cep = cep.replace('-', '').replace('.', '')
-        
-        logger.info("=== DEBUG CepTracker ===")
-        logger.info("CEP original: %s", cep)
-        logger.info("CEP limpo: %s", clean_cep)
-        
-        # Lista de métodos para tentar em ordem
-        methods = [
+    def _providers(self):
+        return [
             ('ViaCEP', self._request_viacep),
             ('BrasilAPI', self._request_brasilapi),
             # ('CEPAberto', self._request_cepaberto),  # Desabilitado - precisa token
         ]
-        
+
+    def _ordered_providers(self):
+        """
+        Provedores com circuito fechado primeiro, ordenados pelo custo
+        esperado quando `adaptive`. Os de circuito aberto vao para o fim
+        e sao descartados sem consulta em `_call`.
+        """
+        providers = self._providers()
+        penalty = 10
+
+        def key(provider):
+            stats = _get_provider_stats(provider[0])
+            cost = stats.expected_cost(penalty) if self.adaptive else 0
+            return (not stats.breaker.available(), cost)
+        return sorted(providers, key=key)
+
+    def _is_failure(self, ex):
+        """Erros 4xx sao respostas do provedor, nao falhas dele"""
+        if isinstance(ex, requests.exceptions.HTTPError):
+            status = getattr(ex.response, 'status_code', None)
+            return status is None or status >= 500
+        return True
+
+    def _log_error(self, api_name, ex):
+        if isinstance(ex, requests.exceptions.ConnectTimeout):
+            logger.error('Timeout na API %s: %s', api_name, ex)
+        elif isinstance(ex, requests.exceptions.ConnectionError):
+            logger.error('Erro de conexão na API %s: %s', api_name, ex)
+        elif isinstance(ex, requests.exceptions.HTTPError):
+            logger.error('Erro HTTP na API %s: %s', api_name, ex)
+        elif isinstance(ex, requests.exceptions.RequestException):
+            logger.error('Erro de requisição na API %s: %s', api_name, ex)
+        else:
+            logger.error('Erro geral na API %s: %s', api_name, ex)
+
+    def _call(self, api_name, method, cep):
+        logger.info("Tentando API: %s", api_name)
+        stats = _get_provider_stats(api_name)
+        if not stats.breaker.allow():
+            logger.warning('Circuito aberto, ignorando API %s', api_name)
+            raise CircuitOpenError(u'Circuito aberto para %s' % api_name)
+
+        start = time.time()
+        try:
+            data = method(cep)
+        except Exception as ex:
+            stats.record(time.time() - start, ok=not self._is_failure(ex))
+            self._log_error(api_name, ex)
+            raise
+        stats.record(time.time() - start, ok=True)
+        logger.info("Sucesso com %s: %s", api_name, data)
+        return data
+
+    def _request_sequential(self, cep):
         last_error = None
-        
-        for api_name, method in methods:
+        for api_name, method in self._ordered_providers():
             try:
-                logger.info("Tentando API: %s", api_name)
-                data = method(clean_cep)
-                logger.info("Sucesso com %s: %s", api_name, data)
-                return data
-                
-            except requests.exceptions.ConnectTimeout as ex:
-                last_error = ex
-                logger.error('Timeout na API %s: %s', api_name, ex)
-                continue
-                
-            except requests.exceptions.ConnectionError as ex:
-                last_error = ex
-                logger.error('Erro de conexão na API %s: %s', api_name, ex)
-                continue
-                
-            except requests.exceptions.HTTPError as ex:
-                last_error = ex
-                logger.error('Erro HTTP na API %s: %s', api_name, ex)
-                continue
-                
-            except requests.exceptions.RequestException as ex:
-                last_error = ex
-                logger.error('Erro de requisição na API %s: %s', api_name, ex)
-                continue
-                
+                return self._call(api_name, method, cep)
             except Exception as ex:
                 last_error = ex
-                logger.error('Erro geral na API %s: %s', api_name, ex)
                 continue
-        
+
         # Se todas as APIs falharam, relançar último erro
         logger.error('Todas as APIs falharam. Último erro: %s', last_error)
         raise last_error
 
+    def _request_concurrent(self, cep, delay):
+        """
+        Dispara os provedores em ordem, o proximo quando o anterior falha
+        ou apos `delay` segundos sem resposta, e retorna a primeira
+        resposta valida. Com `delay` 0 todos sao disparados de uma vez.
+        """
+        providers = self._ordered_providers()
+        pending = set()
+        last_error = None
+
+        while providers or pending:
+            if providers:
+                api_name, method = providers.pop(0)
+                pending.add(_executor.submit(self._call, api_name, method,
+                                             cep))
+                if providers and delay == 0:
+                    continue
+
+            timeout = delay if providers else None
+            done, pending = wait(pending, timeout=timeout,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    data = future.result()
+                except Exception as ex:
+                    last_error = ex
+                else:
+                    # as requisicoes ja iniciadas seguem ate o fim, mas
+                    # ninguem espera por elas
+                    for other in pending:
+                        other.cancel()
+                    return data
+
+        logger.error('Todas as APIs falharam. Último erro: %s', last_error)
+        raise last_error
+
+    def _request(self, cep):
+        clean_cep = cep.replace('-', '').replace('.', '')
+
+        logger.info("=== DEBUG CepTracker ===")
+        logger.info("CEP original: %s", cep)
+        logger.info("CEP limpo: %s", clean_cep)
+
+        if self.strategy == RACE:
+            return self._request_concurrent(clean_cep, delay=0)
+        if self.strategy == HEDGED:
+            return self._request_concurrent(clean_cep, self.hedge_delay)
+        return self._request_sequential(clean_cep)
+
     def track(self, cep):
         logger.info("=== INICIANDO TRACK CEP: %s ===", cep)
         
@@ -154,60 +463,8 @@ class CepTracker(object):
             
         except Exception as ex:
             logger.exception('Erro ao consultar CEP: %s', cep)
-            return [{
-                'cep': cep,
-                '_meta': {
-                    "v_date": datetime.now(),
-                    _notfound_key: True,
-                },
-            }]
+            return [_notfound_record(cep, datetime.now())]
         
-        result = []
-        now = datetime.now()
-
-        # Verificar se API retornou erro
-        if data.get('erro') or not data.get('localidade'):
-            logger.info("CEP não encontrado na API")
-            result.append({
-                'cep': cep,
-                '_meta': {
-                    "v_date": now,
-                    _notfound_key: True,
-                },
-            })
-        else:
-            logger.info("CEP encontrado, processando dados")
-            
-            # Verificar se bairro está vazio ou em branco
-            bairro = data.get('bairro', '').strip()
-            if not bairro:
-                logger.info("CEP com bairro em branco, marcando como not found")
-                result.append({
-                    'cep': cep,
-                    '_meta': {
-                        "v_date": now,
-                        _notfound_key: True,
-                    },
-                })
-            else:
-                # Converter formato da API para formato Postmon
-                result_data = {
-                    "_meta": {
-                        "v_date": now,
-                    },
-                    "cep": data.get('cep', cep).replace('-', ''),
-                    "logradouro": data.get('logradouro', ''),
-                    "bairro": bairro,
-                    "cidade": data.get('localidade', ''),
-                    "estado": data.get('uf', ''),
-                }
-                
-                # Complemento da API
-                if data.get('complemento'):
-                    result_data['complemento'] = data.get('complemento')
-                    
-                logger.info("Dados processados: %s", result_data)
-                result.append(result_data)
-
+        result = [to_record(data, cep)]
         logger.info("=== RESULTADO FINAL: %s ===", result)
         return result
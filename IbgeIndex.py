@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+
+from cache import LRUCache, MISSING
+from database import _cidade_keys, _project
+
+logger = logging.getLogger(__name__)
+
+
+class IbgeIndex(object):
+    """
+    Indice em memoria das colecoes `ufs` e `cidades`.
+
+    As duas colecoes sao pequenas e so mudam quando o `IbgeTracker` roda,
+    entao sao carregadas inteiras e consultadas sem ir ao banco. A cada
+    `check_interval` segundos o indice compara a marca de atualizacao
+    gravada pelo `IbgeTracker` e, se mudou, recarrega tudo em background,
+    trocando os dicionarios de uma so vez.
+    """
+
+    def __init__(self, check_interval=None):
+        if check_interval is None:
+            check_interval = int(
+                os.environ.get('POSTMON_IBGE_INDEX_CHECK', 60))
+        self.check_interval = check_interval
+        self._data = ({}, {})
+        self._version = None
+        self._checked_at = 0
+        self._loading = False
+        self._lock = threading.Lock()
+        # nome consultado -> chave da cidade, evita recalcular o slug
+        self._keys = LRUCache(maxsize=20000, ttl=86400)
+
+    def load(self, db):
+        version = db.get_ibge_updated_at()
+
+        ufs = {}
+        for uf in db.get_all_ufs():
+            uf.pop('_id', None)
+            uf.pop('_hash', None)
+            ufs[uf['sigla']] = uf
+
+        cidades = {}
+        aliases = {}
+        for cidade in db.get_all_cidades():
+            cidade.pop('_id', None)
+            cidade.pop('_hash', None)
+            key = cidade['sigla_uf_nome_cidade']
+            cidades[key] = cidade
+            sigla_uf, nome = cidade.get('sigla_uf'), cidade.get('nome')
+            if sigla_uf and nome:
+                for alias in _cidade_keys(sigla_uf, nome)[1:]:
+                    aliases[alias] = cidade
+        for alias, cidade in aliases.items():
+            cidades.setdefault(alias, cidade)
+
+        self._data = (ufs, cidades)
+        self._keys.clear()
+        self._version = version
+        self._checked_at = time.time()
+        logger.info("Indice IBGE carregado: %d ufs, %d cidades",
+                    len(ufs), len(cidades))
+
+    def _reload(self, db):
+        try:
+            self.load(db)
+        except Exception:
+            logger.exception("Falha ao recarregar o indice IBGE")
+        finally:
+            self._loading = False
+
+    def refresh(self, db):
+        """Recarrega o indice se o IbgeTracker rodou desde a ultima carga"""
+        if time.time() - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if self._loading:
+                return
+            self._checked_at = time.time()
+            try:
+                version = db.get_ibge_updated_at()
+            except Exception:
+                logger.exception("Falha ao consultar a versao do IBGE")
+                return
+            if version == self._version:
+                return
+            self._loading = True
+
+        thread = threading.Thread(target=self._reload, args=(db,))
+        thread.daemon = True
+        thread.start()
+
+    def get_uf(self, sigla, fields=None):
+        ufs, _ = self._data
+        uf = ufs.get(sigla)
+        if uf is None:
+            return MISSING
+        return _project(dict(uf), fields)
+
+    def get_cidade(self, sigla_uf, nome_cidade, fields=None):
+        _, cidades = self._data
+        lookup = (sigla_uf, nome_cidade)
+        keys = self._keys.get(lookup)
+        if keys is MISSING:
+            keys = _cidade_keys(sigla_uf, nome_cidade)
+            self._keys.set(lookup, keys)
+        for key in keys:
+            cidade = cidades.get(key)
+            if cidade is not None:
+                return _project(dict(cidade), fields)
+        return MISSING
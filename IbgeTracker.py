@@ -1,22 +1,128 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import requests
-
-from database import MongoDB as Database
+import codecs
+import json
+import logging
+import os
+import re
+import time
+
+import http_client
+from database import Database
 from utils import slug
 
+logger = logging.getLogger(__name__)
+
+BASE_URL = 'https://raw.githubusercontent.com/PostmonAPI/ibge-parser/master/data/postmon'  # noqa
+CHUNK_SIZE = 64 * 1024
+
+_whitespace = re.compile(r'[\s,]*')
+
+
+def _iter_json_items(chunks):
+    """
+    Itera sobre os itens de um array JSON a partir de pedacos de bytes,
+    sem carregar o documento inteiro em memoria.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = u''
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        pos = _whitespace.match(buf, pos).end()
+        if not started and pos < len(buf):
+            if buf[pos] != '[':
+                raise ValueError(u"Esperado um array JSON")
+            started = True
+            pos += 1
+            continue
+        if started and buf[pos:pos + 1] == ']':
+            return
+
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            # um valor no fim do buffer pode estar incompleto
+            if end is not None and (end < len(buf) or eof):
+                yield item
+                pos = end
+                continue
+
+        if eof:
+            raise ValueError(u"Array JSON incompleto")
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            eof = True
+            chunk = b''
+        buf = buf[pos:] + utf8.decode(chunk, final=eof)
+        pos = 0
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _sum_counts(total, counts):
+    for key, value in counts.items():
+        total[key] = total.get(key, 0) + value
+    return total
 
-class IbgeTracker():
 
-    def __init__(self):
-        base_url = 'https://raw.githubusercontent.com/PostmonAPI/ibge-parser/master/data/postmon'  # noqa
-        self.url_ufs = base_url + '/ufs.json'
-        self.url_cidades = base_url + '/cidades.json'
+class IbgeTracker():
 
-    def _request(self, url):
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+    def __init__(self, batch_size=None, source=None):
+        """
+        `source` e a URL base ou o diretorio local com os arquivos
+        `ufs.json` e `cidades.json` (padrao: `POSTMON_IBGE_SOURCE` ou o
+        repositorio do ibge-parser).
+        """
+        if batch_size is None:
+            batch_size = int(os.environ.get('POSTMON_IBGE_BATCH_SIZE', 1000))
+        if source is None:
+            source = os.environ.get('POSTMON_IBGE_SOURCE', BASE_URL)
+        self.batch_size = batch_size
+        self.url_ufs = self._join(source, 'ufs.json')
+        self.url_cidades = self._join(source, 'cidades.json')
+
+    def _is_url(self, source):
+        return source.startswith(('http://', 'https://'))
+
+    def _join(self, source, name):
+        if self._is_url(source):
+            return source.rstrip('/') + '/' + name
+        return os.path.join(source, name)
+
+    def _iter_chunks(self, source):
+        if not self._is_url(source):
+            with open(source, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    yield chunk
+            return
+
+        response = http_client.get(source, stream=True)
+        try:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                yield chunk
+        finally:
+            response.close()
+
+    def _request(self, source):
+        return _iter_json_items(self._iter_chunks(source))
 
     def _get_info_ufs(self, siglas):
         return self._request(self.url_ufs)
@@ -26,39 +132,65 @@ class IbgeTracker():
 
     def _track_ufs(self, db, siglas):
         infos = self._get_info_ufs(siglas)
-        for info in infos:
-            db.insert_or_update_uf(info)
+        counts = {}
+        for batch in _batches(infos, self.batch_size):
+            _sum_counts(counts, db.bulk_upsert_ufs(batch))
+        return counts
 
     def _track_cidades(self, db):
         infos = self._get_info_cidades()
         siglas = {}
-        for info in infos:
-            codigo_ibge_uf = info['codigo_ibge_uf']
-            sigla_uf = info['sigla_uf']
-            nome = info['nome']
-            if codigo_ibge_uf not in siglas:
-                siglas[codigo_ibge_uf] = sigla_uf
+        counts = {}
+
+        def prepare(infos):
+            for info in infos:
+                codigo_ibge_uf = info['codigo_ibge_uf']
+                sigla_uf = info['sigla_uf']
+                nome = info['nome']
+                if codigo_ibge_uf not in siglas:
+                    siglas[codigo_ibge_uf] = sigla_uf
 
-            # a chave única de uma cidade não
-            # pode ser só o nome, pois
-            # existem cidades com mesmo nome
-            # em estados diferentes
-            info['sigla_uf_nome_cidade'] = slug('%s_%s' % (sigla_uf, nome))
+                # a chave única de uma cidade não
+                # pode ser só o nome, pois
+                # existem cidades com mesmo nome
+                # em estados diferentes
+                info['sigla_uf_nome_cidade'] = slug(
+                    '%s_%s' % (sigla_uf, nome))
+                yield info
 
-            db.insert_or_update_cidade(info)
+        for batch in _batches(prepare(infos), self.batch_size):
+            _sum_counts(counts, db.bulk_upsert_cidades(batch))
 
-        return siglas
+        return siglas, counts
 
     def track(self, db):
         """
         Atualiza as bases internas do mongo
         com os dados mais recentes do IBGE
-        referente a ufs e cidades
+        referente a ufs e cidades.
+
+        Retorna as quantidades de documentos inseridos, alterados e
+        inalterados de cada colecao e o tempo gasto, em segundos.
         """
-        siglas = self._track_cidades(db)
+        start = time.time()
+        siglas, cidades = self._track_cidades(db)
         # siglas é um dict cod_ibge -> sigla:
         # { '35': 'SP', '35': 'RJ', ... }
-        self._track_ufs(db, siglas)
+        ufs = self._track_ufs(db, siglas)
+
+        changed = sum(c.get('inserted', 0) + c.get('modified', 0)
+                      for c in (ufs, cidades))
+        if changed:
+            # avisa os servidores para recarregar o indice em memoria
+            db.mark_ibge_updated()
+
+        report = {
+            'ufs': ufs,
+            'cidades': cidades,
+            'elapsed': time.time() - start,
+        }
+        logger.info("IBGE atualizado: %s", report)
+        return report
 
 
 def _standalone():
@@ -1,17 +1,38 @@
 # coding: utf-8
+from datetime import datetime, timedelta
 import json
 import os
+import re
 
 import packtrack
-import requests
 
-from database import MongoDB as Database
+from database import Database, content_hash, history_fingerprint
+import webhooks
+
+# intervalo entre as verificacoes de um pacote: cresce com o tempo sem
+# mudancas no historico, dentro destes limites
+CHECK_MIN_INTERVAL = timedelta(
+    seconds=int(os.environ.get('POSTMON_PACKS_CHECK_MIN', 3600)))
+CHECK_MAX_INTERVAL = timedelta(
+    seconds=int(os.environ.get('POSTMON_PACKS_CHECK_MAX', 86400)))
+
+# situacoes finais de entrega; "Objeto nao entregue - ..." e uma
+# tentativa sem sucesso e o pacote continua sendo verificado
+_delivered_re = re.compile(u'^(objeto entregue|entrega efetuada)',
+                           re.I | re.U)
+_not_delivered_re = re.compile(u'n[a\u00e3]o entregue', re.I | re.U)
 
 
 def correios(track, backend=None, auth=None):
     if backend is None:
         backend = os.getenv('ECT_BACKEND')
-    encomenda = packtrack.Correios.track(track, backend=backend, auth=auth)
+    try:
+        encomenda = packtrack.Correios.track(track, backend=backend,
+                                             auth=auth)
+    except AttributeError:
+        # o scraping do `packtrack` falha assim quando a pagina dos
+        # Correios nao traz o pacote
+        raise ValueError(u"Encomenda nao encontrada.")
 
     if not encomenda:
         raise ValueError(u"Encomenda nao encontrada.")
@@ -30,6 +51,55 @@ def correios(track, backend=None, auth=None):
     return result
 
 
+def delivered(historico):
+    """
+    O evento mais recente (o ultimo, o `packtrack` ordena por data) e
+    uma entrega concluida
+    """
+    if not historico:
+        return False
+    situacao = (historico[-1].get('situacao') or u'').strip()
+    return bool(_delivered_re.match(situacao) and
+                not _not_delivered_re.search(situacao))
+
+
+def delta(previous, historico):
+    """
+    Eventos de `historico` que nao estao em `previous`, comparados pelo
+    hash de cada evento, e se foram acrescentados no inicio do
+    historico. Se os eventos anteriores mudaram de ordem ou sumiram, o
+    historico nao e um acrescimo e o segundo valor e None.
+    """
+    seen = set(content_hash(event) for event in previous or [])
+    events = [e for e in historico if content_hash(e) not in seen]
+    size = len(events)
+    if not previous or not events:
+        at_head = None
+    elif historico[size:] == previous:
+        at_head = True
+    elif historico[:-size] == previous:
+        at_head = False
+    else:
+        at_head = None
+    return events, at_head
+
+
+def next_check_at(obj, historico, changed, now):
+    """
+    Data da proxima verificacao do pacote, ou None se ele ja foi
+    entregue. O intervalo e metade do tempo sem mudancas no historico,
+    entre `CHECK_MIN_INTERVAL` e `CHECK_MAX_INTERVAL`.
+    """
+    if delivered(historico):
+        return None
+    _meta = obj.get('_meta', {})
+    last_change = now
+    if not changed:
+        last_change = _meta.get('changed_at') or _meta.get('created_at') or now
+    interval = (now - last_change) / 2
+    return now + min(max(interval, CHECK_MIN_INTERVAL), CHECK_MAX_INTERVAL)
+
+
 def register(provider, track, callback):
     """
     Registra o pacote para acompanhamento.
@@ -38,36 +108,74 @@ def register(provider, track, callback):
     return db.packtrack.register(provider, track, callback)
 
 
-def run(provider, track):
-    db = Database()
-    obj = db.packtrack.get_one(provider, track)
+def run(provider, track, obj=None, db=None, auth=None):
+    """
+    Atualiza o historico do pacote e retorna os eventos novos, ou uma
+    lista vazia se nenhum evento foi acrescentado. `obj` e o documento
+    ja carregado, que e atualizado junto com o banco.
+    """
+    if db is None:
+        db = Database()
+    if obj is None:
+        obj = db.packtrack.get_one(provider, track)
 
     if provider != 'ect':
         raise ValueError(u"Unexpected provider: %s" % provider)
 
+    now = datetime.utcnow()
     try:
-        data = correios(track)
+        data = correios(track, auth=auth)
     except ValueError:
-        return False
-
-    changed = obj.get('historico') != data
-    db.packtrack.update(provider, track, data, changed=changed)
-    return changed
-
-
-def report(provider, track):
-    db = Database()
-    obj = db.packtrack.get_one(provider, track)
+        # pacote ainda sem historico: tambem entra no intervalo crescente
+        next_check = next_check_at(obj or {}, None, False, now)
+        db.packtrack.update(provider, track, None, changed=False,
+                            next_check_at=next_check)
+        return []
+
+    previous = obj.get('historico')
+    fingerprint = obj['_meta'].get('fingerprint')
+    if fingerprint is None and previous:
+        # pacotes gravados antes do `_meta.fingerprint`
+        fingerprint = history_fingerprint(previous)
+    changed = fingerprint != history_fingerprint(data)
+
+    events = []
+    at_head = None
+    if changed:
+        events, at_head = delta(previous, data)
+    next_check = next_check_at(obj, data, changed, now)
+    db.packtrack.update(provider, track, data, changed=changed,
+                        next_check_at=next_check,
+                        new_events=events if at_head is not None else None,
+                        at_head=bool(at_head))
+    if changed:
+        obj['historico'] = data
+    return events
+
+
+def report(provider, track, obj=None, db=None, events=None):
+    """
+    Envia o pacote para os callbacks registrados, em paralelo. Com
+    `events`, o `historico` enviado traz somente esses eventos novos. As
+    entregas que falharem sao repetidas pela tarefa `deliver_webhooks`.
+    """
+    if db is None:
+        db = Database()
+    if obj is None:
+        obj = db.packtrack.get_one(provider, track)
 
+    obj = dict(obj)
     _meta = obj.pop('_meta')
-    callbacks = _meta.pop('callbacks')
+    if events is not None:
+        obj['historico'] = events
 
-    for callback in callbacks:
+    messages = []
+    for callback in _meta['callbacks']:
         data = obj.copy()
-        url = callback['callback']
         data['input'] = callback
-        headers = {'Content-Type': 'application/json'}
-        requests.post(
-            url,
-            headers=headers,
-            data=json.dumps(data))
+        messages.append({
+            'url': callback['callback'],
+            'data': json.dumps(data),
+            'token': obj.get('token'),
+        })
+    return webhooks.deliver(db, webhooks.enqueue(db, messages))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Servidor do Postmon com I/O cooperativo (gevent).
+
+Expoe as mesmas rotas do PostmonServer, mas cada requisicao roda em uma
+greenlet: enquanto uma consulta espera o MongoDB ou um provedor de CEP,
+o processo atende as demais. O monkey patch precisa acontecer antes de
+qualquer import de socket/threading, por isso este modulo existe em
+separado e deve ser o ponto de entrada do processo.
+
+Uso:
+
+    $ pip install gevent
+    $ python PostmonAsyncServer.py
+"""
+try:
+    from gevent import monkey
+except ImportError:
+    monkey = None
+else:
+    monkey.patch_all()
+
+import sys
+
+from bottle import run
+
+import PostmonServer
+
+
+def _standalone(port=9876):
+    if monkey is None:
+        sys.exit("O servidor assincrono depende do gevent: "
+                 "pip install gevent")
+    run(app=PostmonServer.app, host='0.0.0.0', port=port, server='gevent')
+
+
+if __name__ == "__main__":
+    _standalone()
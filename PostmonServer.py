@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
+import re
+import threading
+import time
 import bottle
 import json
 import logging
@@ -11,10 +16,14 @@ from bottle.ext.healthcheck import HealthCheck
 from raven import Client
 from raven.contrib.bottle import Sentry
 
-from CepTracker import CepTracker, _notfound_key
+from cache import LRUCache, MISSING
+from CepTracker import CepTracker, provider_stats
+from IbgeIndex import IbgeIndex
 import PackTracker
+from singleflight import SingleFlight
 import requests
-from database import MongoDB as Database
+from database import Database, cache_stats, expires_at, is_notfound, \
+    pool_stats
 from utils import EnableCORS
 
 logger = logging.getLogger(__name__)
@@ -25,9 +34,47 @@ app.catchall = False
 app_v1 = bottle.Bottle()
 app_v1.catchall = False
 jsonp_query_key = 'callback'
+_cep_re = re.compile(r'^[0-9]{8}$')
+
+SINGLEFLIGHT_MONGO = os.environ.get('POSTMON_SINGLEFLIGHT_MONGO') == '1'
+SINGLEFLIGHT_LOCK_TTL = int(
+    os.environ.get('POSTMON_SINGLEFLIGHT_LOCK_TTL', 30))
+_singleflight = SingleFlight()
+
+STALE_GRACE = timedelta(
+    seconds=int(os.environ.get('POSTMON_STALE_GRACE', 0)))
+_revalidate_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('POSTMON_STALE_WORKERS', 4)))
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+
+BATCH_MAX_CEPS = int(os.environ.get('POSTMON_BATCH_MAX_CEPS', 100))
+RANGE_MAX_LIMIT = int(os.environ.get('POSTMON_RANGE_MAX_LIMIT', 1000))
+
+TRACK_MAX_AGE = timedelta(
+    seconds=int(os.environ.get('POSTMON_TRACK_MAX_AGE', 900)))
+_report_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('POSTMON_TRACK_REPORT_WORKERS', 2)))
+TRACK_BATCH_MAX = int(os.environ.get('POSTMON_TRACK_BATCH_MAX', 50))
+# limite global de consultas simultaneas aos Correios pelo batch
+_track_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('POSTMON_TRACK_BATCH_WORKERS', 5)))
+# consultas por token: TTL curto, para acompanhar o agendamento e os
+# callbacks sem voltar ao banco a cada requisicao
+_tokens_cache = LRUCache(
+    maxsize=int(os.environ.get('POSTMON_CACHE_TOKENS_SIZE', 10000)),
+    ttl=int(os.environ.get('POSTMON_CACHE_TOKENS_TTL', 30)))
+_batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('POSTMON_BATCH_WORKERS', 10)))
 
 db = Database()
 db.create_indexes()
+if os.environ.get('POSTMON_CHECK_INDEXES', '1') != '0':
+    for problem in db.check_indexes():
+        logger.warning(u"Indices: %s", problem)
+
+ibge_index = IbgeIndex()
+ibge_index.load(db)
 
 
 def validate_format(callback):
@@ -41,28 +88,19 @@ def validate_format(callback):
 
 
 def _notfound(record):
-    _meta = record.get('_meta', {})
-    return _notfound_key in _meta or _notfound_key in record
+    return is_notfound(record)
 
 
 def expired(record_date):
-    _meta = record_date.get('_meta', {})
-    v_date = _meta.get('v_date') or record_date.get('v_date')
-    if not v_date:
+    expiration = expires_at(record_date)
+    if expiration is None:
         return True
 
+    is_expired = datetime.now() >= expiration
     if _notfound(record_date):
-        # Para registros "not found", expirar em 10 minutos para desenvolvimento
-        MINUTES = 10
-        now = datetime.now()
-        is_expired = (now - v_date >= timedelta(minutes=MINUTES))
-        logger.info("Registro notfound, idade: %s, expirou: %s", now - v_date, is_expired)
-        return is_expired
-    else:
-        # Para registros validos, manter 6 meses
-        WEEKS = 26
-        now = datetime.now()
-        return (now - v_date >= timedelta(weeks=WEEKS))
+        logger.info("Registro notfound, expira em: %s, expirou: %s",
+                    expiration, is_expired)
+    return is_expired
 
 
 def _get_info_from_source(cep):
@@ -107,18 +145,162 @@ def make_error(message, output_format=None):
 
 def _get_estado_info(db, sigla):
     sigla = sigla.upper()
-    return db.get_one_uf(sigla, fields={'_id': False, 'sigla': False})
+    fields = {'_id': False, '_hash': False, 'sigla': False}
+    ibge_index.refresh(db)
+    result = ibge_index.get_uf(sigla, fields=fields)
+    if result is MISSING:
+        result = db.get_one_uf(sigla, fields=fields)
+    return result
 
 
 def _get_cidade_info(db, sigla_uf, nome_cidade):
     fields = {
         '_id': False,
+        '_hash': False,
         'sigla_uf': False,
         'codigo_ibge_uf': False,
         'sigla_uf_nome_cidade': False,
         'nome': False
     }
-    return db.get_one_cidade(sigla_uf, nome_cidade, fields=fields)
+    ibge_index.refresh(db)
+    result = ibge_index.get_cidade(sigla_uf, nome_cidade, fields=fields)
+    if result is MISSING:
+        result = db.get_one_cidade(sigla_uf, nome_cidade, fields=fields)
+    return result
+
+
+def _update_from_source(db, cep, keep_stale=False):
+    """
+    Consulta o CEP nas fontes externas e grava o resultado. Com
+    `keep_stale` um "not found" (a fonte falhou ou nao achou o CEP) nao
+    substitui um endereco valido ja gravado, que continua sendo servido.
+    """
+    info = _get_info_from_source(cep)
+    logger.info("Info recebida da fonte: %s", info)
+
+    logger.info("Salvando dados no MongoDB...")
+    result = None
+    for item in info:
+        if keep_stale and item['cep'] == cep and _notfound(item):
+            current = db.get_one(cep, fields={'_id': False, 'v_date': False})
+            if current and not _notfound(current):
+                logger.warning("Fonte sem resposta para o CEP %s, mantendo "
+                               "o registro expirado", cep)
+                result = current
+                continue
+        logger.info("Salvando item: %s", item)
+        # o documento gravado ja e a resposta, sem ler o CEP de novo
+        record = db.insert_or_update(
+            item, fields={'_id': False, 'v_date': False})
+        if record['cep'] == cep:
+            result = record
+    logger.info("Resultado apos salvar: %s", result)
+    return result
+
+
+def _wait_for_update(db, cep, lock):
+    """Espera outro processo atualizar o CEP enquanto ele tem o lock"""
+    deadline = time.time() + SINGLEFLIGHT_LOCK_TTL
+    while time.time() < deadline:
+        result = db.get_one(cep, fields={'_id': False, 'v_date': False})
+        if result and not expired(result):
+            return result
+        if not db.is_locked(lock):
+            break
+        time.sleep(0.1)
+    return None
+
+
+def _update_from_source_locked(db, cep, keep_stale=False):
+    if not SINGLEFLIGHT_MONGO:
+        return _update_from_source(db, cep, keep_stale)
+
+    lock = 'cep:%s' % cep
+    token = db.acquire_lock(lock, ttl=SINGLEFLIGHT_LOCK_TTL)
+    if token is None:
+        logger.info("CEP %s sendo atualizado por outro processo", cep)
+        result = _wait_for_update(db, cep, lock)
+        if result is not None:
+            return result
+        return _update_from_source(db, cep, keep_stale)
+
+    try:
+        return _update_from_source(db, cep, keep_stale)
+    finally:
+        db.release_lock(lock, token)
+
+
+def _refresh_cep(db, cep, keep_stale=False):
+    """
+    Atualiza o CEP nas fontes externas. Requisicoes simultaneas para o
+    mesmo CEP no processo compartilham uma unica consulta; com
+    `POSTMON_SINGLEFLIGHT_MONGO=1` um lock no banco faz o mesmo entre
+    processos.
+    """
+    return _singleflight.do(cep, _update_from_source_locked, db, cep,
+                            keep_stale)
+
+
+def _servable_stale(record):
+    """
+    Registro expirado que ainda esta dentro da janela `STALE_GRACE` e
+    pode ser servido enquanto e atualizado em background. Registros
+    "not found" nunca sao servidos expirados.
+    """
+    if not STALE_GRACE or _notfound(record):
+        return False
+    expiration = expires_at(record)
+    return (expiration is not None and
+            datetime.now() < expiration + STALE_GRACE)
+
+
+def _revalidate_task(cep):
+    try:
+        _refresh_cep(Database(), cep, keep_stale=True)
+    except Exception:
+        logger.exception("Falha ao atualizar o CEP %s em background", cep)
+    finally:
+        with _revalidating_lock:
+            _revalidating.discard(cep)
+
+
+def _revalidate(cep):
+    """Agenda a atualizacao do CEP, se ainda nao estiver agendada"""
+    with _revalidating_lock:
+        if cep in _revalidating:
+            return
+        _revalidating.add(cep)
+    _revalidate_executor.submit(_revalidate_task, cep)
+
+
+def _enrich(db, result, estados=None, cidades=None):
+    """
+    Remove os metadados e adiciona `estado_info` e `cidade_info`.
+
+    `estados` e `cidades` permitem reaproveitar as informacoes entre
+    varios resultados de uma mesma requisicao.
+    """
+    result.pop('v_date', None)
+    result.pop('_meta', None)
+
+    if estados is None:
+        estados = {}
+    if cidades is None:
+        cidades = {}
+
+    sigla_uf = result['estado']
+    if sigla_uf not in estados:
+        estados[sigla_uf] = _get_estado_info(db, sigla_uf)
+    if estados[sigla_uf]:
+        result['estado_info'] = dict(estados[sigla_uf])
+
+    nome_cidade = result['cidade']
+    key = (sigla_uf, nome_cidade)
+    if key not in cidades:
+        cidades[key] = _get_cidade_info(db, sigla_uf, nome_cidade)
+    if cidades[key]:
+        result['cidade_info'] = dict(cidades[key])
+    return result
 
 
 # REGEX CORRIGIDO - Aceita CEP com ou sem hifen, mais flexivel
@@ -128,21 +310,25 @@ def verifica_cep(cep):
     logger.info("=== ROTA CEP CHAMADA: %s ===", cep)
     cep_limpo = cep.replace('-', '')
     logger.info("CEP limpo: %s", cep_limpo)
-    
+
     db = Database()
     response.headers['Access-Control-Allow-Origin'] = '*'
     message = None
-    
+    stale = False
+
     logger.info("Consultando cache no MongoDB...")
     result = db.get_one(cep_limpo, fields={'_id': False})
     logger.info("Resultado do cache: %s", result)
-    
-    if not result or expired(result):
+
+    if result and expired(result) and _servable_stale(result):
+        logger.info("Registro expirado, atualizando em background...")
+        _revalidate(cep_limpo)
+        stale = True
+    elif not result or expired(result):
         logger.info("Cache vazio ou expirado, consultando fonte externa...")
         result = None
         try:
-            info = _get_info_from_source(cep_limpo)
-            logger.info("Info recebida da fonte: %s", info)
+            result = _refresh_cep(db, cep_limpo)
         except requests.exceptions.RequestException as ex:
             message = '503 Servico Temporariamente Indisponivel'
             logger.exception(message)
@@ -151,14 +337,6 @@ def verifica_cep(cep):
             message = '500 Erro interno'
             logger.exception("Erro geral: %s", ex)
             return make_error(message)
-        else:
-            logger.info("Salvando dados no MongoDB...")
-            for item in info:
-                logger.info("Salvando item: %s", item)
-                db.insert_or_update(item)
-            result = db.get_one(cep_limpo, fields={
-                '_id': False, 'v_date': False})
-            logger.info("Resultado apos salvar: %s", result)
 
     if result:
         notfound = _notfound(result)
@@ -173,23 +351,185 @@ def verifica_cep(cep):
         return make_error(message)
 
     logger.info("Processando resultado final...")
-    result.pop('v_date', None)
-    result.pop('_meta', None)
+    if stale:
+        # o registro esta sendo atualizado: caches intermediarios nao
+        # devem guarda-lo por 30 dias
+        response.headers['Cache-Control'] = \
+            'public, max-age=0, stale-while-revalidate=60'
+    else:
+        response.headers['Cache-Control'] = 'public, max-age=2592000'
+    result = _enrich(db, result)
 
-    response.headers['Cache-Control'] = 'public, max-age=2592000'
-    sigla_uf = result['estado']
-    estado_info = _get_estado_info(db, sigla_uf)
-    if estado_info:
-        result['estado_info'] = estado_info
-    nome_cidade = result['cidade']
-    cidade_info = _get_cidade_info(db, sigla_uf, nome_cidade)
-    if cidade_info:
-        result['cidade_info'] = cidade_info
-    
     logger.info("Retornando resultado final: %s", result)
     return format_result(result)
 
 
+def _batch_error(cep, message):
+    status, _, erro = message.partition(' ')
+    return {'cep': cep, 'status': int(status), 'erro': erro}
+
+
+def _lookup_batch(db, ceps):
+    """
+    Consulta varios CEPs: os registros em cache sao lidos com uma unica
+    consulta ao banco e somente os ausentes ou expirados (fora da janela
+    de `STALE_GRACE`) vao para as fontes externas, em paralelo.
+    """
+    cached = db.get_many(ceps, fields={'_id': False})
+    misses = []
+    for cep in ceps:
+        record = cached.get(cep)
+        if record and expired(record) and _servable_stale(record):
+            _revalidate(cep)
+        elif not record or expired(record):
+            misses.append(cep)
+
+    futures = dict(
+        (cep, _batch_executor.submit(_refresh_cep, db, cep))
+        for cep in misses)
+
+    estados = {}
+    cidades = {}
+    results = []
+    for cep in ceps:
+        if cep in futures:
+            try:
+                result = futures[cep].result()
+            except requests.exceptions.RequestException:
+                message = '503 Servico Temporariamente Indisponivel'
+                logger.exception(message)
+                results.append(_batch_error(cep, message))
+                continue
+            except Exception as ex:
+                logger.exception("Erro geral: %s", ex)
+                results.append(_batch_error(cep, '500 Erro interno'))
+                continue
+        else:
+            result = cached[cep]
+
+        if not result or _notfound(result):
+            message = '404 CEP %s nao encontrado' % cep
+            results.append(_batch_error(cep, message))
+        else:
+            results.append(_enrich(db, result, estados, cidades))
+    return results
+
+
+def _json_body():
+    """Corpo JSON da requisicao, ou None se estiver ausente ou invalido"""
+    try:
+        return request.json
+    except ValueError:
+        return None
+
+
+@app_v1.route('/cep/batch', method=['GET', 'POST'])
+def verifica_ceps():
+    """
+    Consulta ate `POSTMON_BATCH_MAX_CEPS` CEPs em uma requisicao.
+
+    GET /v1/cep/batch?ceps=01330000,65930000
+    POST /v1/cep/batch {"ceps": ["01330000", "65930000"]}
+
+    O resultado traz um item por CEP, na ordem recebida. CEPs nao
+    encontrados ou com falha trazem `status` e `erro`.
+    """
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    if request.method == 'POST':
+        body = _json_body()
+        if isinstance(body, dict):
+            body = body.get('ceps')
+        ceps = body if isinstance(body, list) else None
+    else:
+        ceps = [c for c in request.query.ceps.split(',') if c]
+
+    if not ceps:
+        return make_error('400 Parametro ceps obrigatorio')
+
+    ceps = [(u'%s' % cep).strip().replace('-', '') for cep in ceps]
+    ceps = list(OrderedDict.fromkeys(ceps))
+    if len(ceps) > BATCH_MAX_CEPS:
+        message = '400 Maximo de %d CEPs por consulta' % BATCH_MAX_CEPS
+        return make_error(message)
+
+    validos = [cep for cep in ceps if _cep_re.match(cep)]
+    results = dict(zip(validos, _lookup_batch(Database(), validos)))
+
+    ceps_result = []
+    for cep in ceps:
+        if cep in results:
+            ceps_result.append(results[cep])
+        else:
+            ceps_result.append(_batch_error(cep, '400 CEP invalido'))
+    return format_result({'ceps': ceps_result})
+
+
+def _stream_range(db, start, end, after, limit):
+    """
+    Gera o JSON `{"ceps": [...], "proximo": ...}` um registro por vez,
+    sem montar a lista inteira em memoria. `proximo` e o cursor da
+    pagina seguinte, ou null na ultima pagina.
+    """
+    yield '{"ceps": ['
+    last = None
+    count = 0
+    for record in db.get_range(start, end, after=after, limit=limit):
+        for key in ('_id', '_meta', 'v_date'):
+            record.pop(key, None)
+        yield (', ' if count else '') + json.dumps(record)
+        last = record['cep']
+        count += 1
+    proximo = last if count == limit else None
+    yield '], "proximo": %s}' % json.dumps(proximo)
+
+
+def _range_response(start, end):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    if request.query.format not in ('', 'json'):
+        return make_error('400 Somente o formato json e suportado',
+                          output_format='json')
+
+    limite = request.query.limite or str(RANGE_MAX_LIMIT)
+    if not limite.isdigit() or not int(limite):
+        return make_error('400 Parametro limite invalido',
+                          output_format='json')
+    limit = min(int(limite), RANGE_MAX_LIMIT)
+
+    after = request.query.cursor.replace('-', '') or None
+    if after is not None and not _cep_re.match(after):
+        return make_error('400 Parametro cursor invalido',
+                          output_format='json')
+
+    response.content_type = 'application/json'
+    return _stream_range(Database(), start, end, after, limit)
+
+
+@app_v1.route('/cep/range')
+def ceps_range():
+    """
+    CEPs em cache entre `inicio` e `fim`, em ordem, em paginas de ate
+    `POSTMON_RANGE_MAX_LIMIT` registros.
+
+    GET /v1/cep/range?inicio=01300000&fim=01399999&limite=500
+    GET /v1/cep/range?inicio=01300000&fim=01399999&cursor=01310100
+    """
+    inicio = request.query.inicio.replace('-', '')
+    fim = request.query.fim.replace('-', '')
+    if not _cep_re.match(inicio) or not _cep_re.match(fim):
+        return make_error('400 Parametros inicio e fim obrigatorios',
+                          output_format='json')
+    if inicio > fim:
+        return make_error('400 Parametro inicio maior que fim',
+                          output_format='json')
+    return _range_response(inicio, fim)
+
+
+@app_v1.route('/cep/prefix/<prefix:re:[0-9]{1,8}>')
+def ceps_prefix(prefix):
+    """CEPs em cache que comecam com `prefix`, paginados como /cep/range"""
+    return _range_response(prefix.ljust(8, '0'), prefix.ljust(8, '9'))
+
+
 @app_v1.route('/uf/<sigla>')
 def uf(sigla):
     response.headers['Access-Control-Allow-Origin'] = '*'
@@ -218,20 +558,160 @@ def cidade(sigla_uf, nome):
         return make_error(message)
 
 
+def _fresh_pack(obj):
+    """O historico gravado foi consultado ha menos de `TRACK_MAX_AGE`"""
+    if not obj or not obj.get('historico'):
+        return False
+    checked_at = obj['_meta'].get('checked_at')
+    return (checked_at is not None and
+            datetime.utcnow() - checked_at < TRACK_MAX_AGE)
+
+
+def _report_pack(db, provider, track, obj, events):
+    try:
+        PackTracker.report(provider, track, obj=obj, db=db, events=events)
+    except Exception:
+        logger.exception("Falha ao enviar os callbacks de %s", track)
+
+
+def _refresh_pack(db, provider, track, auth):
+    """
+    Consulta o historico nos Correios e grava no banco. Para um pacote
+    com callbacks a consulta vale como a verificacao do agendamento e
+    as mudancas sao enviadas aos callbacks em background.
+
+    Backends sem `packtrack` (snapshot) apenas consultam os Correios.
+    """
+    if db.packtrack is None:
+        return PackTracker.correios(track, auth=auth)
+
+    obj = db.packtrack.get_one(provider, track)
+    if obj and obj['_meta'].get('callbacks'):
+        events = PackTracker.run(provider, track, obj=obj, db=db, auth=auth)
+        if events:
+            _report_executor.submit(_report_pack, db, provider, track, obj,
+                                    events)
+        if not obj.get('historico'):
+            raise ValueError(u"A encomenda ainda nao tem historico.")
+        return obj['historico']
+
+    historico = PackTracker.correios(track, auth=auth)
+    db.packtrack.save(provider, track, historico)
+    return historico
+
+
+def _get_pack(provider, track, auth):
+    """
+    Historico do pacote: o gravado no banco enquanto estiver dentro de
+    `POSTMON_TRACK_MAX_AGE`, senao uma nova consulta, compartilhada
+    pelas requisicoes simultaneas para o mesmo pacote.
+    """
+    db = Database()
+    if db.packtrack is not None:
+        obj = db.packtrack.get_one(provider, track)
+        if _fresh_pack(obj):
+            return obj['historico']
+    return _refresh_pack_once(db, provider, track, auth)
+
+
+def _refresh_pack_once(db, provider, track, auth):
+    return _singleflight.do(('rastreio', provider, track), _refresh_pack,
+                            db, provider, track, auth)
+
+
+def _correios_auth():
+    auth = (
+        request.headers.get('x-correios-usuario'),
+        request.headers.get('x-correios-senha'),
+    )
+    if auth == (None, None):
+        return None
+    return auth
+
+
+def _pack_error(track, message):
+    status, _, erro = message.partition(' ')
+    return {'codigo': track, 'status': int(status), 'erro': erro}
+
+
+def _lookup_packs(db, provider, tracks, auth):
+    """
+    Consulta varios pacotes: os gravados dentro de `TRACK_MAX_AGE` sao
+    lidos com uma unica consulta ao banco e os demais vao para os
+    Correios em paralelo, no pool compartilhado entre as requisicoes.
+    """
+    stored = {}
+    if db.packtrack is not None:
+        stored = db.packtrack.get_many(provider, tracks)
+    futures = dict(
+        (track, _track_executor.submit(
+            _refresh_pack_once, db, provider, track, auth))
+        for track in tracks if not _fresh_pack(stored.get(track)))
+
+    results = []
+    for track in tracks:
+        if track not in futures:
+            historico = stored[track]['historico']
+        else:
+            try:
+                historico = futures[track].result()
+            except ValueError:
+                message = "404 Pacote %s nao encontrado" % track
+                logger.info(message)
+                results.append(_pack_error(track, message))
+                continue
+            except requests.exceptions.RequestException:
+                message = '503 Servico Temporariamente Indisponivel'
+                logger.exception(message)
+                results.append(_pack_error(track, message))
+                continue
+            except Exception as ex:
+                logger.exception("Erro geral: %s", ex)
+                results.append(_pack_error(track, '500 Erro interno'))
+                continue
+        results.append({
+            'servico': provider,
+            'codigo': track,
+            'historico': historico,
+        })
+    return results
+
+
+@app_v1.route('/rastreio/ect/batch', method='POST')
+def track_packs():
+    """
+    Rastreia ate `POSTMON_TRACK_BATCH_MAX` pacotes em uma requisicao.
+
+    POST /v1/rastreio/ect/batch {"codigos": ["SS123456789BR", ...]}
+
+    O resultado traz um item por codigo, na ordem recebida. Codigos nao
+    encontrados ou com falha trazem `status` e `erro`.
+    """
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    body = _json_body()
+    if isinstance(body, dict):
+        body = body.get('codigos')
+    if not isinstance(body, list) or not body:
+        return make_error('400 Parametro codigos obrigatorio')
+
+    tracks = [(u'%s' % track).strip() for track in body]
+    tracks = list(OrderedDict.fromkeys(t for t in tracks if t))
+    if len(tracks) > TRACK_BATCH_MAX:
+        message = '400 Maximo de %d codigos por consulta' % TRACK_BATCH_MAX
+        return make_error(message)
+
+    results = _lookup_packs(Database(), 'ect', tracks, _correios_auth())
+    return format_result({'pacotes': results})
+
+
 @app_v1.route('/rastreio/<provider>/<track>')
 def track_pack(provider, track):
     response.headers['Access-Control-Allow-Origin'] = '*'
     if provider == 'ect':
-        auth = (
-            request.headers.get('x-correios-usuario'),
-            request.headers.get('x-correios-senha'),
-        )
-        if auth == (None, None):
-            auth = None
-
+        auth = _correios_auth()
         try:
-            historico = PackTracker.correios(track, auth=auth)
-        except (AttributeError, ValueError):
+            historico = _get_pack(provider, track, auth)
+        except ValueError:
             message = "404 Pacote %s nao encontrado" % track
             logger.exception(message)
         else:
@@ -246,9 +726,59 @@ def track_pack(provider, track):
     return make_error(message)
 
 
+def _callbacks_status(callbacks, deliveries):
+    """Situacao da ultima entrega de cada callback registrado"""
+    last = dict((d['url'], d) for d in deliveries)
+    result = []
+    for callback in callbacks:
+        delivery = last.get(callback['callback'], {})
+        result.append({
+            'callback': callback['callback'],
+            'status': delivery.get('status'),
+            'tentativas': delivery.get('attempts', 0),
+            'erro': delivery.get('last_error'),
+        })
+    return result
+
+
+def _get_pack_by_token(token):
+    result = _tokens_cache.get(token)
+    if result is not MISSING:
+        return result
+
+    db = Database()
+    if db.packtrack is None:
+        # sem armazenamento dos pacotes nao ha tokens registrados
+        return None
+    obj = db.packtrack.get_by_token(token)
+    result = None
+    if obj is not None:
+        checked_at = obj['_meta'].get('checked_at')
+        deliveries = db.deliveries.get_by_token(token)
+        result = {
+            'servico': obj['servico'],
+            'codigo': obj['codigo'],
+            'token': token,
+            'historico': obj.get('historico') or [],
+            'verificado_em': checked_at and checked_at.isoformat(),
+            'callbacks': _callbacks_status(obj['_meta']['callbacks'],
+                                           deliveries),
+        }
+    _tokens_cache.set(token, result)
+    return result
+
+
 @app_v1.route('/rastreio/<token>')
 def track_pack_token(token):
-    return make_error('404 NOT IMPLEMENTED')
+    """
+    Historico gravado do pacote e situacao dos callbacks, sem consultar
+    os Correios. O historico e atualizado pelo agendamento.
+    """
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    result = _get_pack_by_token(token)
+    if result is None:
+        return make_error('404 Token %s nao encontrado' % token)
+    return format_result(result)
 
 
 @app_v1.route('/rastreio/<provider>/<track>', method='POST')
@@ -275,11 +805,21 @@ def track_pack_register(provider, track):
         logger.exception(message)
         return make_error(message)
     else:
+        _tokens_cache.delete(result)
         return format_result({
             'token': result,
         })
 
 
+@app.route('/__stats__')
+def stats():
+    return {
+        'mongodb_pool': pool_stats(),
+        'cache': dict(cache_stats(), tokens=_tokens_cache.stats()),
+        'providers': provider_stats(),
+    }
+
+
 @app.route('/crossdomain.xml')
 def crossdomain():
     response.content_type = 'application/xml'
@@ -1,17 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from datetime import timedelta
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from celery import Celery
 from celery.utils.log import get_task_logger
 from IbgeTracker import IbgeTracker
 import PackTracker
-from database import MongoDB as Database
+import webhooks
+from database import Database
 import os
 
 USERNAME = os.environ.get('POSTMON_DB_USER')
 PASSWORD = os.environ.get('POSTMON_DB_PASSWORD')
 HOST = os.environ.get('POSTMON_DB_HOST', 'localhost')
 PORT = os.environ.get('POSTMON_DB_PORT', '27017')
+PACKS_CONCURRENCY = int(os.environ.get('POSTMON_PACKS_CONCURRENCY', 10))
 
 if all((USERNAME, PASSWORD)):
     broker_conn_string = 'mongodb://%s:%s@%s:%s' \
@@ -38,7 +41,11 @@ app.conf.update(
         'track_packs': {
             'task': 'PostmonTaskScheduler.track_packs',
             'schedule': timedelta(hours=1),
-        }
+        },
+        'deliver_webhooks': {
+            'task': 'PostmonTaskScheduler.deliver_webhooks',
+            'schedule': timedelta(minutes=1),
+        },
 
     }
 )
@@ -51,19 +58,68 @@ def track_ibge():
     logger.info('Iniciando tracking do IBGE...')
     db = Database()
     ibge = IbgeTracker()
-    ibge.track(db)
-    logger.info('Finalizou o tracking do IBGE')
+    report = ibge.track(db)
+    logger.info('Finalizou o tracking do IBGE: %s', report)
+
+
+def _track_pack(db, obj):
+    provider = obj['servico']
+    track = obj['codigo']
+    events = PackTracker.run(provider, track, obj=obj, db=db)
+    if events:
+        PackTracker.report(provider, track, obj=obj, db=db, events=events)
+    return events
+
+
+def _collect(done, counts):
+    for future in done:
+        try:
+            changed = future.result()
+        except Exception:
+            logger.exception('Falha ao rastrear pacote')
+            counts['failed'] += 1
+            continue
+        counts['changed' if changed else 'unchanged'] += 1
 
 
 @app.task
-def track_packs():
+def track_packs(concurrency=None):
+    """
+    Rastreia os pacotes com a verificacao vencida (`next_check_at`) em
+    ate `POSTMON_PACKS_CONCURRENCY` threads, lendo o cursor sob demanda
+    e reaproveitando o documento lido em `PackTracker.run` e
+    `PackTracker.report`.
+    """
+    if concurrency is None:
+        concurrency = PACKS_CONCURRENCY
     logger.info('Iniciando tracking de pacotes...')
     db = Database()
-    for obj in db.packtrack.get_all():
-        provider = obj['servico']
-        track = obj['codigo']
-        changed = PackTracker.run(provider, track)
-        if changed:
-            PackTracker.report(provider, track)
-
-    logger.info('Finalizou o tracking de pacotes')
+    counts = {'changed': 0, 'unchanged': 0, 'failed': 0}
+    # limita os documentos em memoria aguardando uma thread livre
+    max_pending = concurrency * 2
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = set()
+    try:
+        for obj in db.packtrack.get_due(datetime.utcnow()):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                _collect(done, counts)
+            pending.add(executor.submit(_track_pack, db, obj))
+        done, _ = wait(pending)
+        _collect(done, counts)
+    finally:
+        executor.shutdown(wait=True)
+
+    logger.info('Finalizou o tracking de pacotes: %s', counts)
+    logger.info('Entregas de callbacks: %s', webhooks.delivery_stats())
+    return counts
+
+
+@app.task
+def deliver_webhooks():
+    """Reenvia os callbacks com falha cuja proxima tentativa venceu"""
+    counts = webhooks.deliver_due(Database())
+    if any(counts.values()):
+        logger.info('Reenvio de callbacks: %s', counts)
+    return counts
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import copy
+import threading
+import time
+
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    Cache em memoria limitado por quantidade de itens (LRU) e com
+    tempo de vida por item.
+
+    Os valores sao copiados na entrada e na saida, entao quem consulta
+    pode alterar o resultado sem corromper o cache.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=MISSING):
+        now = time.time()
+        with self._lock:
+            try:
+                expires_at, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires_at <= now:
+                self.expirations += 1
+                self.misses += 1
+                return default
+            # reinsere no fim: item usado mais recentemente
+            self._data[key] = (expires_at, value)
+            self.hits += 1
+        return copy.deepcopy(value)
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
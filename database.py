@@ -1,15 +1,515 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from datetime import datetime
+from datetime import datetime, timedelta
+import hashlib
+import json
 import os
 import re
+import threading
+import uuid
 
+from bson import ObjectId
 import pymongo
+from pymongo import monitoring
+from pymongo.errors import DuplicateKeyError
 
+from cache import LRUCache, MISSING
+from CepTracker import _notfound_key
+import indexes
 from utils import slug
 
+# Registros validos ficam 6 meses no cache, registros "not found" sao
+# consultados novamente na fonte apos 10 minutos.
+CEP_TTL = timedelta(weeks=26)
+NOTFOUND_TTL = timedelta(minutes=10)
 
-class MongoDB(object):
+# pacotes consultados em /rastreio sem registro ficam gravados apenas
+# como cache e sao removidos apos este tempo sem novas consultas
+TRACK_CACHE_TTL = timedelta(
+    seconds=int(os.environ.get('POSTMON_TRACK_CACHE_RETENTION', 86400)))
+# pacotes lidos por lote nas consultas que percorrem a colecao
+STREAM_BATCH_SIZE = 100
+
+_ceps_cache = LRUCache(
+    maxsize=int(os.environ.get('POSTMON_CACHE_CEPS_SIZE', 10000)),
+    ttl=int(os.environ.get('POSTMON_CACHE_CEPS_TTL', 3600)))
+_ufs_cache = LRUCache(
+    maxsize=int(os.environ.get('POSTMON_CACHE_UFS_SIZE', 100)),
+    ttl=int(os.environ.get('POSTMON_CACHE_IBGE_TTL', 3600)))
+_cidades_cache = LRUCache(
+    maxsize=int(os.environ.get('POSTMON_CACHE_CIDADES_SIZE', 10000)),
+    ttl=int(os.environ.get('POSTMON_CACHE_IBGE_TTL', 3600)))
+
+
+def is_notfound(record):
+    _meta = record.get('_meta', {})
+    return _notfound_key in _meta or _notfound_key in record
+
+
+def expires_at(record):
+    """Data em que o registro de CEP deixa de ser valido, ou None"""
+    _meta = record.get('_meta', {})
+    v_date = _meta.get('v_date') or record.get('v_date')
+    if not isinstance(v_date, datetime):
+        return None
+    if is_notfound(record):
+        return v_date + NOTFOUND_TTL
+    return v_date + CEP_TTL
+
+
+def content_hash(obj):
+    """Hash do conteudo do documento, ignorando `_id` e `_hash`"""
+    obj = dict((k, v) for k, v in obj.items() if k not in ('_id', '_hash'))
+    content = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def history_fingerprint(historico):
+    """Hash do historico de um pacote, a partir do hash de cada evento"""
+    hashes = [content_hash(event) for event in historico or []]
+    return hashlib.sha1(','.join(hashes).encode('ascii')).hexdigest()
+
+
+def cache_stats():
+    return {
+        'ceps': _ceps_cache.stats(),
+        'ufs': _ufs_cache.stats(),
+        'cidades': _cidades_cache.stats(),
+    }
+
+
+def _project(doc, projection):
+    """Aplica em memoria uma projecao de campos de primeiro nivel"""
+    if doc is None or not projection:
+        return doc
+    if not isinstance(projection, dict):
+        projection = dict((k, True) for k in projection)
+
+    include = [k for k, v in projection.items() if v and k != '_id']
+    if include:
+        result = dict((k, doc[k]) for k in include if k in doc)
+        if '_id' in doc and projection.get('_id', True):
+            result['_id'] = doc['_id']
+        return result
+    return dict((k, v) for k, v in doc.items() if projection.get(k, True))
+
+
+def _cidade_key(sigla_uf, nome_cidade):
+    return u'{}_{}'.format(slug(sigla_uf), slug(nome_cidade))
+
+
+def _cidade_keys(sigla_uf, nome_cidade):
+    """Chave da cidade e, se houver, do nome alternativo entre parenteses"""
+    keys = [_cidade_key(sigla_uf, nome_cidade)]
+    search = re.search(r'\((.+)\)', nome_cidade)
+    if search:
+        keys.append(_cidade_key(sigla_uf, search.group(1)))
+    return keys
+
+
+def _cacheable(kwargs):
+    """Somente consultas simples, com projecao de primeiro nivel"""
+    projection = kwargs.get('projection', kwargs.get('fields'))
+    if set(kwargs) - {'projection', 'fields'}:
+        return False
+    return not projection or not any('.' in k for k in projection)
+
+
+class _PoolStats(monitoring.ConnectionPoolListener):
+    """Contadores dos eventos do pool de conexoes do MongoClient"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checked_in = 0
+        self.check_out_failed = 0
+        self.cleared = 0
+
+    def _incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._incr('cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._incr('created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._incr('closed')
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._incr('check_out_failed')
+
+    def connection_checked_out(self, event):
+        self._incr('checked_out')
+
+    def connection_checked_in(self, event):
+        self._incr('checked_in')
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'connections_open': self.created - self.closed,
+                'connections_in_use': self.checked_out - self.checked_in,
+                'connections_created': self.created,
+                'connections_closed': self.closed,
+                'checkouts': self.checked_out,
+                'checkout_failures': self.check_out_failed,
+                'pool_cleared': self.cleared,
+            }
+
+
+_client = None
+_client_pid = None
+_client_stats = None
+_client_lock = threading.Lock()
+
+
+def _client_options():
+    options = {
+        'maxPoolSize': int(os.environ.get('POSTMON_DB_MAX_POOL_SIZE', 100)),
+        'minPoolSize': int(os.environ.get('POSTMON_DB_MIN_POOL_SIZE', 0)),
+        'readPreference': os.environ.get(
+            'POSTMON_DB_READ_PREFERENCE', 'primary'),
+    }
+    wait_queue_timeout = os.environ.get('POSTMON_DB_WAIT_QUEUE_TIMEOUT_MS')
+    if wait_queue_timeout:
+        options['waitQueueTimeoutMS'] = int(wait_queue_timeout)
+    return options
+
+
+def get_client():
+    """
+    Retorna o MongoClient compartilhado pelo processo.
+
+    O cliente e criado na primeira chamada e reaproveitado por todas as
+    instancias de `MongoDB`. Como o MongoClient nao sobrevive a um fork,
+    um novo cliente e criado quando o pid muda (ex.: workers de um
+    servidor WSGI pre-fork).
+    """
+    global _client, _client_pid, _client_stats
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            HOST = os.environ.get('POSTMON_DB_HOST', 'localhost')
+            PORT = int(os.environ.get('POSTMON_DB_PORT', 27017))
+            DATABASE = os.environ.get('POSTMON_DB_NAME', 'postmon')
+            USERNAME = os.environ.get('POSTMON_DB_USER')
+            PASSWORD = os.environ.get('POSTMON_DB_PASSWORD')
+
+            options = _client_options()
+            if all((USERNAME, PASSWORD)):
+                options.update({
+                    'username': USERNAME,
+                    'password': PASSWORD,
+                    'authSource': DATABASE,
+                })
+
+            stats = _PoolStats()
+            # connect=False adia a conexao ate a primeira operacao, o que
+            # torna seguro criar o cliente antes do fork dos workers.
+            _client = pymongo.MongoClient(
+                HOST, PORT, connect=False, event_listeners=[stats],
+                **options)
+            _client_stats = stats
+            _client_pid = pid
+    return _client
+
+
+def _live_options(client):
+    """Opcoes com que o MongoClient foi de fato criado"""
+    # `MongoClient.options` so existe a partir do pymongo 4; no 3.x o
+    # atributo seria lido como o banco "options"
+    if hasattr(type(client), 'options'):
+        return client.options
+    return client._MongoClient__options
+
+
+def pool_stats():
+    """Estatisticas do pool de conexoes do processo atual"""
+    if _client is None or _client_pid != os.getpid():
+        return {'pid': os.getpid(), 'connected': False}
+
+    options = _live_options(_client)
+    pool = options.pool_options
+    wait_queue_timeout = pool.wait_queue_timeout
+    if wait_queue_timeout is not None:
+        wait_queue_timeout = int(wait_queue_timeout * 1000)
+    stats = _client_stats.as_dict()
+    stats.update({
+        'pid': _client_pid,
+        'connected': True,
+        'max_pool_size': pool.max_pool_size,
+        'min_pool_size': pool.min_pool_size,
+        'wait_queue_timeout_ms': wait_queue_timeout,
+        'read_preference': options.read_preference.mongos_mode,
+    })
+    return stats
+
+
+def Database():
+    """
+    Backend de armazenamento definido por `POSTMON_DB_BACKEND`: `mongo`
+    (padrao), `memory`, `sqlite` ou `snapshot`. Com `POSTMON_DB_SNAPSHOT`
+    definido, o padrao passa a ser `snapshot`.
+    """
+    backend = os.environ.get('POSTMON_DB_BACKEND')
+    if not backend:
+        snapshot = os.environ.get('POSTMON_DB_SNAPSHOT')
+        backend = 'snapshot' if snapshot else 'mongo'
+
+    if backend == 'mongo':
+        return MongoDB()
+    if backend == 'memory':
+        from database_memory import MemoryDatabase
+        return MemoryDatabase()
+    if backend == 'sqlite':
+        from database_sqlite import SQLiteDatabase
+        return SQLiteDatabase()
+    if backend == 'snapshot':
+        from snapshot import SnapshotDatabase
+        return SnapshotDatabase()
+    raise ValueError(u"POSTMON_DB_BACKEND invalido: %s" % backend)
+
+
+class BaseDatabase(object):
+    """
+    Interface dos backends de armazenamento.
+
+    Os registros seguem o formato dos documentos do MongoDB: os `get_*`
+    retornam dicts (ou None) e aceitam `fields` com uma projecao de
+    primeiro nivel. Os pacotes rastreados ficam em `packtrack`, um
+    `BasePackTrack`, e a caixa de saida dos callbacks em `deliveries`,
+    um `BaseDeliveries`.
+    """
+
+    packtrack = None
+    deliveries = None
+
+    def create_indexes(self):
+        pass
+
+    def check_indexes(self):
+        """Lista os problemas de indices encontrados no armazenamento"""
+        return []
+
+    def get_one(self, cep, **kwargs):
+        raise NotImplementedError
+
+    def get_many(self, ceps, **kwargs):
+        """Retorna um dict cep -> registro apenas com os CEPs encontrados"""
+        found = {}
+        for cep in ceps:
+            r = self.get_one(cep, **kwargs)
+            if r is not None:
+                found[cep] = r
+        return found
+
+    def get_all_ceps(self):
+        raise NotImplementedError
+
+    def get_range(self, start, end, after=None, limit=None):
+        """
+        CEPs entre `start` e `end` (inclusive), em ordem, sem os
+        registros "not found". `after` continua a partir do ultimo CEP de
+        uma pagina anterior e `limit` limita a quantidade de registros.
+        """
+        raise NotImplementedError
+
+    def get_one_uf(self, sigla, **kwargs):
+        raise NotImplementedError
+
+    def get_one_uf_by_nome(self, nome, **kwargs):
+        raise NotImplementedError
+
+    def get_one_cidade(self, sigla_uf, nome_cidade, **kwargs):
+        raise NotImplementedError
+
+    def get_all_ufs(self):
+        raise NotImplementedError
+
+    def get_all_cidades(self):
+        raise NotImplementedError
+
+    def get_ibge_updated_at(self):
+        raise NotImplementedError
+
+    def mark_ibge_updated(self):
+        raise NotImplementedError
+
+    def insert_or_update(self, obj, **kwargs):
+        """
+        Grava o CEP, removendo os campos de endereco ausentes em `obj`.
+        Retorna o documento gravado, com a projecao de `fields`.
+        """
+        raise NotImplementedError
+
+    def bulk_insert_or_update(self, objs):
+        """
+        Grava varios CEPs. Retorna as quantidades de documentos
+        inseridos, alterados e inalterados.
+        """
+        raise NotImplementedError
+
+    def insert_or_update_uf(self, obj, **kwargs):
+        raise NotImplementedError
+
+    def insert_or_update_cidade(self, obj, **kwargs):
+        raise NotImplementedError
+
+    def bulk_upsert_ufs(self, objs):
+        """
+        Grava as ufs pulando as que nao mudaram. Retorna as quantidades
+        de documentos inseridos, alterados e inalterados.
+        """
+        raise NotImplementedError
+
+    def bulk_upsert_cidades(self, objs):
+        raise NotImplementedError
+
+    def remove(self, cep):
+        raise NotImplementedError
+
+    def remove_uf(self, sigla):
+        raise NotImplementedError
+
+    def remove_cidade(self, sigla_uf_nome_cidade):
+        raise NotImplementedError
+
+    def acquire_lock(self, name, ttl):
+        """
+        Lock entre processos. Retorna um token para `release_lock`, ou
+        None se outro processo ja tem o lock. O lock expira sozinho apos
+        `ttl` segundos, caso o dono morra sem libera-lo.
+        """
+        raise NotImplementedError
+
+    def release_lock(self, name, token):
+        raise NotImplementedError
+
+    def is_locked(self, name):
+        raise NotImplementedError
+
+
+class BasePackTrack(object):
+    """
+    Interface do armazenamento dos pacotes rastreados. Os documentos
+    trazem `servico`, `codigo`, `token`, `historico` e `_meta`.
+    """
+
+    def get_one(self, provider, track):
+        raise NotImplementedError
+
+    def get_many(self, provider, tracks):
+        """Retorna um dict codigo -> pacote apenas com os encontrados"""
+        found = {}
+        for track in tracks:
+            obj = self.get_one(provider, track)
+            if obj is not None:
+                found[track] = obj
+        return found
+
+    def get_by_token(self, token):
+        """Pacote com o `token` devolvido no registro, ou None"""
+        raise NotImplementedError
+
+    def get_all(self):
+        """Todos os pacotes, lidos sob demanda"""
+        raise NotImplementedError
+
+    def get_due(self, now):
+        """
+        Pacotes com `_meta.next_check_at` vencido em `now`, lidos sob
+        demanda. Pacotes com `next_check_at` None nao sao mais
+        verificados.
+        """
+        raise NotImplementedError
+
+    def register(self, provider, track, callback):
+        """
+        Registra o callback do pacote e retorna o token. O pacote e
+        verificado na proxima execucao do agendamento.
+        """
+        raise NotImplementedError
+
+    def save(self, provider, track, data):
+        """
+        Grava o historico `data` consultado fora do agendamento. Um
+        pacote sem callbacks fica apenas como cache, sem `next_check_at`
+        e com `_meta.expires_at` em `TRACK_CACHE_TTL`; o registro de um
+        callback remove o `expires_at`.
+        """
+        raise NotImplementedError
+
+    def update(self, provider, track, data, changed, next_check_at=MISSING,
+               new_events=None, at_head=False):
+        """
+        Marca o pacote como verificado e, se `changed`, grava o novo
+        historico `data` e o seu `_meta.fingerprint`. `next_check_at`
+        agenda a proxima verificacao.
+
+        `new_events` e `at_head` sao apenas uma indicacao de que `data`
+        e o historico gravado com estes eventos acrescentados no fim (ou
+        no inicio, com `at_head`). O MongoDB grava somente os eventos
+        novos, se o historico gravado for o esperado; os backends que
+        regravam o documento inteiro podem ignora-los. O resultado e o
+        mesmo em todos: o historico passa a ser `data`.
+        """
+        raise NotImplementedError
+
+    def remove(self, provider, track):
+        raise NotImplementedError
+
+
+class BaseDeliveries(object):
+    """
+    Interface da caixa de saida dos callbacks (ver `webhooks`). Os
+    documentos trazem `_id`, `url`, `data`, `token`, `status`,
+    `attempts` e `next_attempt_at`, None quando nao ha mais tentativas.
+    """
+
+    def add(self, objs):
+        raise NotImplementedError
+
+    def get_one(self, _id):
+        raise NotImplementedError
+
+    def get_by_token(self, token):
+        """Entregas do pacote com o `token`, da mais antiga a mais nova"""
+        raise NotImplementedError
+
+    def claim_due(self, now, lease, limit):
+        """
+        Reserva ate `limit` entregas com `next_attempt_at` vencido em
+        `now`, adiando a proxima tentativa para `now + lease` para que
+        outro processo nao as envie ao mesmo tempo.
+        """
+        raise NotImplementedError
+
+    def update(self, _id, fields):
+        raise NotImplementedError
+
+
+class MongoDB(BaseDatabase):
 
     _fields = [
         'logradouro',
@@ -21,19 +521,47 @@ class MongoDB(object):
 
     def __init__(self):
         DATABASE = os.environ.get('POSTMON_DB_NAME', 'postmon')
-        HOST = os.environ.get('POSTMON_DB_HOST', 'localhost')
-        PORT = int(os.environ.get('POSTMON_DB_PORT', 27017))
-        USERNAME = os.environ.get('POSTMON_DB_USER')
-        PASSWORD = os.environ.get('POSTMON_DB_PASSWORD')
 
-        self._client = pymongo.MongoClient(HOST, PORT)
+        self._client = get_client()
         self._db = self._client[DATABASE]
-        if all((USERNAME, PASSWORD)):
-            self._db.authenticate(USERNAME, PASSWORD)
         self.packtrack = PackTrack(self._db.packtrack)
+        self.deliveries = Deliveries(self._db.deliveries)
 
     def create_indexes(self):
-        self._db.ceps.ensure_index('cep')
+        indexes.ensure_indexes(self._db)
+
+    def check_indexes(self):
+        return indexes.check_indexes(self._db)
+
+    def acquire_lock(self, name, ttl):
+        now = datetime.utcnow()
+        token = uuid.uuid4().hex
+        lock = {
+            '_id': name,
+            'owner': token,
+            'expires_at': now + timedelta(seconds=ttl),
+        }
+        try:
+            self._db.locks.insert_one(lock)
+        except DuplicateKeyError:
+            # o monitor de TTL do mongo roda a cada minuto, entao um lock
+            # vencido pode ainda estar no banco
+            expired = self._db.locks.delete_one(
+                {'_id': name, 'expires_at': {'$lte': now}})
+            if not expired.deleted_count:
+                return None
+            try:
+                self._db.locks.insert_one(lock)
+            except DuplicateKeyError:
+                return None
+        return token
+
+    def release_lock(self, name, token):
+        self._db.locks.delete_one({'_id': name, 'owner': token})
+
+    def is_locked(self, name):
+        spec = {'_id': name, 'expires_at': {'$gt': datetime.utcnow()}}
+        return self._db.locks.find_one(spec) is not None
 
     def _fix_kwargs(self, kwargs):
         """Fix kwargs for different pymongo versions"""
@@ -57,59 +585,246 @@ class MongoDB(object):
 
     def get_one(self, cep, **kwargs):
         kwargs = self._fix_kwargs(kwargs)
+        if not _cacheable(kwargs):
+            return self._get_one(cep, **kwargs)
+
+        projection = kwargs.get('projection', kwargs.get('fields'))
+        r = _ceps_cache.get(cep)
+        if r is MISSING:
+            r = self._get_one(cep)
+            self._cache_cep(r)
+        return _project(r, projection)
+
+    def get_many(self, ceps, **kwargs):
+        """
+        Busca varios CEPs de uma vez. Os que nao estao no cache em memoria
+        sao lidos do banco com uma unica consulta `$in`.
+
+        Retorna um dict cep -> registro apenas com os CEPs encontrados.
+        """
+        kwargs = self._fix_kwargs(kwargs)
+        projection = kwargs.pop('projection', kwargs.pop('fields', None))
+
+        found = {}
+        missing = []
+        for cep in ceps:
+            r = _ceps_cache.get(cep)
+            if r is MISSING:
+                missing.append(cep)
+            else:
+                found[cep] = r
+
+        if missing:
+            for r in self._db.ceps.find({'cep': {'$in': missing}}):
+                self._fix_endereco(r)
+                self._cache_cep(r)
+                found[r['cep']] = r
+
+        return dict((cep, _project(r, projection))
+                    for cep, r in found.items())
+
+    def _get_one(self, cep, **kwargs):
         r = self._db.ceps.find_one({'cep': cep}, **kwargs)
+        self._fix_endereco(r)
+        return r
+
+    def _fix_endereco(self, r):
         if r and u'endereço' in r and 'endereco' not in r:
             # Garante que o cache também tem a key `endereco`. #92
             # Novos resultados já são adicionados corretamente.
             r['endereco'] = r[u'endereço']
-        return r
+
+    def _cache_cep(self, r):
+        if not r:
+            return
+        # o registro sai do cache quando expirar no banco
+        expiration = expires_at(r)
+        if expiration:
+            ttl = (expiration - datetime.now()).total_seconds()
+            _ceps_cache.set(r['cep'], r, min(ttl, _ceps_cache.ttl))
 
     def get_one_uf(self, sigla, **kwargs):
         kwargs = self._fix_kwargs(kwargs)
-        return self._db.ufs.find_one({'sigla': sigla}, **kwargs)
+        if not _cacheable(kwargs):
+            return self._db.ufs.find_one({'sigla': sigla}, **kwargs)
+
+        projection = kwargs.get('projection', kwargs.get('fields'))
+        r = _ufs_cache.get(sigla)
+        if r is MISSING:
+            r = self._db.ufs.find_one({'sigla': sigla})
+            _ufs_cache.set(sigla, r)
+        return _project(r, projection)
 
     def get_one_cidade(self, sigla_uf, nome_cidade, **kwargs):
-        def key_func(_uf, _cidade):
-            return u'{}_{}'.format(slug(_uf), slug(_cidade))
-        sigla_uf_nome_cidade = key_func(sigla_uf, nome_cidade)
-        spec = {'sigla_uf_nome_cidade': sigla_uf_nome_cidade}
-
-        search = re.search(r'\((.+)\)', nome_cidade)
-        if search:
-            nome_cidade_alternativa = search.group(1)
-            spec_alternativa = {
-                'sigla_uf_nome_cidade': key_func(
-                    sigla_uf, nome_cidade_alternativa)
-            }
-            spec = {'$or': [spec, spec_alternativa]}
-        
         kwargs = self._fix_kwargs(kwargs)
+        if not _cacheable(kwargs):
+            return self._get_one_cidade(sigla_uf, nome_cidade, **kwargs)
+
+        projection = kwargs.get('projection', kwargs.get('fields'))
+        key = (sigla_uf, nome_cidade)
+        r = _cidades_cache.get(key)
+        if r is MISSING:
+            r = self._get_one_cidade(sigla_uf, nome_cidade)
+            _cidades_cache.set(key, r)
+        return _project(r, projection)
+
+    def _get_one_cidade(self, sigla_uf, nome_cidade, **kwargs):
+        specs = [{'sigla_uf_nome_cidade': key}
+                 for key in _cidade_keys(sigla_uf, nome_cidade)]
+        spec = specs[0] if len(specs) == 1 else {'$or': specs}
         return self._db.cidades.find_one(spec, **kwargs)
 
+    def get_all_ceps(self):
+        return self._db.ceps.find(projection={'_id': False})
+
+    def get_range(self, start, end, after=None, limit=None):
+        cep = {'$gte': start, '$lte': end}
+        if after is not None and after >= start:
+            cep = {'$gt': after, '$lte': end}
+        spec = {
+            'cep': cep,
+            '_meta.' + _notfound_key: {'$exists': False},
+            _notfound_key: {'$exists': False},
+        }
+        # a ordenacao pelo indice de `cep` faz a busca por intervalo no
+        # proprio indice, sem ordenar em memoria
+        cursor = self._db.ceps.find(spec, projection={'_id': False})
+        cursor = cursor.sort('cep', pymongo.ASCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def get_all_ufs(self):
+        return self._db.ufs.find()
+
+    def get_all_cidades(self):
+        return self._db.cidades.find()
+
+    def get_ibge_updated_at(self):
+        r = self._db.meta.find_one({'_id': 'ibge'})
+        return r and r.get('updated_at')
+
+    def mark_ibge_updated(self):
+        self._db.meta.update({'_id': 'ibge'},
+                             {'$set': {'updated_at': datetime.utcnow()}},
+                             upsert=True)
+
     def get_one_uf_by_nome(self, nome, **kwargs):
         kwargs = self._fix_kwargs(kwargs)
         return self._db.ufs.find_one({'nome': nome}, **kwargs)
 
     def insert_or_update(self, obj, **kwargs):
+        kwargs = self._fix_kwargs(kwargs)
+        projection = kwargs.get('projection', kwargs.get('fields'))
 
         update = {'$set': obj}
         empty_fields = set(self._fields) - set(obj)
         if empty_fields:
             update['$unset'] = dict((x, 1) for x in empty_fields)
 
-        self._db.ceps.update({'cep': obj['cep']}, update, upsert=True)
+        # o documento gravado volta na mesma operacao, sem uma nova
+        # consulta, e ja entra no cache
+        r = self._db.ceps.find_one_and_update(
+            {'cep': obj['cep']}, update, upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER)
+        _ceps_cache.delete(obj['cep'])
+        self._fix_endereco(r)
+        self._cache_cep(r)
+        return _project(r, projection)
+
+    def bulk_insert_or_update(self, objs):
+        """
+        Mesma regra do `insert_or_update` para varios CEPs, com um
+        unico `bulk_write` nao ordenado.
+
+        Retorna as quantidades de documentos inseridos, alterados e
+        inalterados.
+        """
+        ops = []
+        for obj in objs:
+            update = {'$set': obj}
+            empty_fields = set(self._fields) - set(obj)
+            if empty_fields:
+                update['$unset'] = dict((x, 1) for x in empty_fields)
+            ops.append(pymongo.UpdateOne({'cep': obj['cep']}, update,
+                                         upsert=True))
+
+        result = {'inserted': 0, 'modified': 0, 'unchanged': 0}
+        if not ops:
+            return result
+        r = self._db.ceps.bulk_write(ops, ordered=False)
+        for obj in objs:
+            _ceps_cache.delete(obj['cep'])
+        result['inserted'] = r.upserted_count
+        result['modified'] = r.modified_count
+        result['unchanged'] = r.matched_count - r.modified_count
+        return result
 
     def insert_or_update_uf(self, obj, **kwargs):
-        update = {'$set': obj}
-        self._db.ufs.update({'sigla': obj['sigla']}, update, upsert=True)
+        # o documento muda fora do bulk, entao o _hash deixa de valer
+        update = {'$set': obj, '$unset': {'_hash': 1}}
+        self._db.ufs.update_one({'sigla': obj['sigla']}, update, upsert=True)
+        _ufs_cache.delete(obj['sigla'])
 
     def insert_or_update_cidade(self, obj, **kwargs):
-        update = {'$set': obj}
+        update = {'$set': obj, '$unset': {'_hash': 1}}
         chave = 'sigla_uf_nome_cidade'
-        self._db.cidades.update({chave: obj[chave]}, update, upsert=True)
+        self._db.cidades.update_one({chave: obj[chave]}, update, upsert=True)
+        # a chave do cache e o nome consultado, nao o slug gravado
+        _cidades_cache.clear()
+
+    def _bulk_upsert(self, collection, key, objs):
+        """
+        Grava `objs` com um unico `bulk_write` nao ordenado, pulando os
+        documentos cujo conteudo nao mudou (mesmo `_hash`).
+
+        Retorna as quantidades de documentos inseridos, alterados e
+        inalterados.
+        """
+        objs = [dict(obj, _hash=content_hash(obj)) for obj in objs]
+        keys = [obj[key] for obj in objs]
+        current = dict(
+            (doc[key], doc.get('_hash'))
+            for doc in collection.find({key: {'$in': keys}},
+                                       projection={key: True, '_hash': True}))
+
+        ops = [pymongo.UpdateOne({key: obj[key]}, {'$set': obj}, upsert=True)
+               for obj in objs if current.get(obj[key]) != obj['_hash']]
+        result = {
+            'inserted': 0,
+            'modified': 0,
+            'unchanged': len(objs) - len(ops),
+        }
+        if ops:
+            r = collection.bulk_write(ops, ordered=False)
+            result['inserted'] = r.upserted_count
+            result['modified'] = r.modified_count
+            result['unchanged'] += r.matched_count - r.modified_count
+        return result
+
+    def bulk_upsert_ufs(self, objs):
+        result = self._bulk_upsert(self._db.ufs, 'sigla', objs)
+        _ufs_cache.clear()
+        return result
+
+    def bulk_upsert_cidades(self, objs):
+        result = self._bulk_upsert(
+            self._db.cidades, 'sigla_uf_nome_cidade', objs)
+        _cidades_cache.clear()
+        return result
 
     def remove(self, cep):
         self._db.ceps.remove({'cep': cep})
+        _ceps_cache.delete(cep)
+
+    def remove_uf(self, sigla):
+        self._db.ufs.delete_one({'sigla': sigla})
+        _ufs_cache.delete(sigla)
+
+    def remove_cidade(self, sigla_uf_nome_cidade):
+        self._db.cidades.delete_one(
+            {'sigla_uf_nome_cidade': sigla_uf_nome_cidade})
+        _cidades_cache.clear()
 
     def find_empty_bairro_records(self):
         """Find all CEP records with empty or missing bairro field"""
@@ -166,6 +881,7 @@ class MongoDB(object):
         }
         
         result = self._db.ceps.delete_many(query)
+        _ceps_cache.clear()
         
         return {
             'count': result.deleted_count,
@@ -175,12 +891,14 @@ class MongoDB(object):
         }
 
 
-class PackTrack(object):
+class PackTrack(BasePackTrack):
 
     def __init__(self, collection):
         self._collection = collection
 
     def _patch(self, obj):
+        if obj is None:
+            return
         try:
             _id = obj.pop('_id')
         except KeyError:
@@ -194,11 +912,49 @@ class PackTrack(object):
         self._patch(obj)
         return obj
 
-    def get_all(self):
-        objs = list(self._collection.find())
-        for obj in objs:
+    def get_many(self, provider, tracks):
+        spec = {'servico': provider, 'codigo': {'$in': list(tracks)}}
+        found = {}
+        for obj in self._collection.find(spec):
             self._patch(obj)
-        return objs
+            found[obj['codigo']] = obj
+        return found
+
+    def get_by_token(self, token):
+        # o token e o `_id` do documento
+        if not ObjectId.is_valid(token):
+            return None
+        obj = self._collection.find_one({'_id': ObjectId(token)})
+        self._patch(obj)
+        return obj
+
+    def _stream(self, spec):
+        """
+        Le os pacotes sob demanda. Cada pacote leva uma consulta aos
+        Correios, entao o cursor pode ficar mais de 10 minutos sem
+        buscar o lote seguinte: sem `no_cursor_timeout` o servidor o
+        fecharia (`CursorNotFound`). O cursor e fechado ao fim da
+        leitura ou quando o gerador e descartado.
+        """
+        cursor = self._collection.find(spec, no_cursor_timeout=True,
+                                       batch_size=STREAM_BATCH_SIZE)
+        try:
+            for obj in cursor:
+                self._patch(obj)
+                yield obj
+        finally:
+            cursor.close()
+
+    def get_all(self):
+        return self._stream({})
+
+    def get_due(self, now):
+        spec = {'$or': [
+            {'_meta.next_check_at': {'$lte': now}},
+            # pacotes registrados antes do agendamento
+            {'_meta.next_check_at': {'$exists': False}},
+        ]}
+        return self._stream(spec)
 
     def register(self, provider, track, callback):
         key = {'servico': provider, 'codigo': track}
@@ -206,29 +962,124 @@ class PackTrack(object):
             '$addToSet': {
                 '_meta.callbacks': callback,
             },
+            # tambem agenda os pacotes que estavam apenas no cache
+            '$set': {
+                '_meta.next_check_at': datetime.utcnow(),
+            },
+            '$unset': {
+                '_meta.expires_at': '',
+            },
             '$setOnInsert': {
                 '_meta.created_at': datetime.utcnow(),
                 '_meta.changed_at': None,
                 '_meta.checked_at': None,
             },
         }
-        self._collection.find_and_modify(key, data, upsert=True)
-        obj = self._collection.find_one(key)
-        self._patch(obj)
-        return obj['token']
+        obj = self._collection.find_one_and_update(
+            key, data, projection={'_id': True}, upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER)
+        return str(obj['_id'])
+
+    def save(self, provider, track, data):
+        key = {'servico': provider, 'codigo': track}
+        now = datetime.utcnow()
+        set_ = {
+            'historico': data,
+            '_meta.fingerprint': history_fingerprint(data),
+            '_meta.checked_at': now,
+        }
+        # renova a expiracao somente enquanto o pacote nao tem callbacks,
+        # para nao expirar um pacote registrado entre a leitura e a escrita
+        spec = dict(key)
+        spec['_meta.callbacks'] = {'$size': 0}
+        cached = dict(set_)
+        cached['_meta.expires_at'] = now + TRACK_CACHE_TTL
+        if self._collection.update_one(spec, {'$set': cached}).matched_count:
+            return
+        self._collection.update_one(key, {
+            '$set': set_,
+            '$setOnInsert': {
+                '_meta.callbacks': [],
+                '_meta.created_at': now,
+                '_meta.changed_at': now,
+                '_meta.next_check_at': None,
+                '_meta.expires_at': now + TRACK_CACHE_TTL,
+            },
+        }, upsert=True)
 
-    def update(self, provider, track, data, changed):
+    def update(self, provider, track, data, changed, next_check_at=MISSING,
+               new_events=None, at_head=False):
         key = {'servico': provider, 'codigo': track}
         now = datetime.utcnow()
 
         set_ = {
             "_meta.checked_at": now
         }
+        if next_check_at is not MISSING:
+            set_['_meta.next_check_at'] = next_check_at
         if changed:
             set_.update({
                 '_meta.changed_at': now,
-                'historico': data,
+                '_meta.fingerprint': history_fingerprint(data),
             })
+            if new_events and len(new_events) < len(data):
+                if self._push(key, set_, data, new_events, at_head):
+                    return
+            set_['historico'] = data
 
         query = {"$set": set_}
-        self._collection.update(key, query)
+        self._collection.update_one(key, query)
+
+    def _push(self, key, set_, data, new_events, at_head):
+        """
+        Acrescenta somente os eventos novos ao historico gravado. Se o
+        historico gravado nao e o esperado (p.ex. atualizado por outro
+        processo ou sem `fingerprint`), nada e alterado.
+        """
+        size = len(new_events)
+        previous = data[size:] if at_head else data[:-size]
+        spec = dict(key)
+        spec['_meta.fingerprint'] = history_fingerprint(previous)
+        push = {'$each': new_events}
+        if at_head:
+            push['$position'] = 0
+        result = self._collection.update_one(
+            spec, {'$set': set_, '$push': {'historico': push}})
+        return result.matched_count > 0
+
+    def remove(self, provider, track):
+        self._collection.delete_one({'servico': provider, 'codigo': track})
+
+
+class Deliveries(BaseDeliveries):
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def add(self, objs):
+        self._collection.insert_many([dict(obj) for obj in objs],
+                                     ordered=False)
+
+    def get_one(self, _id):
+        return self._collection.find_one({'_id': _id})
+
+    def get_by_token(self, token):
+        return list(self._collection.find(
+            {'token': token}, sort=[('created_at', pymongo.ASCENDING)]))
+
+    def claim_due(self, now, lease, limit):
+        spec = {'next_attempt_at': {'$lte': now}}
+        update = {'$set': {'next_attempt_at': now + lease}}
+        claimed = []
+        # uma entrega por vez, para que cada reserva seja atomica
+        while len(claimed) < limit:
+            obj = self._collection.find_one_and_update(
+                spec, update, sort=[('next_attempt_at', pymongo.ASCENDING)],
+                return_document=pymongo.ReturnDocument.AFTER)
+            if obj is None:
+                break
+            claimed.append(obj)
+        return claimed
+
+    def update(self, _id, fields):
+        self._collection.update_one({'_id': _id}, {'$set': fields})
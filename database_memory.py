@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Backend de armazenamento em memoria (`POSTMON_DB_BACKEND=memory`).
+
+Os dados sao compartilhados por todas as instancias do processo e se
+perdem ao reinicia-lo. Util para os testes e para medir o custo do
+armazenamento nos benchmarks, sem um servidor MongoDB.
+"""
+from datetime import datetime, timedelta
+import copy
+import threading
+import uuid
+
+from bson import ObjectId
+
+from cache import MISSING
+from database import BaseDatabase, BaseDeliveries, BasePackTrack, \
+    TRACK_CACHE_TTL, _cidade_keys, _project, content_hash, \
+    history_fingerprint, is_notfound
+
+_lock = threading.RLock()
+_collections = {}
+
+
+def _collection(name):
+    return _collections.setdefault(name, {})
+
+
+def clear():
+    """Apaga todos os dados do processo"""
+    with _lock:
+        _collections.clear()
+
+
+def _get(name, key, projection=None):
+    with _lock:
+        doc = _collection(name).get(key)
+        return _project(copy.deepcopy(doc), projection)
+
+
+def _bulk_upsert(name, key, objs):
+    result = {'inserted': 0, 'modified': 0, 'unchanged': 0}
+    with _lock:
+        docs = _collection(name)
+        for obj in objs:
+            obj = dict(copy.deepcopy(obj), _hash=content_hash(obj))
+            current = docs.get(obj[key])
+            if current is None:
+                result['inserted'] += 1
+                docs[obj[key]] = obj
+            elif current.get('_hash') == obj['_hash']:
+                result['unchanged'] += 1
+            else:
+                result['modified'] += 1
+                current.update(obj)
+    return result
+
+
+class MemoryDatabase(BaseDatabase):
+
+    _fields = [
+        'logradouro',
+        'bairro',
+        'cidade',
+        'estado',
+        'complemento'
+    ]
+
+    def __init__(self):
+        self.packtrack = MemoryPackTrack()
+        self.deliveries = MemoryDeliveries()
+
+    def get_one(self, cep, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        return _get('ceps', cep, projection)
+
+    def get_all_ceps(self):
+        with _lock:
+            return copy.deepcopy(list(_collection('ceps').values()))
+
+    def get_range(self, start, end, after=None, limit=None):
+        if after is not None and after >= start:
+            start = after
+        with _lock:
+            docs = _collection('ceps')
+            ceps = sorted(cep for cep in docs
+                          if start <= cep <= end and cep != after)
+            result = []
+            for cep in ceps:
+                if limit and len(result) >= limit:
+                    break
+                if not is_notfound(docs[cep]):
+                    result.append(copy.deepcopy(docs[cep]))
+        return result
+
+    def get_one_uf(self, sigla, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        return _get('ufs', sigla, projection)
+
+    def get_one_uf_by_nome(self, nome, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        with _lock:
+            for uf in _collection('ufs').values():
+                if uf.get('nome') == nome:
+                    return _project(copy.deepcopy(uf), projection)
+        return None
+
+    def get_one_cidade(self, sigla_uf, nome_cidade, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        for key in _cidade_keys(sigla_uf, nome_cidade):
+            r = _get('cidades', key, projection)
+            if r is not None:
+                return r
+        return None
+
+    def get_all_ufs(self):
+        with _lock:
+            return copy.deepcopy(list(_collection('ufs').values()))
+
+    def get_all_cidades(self):
+        with _lock:
+            return copy.deepcopy(list(_collection('cidades').values()))
+
+    def get_ibge_updated_at(self):
+        r = _get('meta', 'ibge')
+        return r and r.get('updated_at')
+
+    def mark_ibge_updated(self):
+        with _lock:
+            _collection('meta')['ibge'] = {'updated_at': datetime.utcnow()}
+
+    def _insert_or_update(self, docs, obj):
+        current = docs.get(obj['cep'])
+        doc = dict(current or {})
+        doc.update(copy.deepcopy(obj))
+        for field in set(self._fields) - set(obj):
+            doc.pop(field, None)
+        docs[obj['cep']] = doc
+        if current is None:
+            return 'inserted', doc
+        return 'modified' if doc != current else 'unchanged', doc
+
+    def insert_or_update(self, obj, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        with _lock:
+            _, doc = self._insert_or_update(_collection('ceps'), obj)
+            return _project(copy.deepcopy(doc), projection)
+
+    def bulk_insert_or_update(self, objs):
+        result = {'inserted': 0, 'modified': 0, 'unchanged': 0}
+        with _lock:
+            docs = _collection('ceps')
+            for obj in objs:
+                status, _ = self._insert_or_update(docs, obj)
+                result[status] += 1
+        return result
+
+    def insert_or_update_uf(self, obj, **kwargs):
+        with _lock:
+            doc = _collection('ufs').setdefault(obj['sigla'], {})
+            doc.update(copy.deepcopy(obj))
+            doc.pop('_hash', None)
+
+    def insert_or_update_cidade(self, obj, **kwargs):
+        chave = 'sigla_uf_nome_cidade'
+        with _lock:
+            doc = _collection('cidades').setdefault(obj[chave], {})
+            doc.update(copy.deepcopy(obj))
+            doc.pop('_hash', None)
+
+    def bulk_upsert_ufs(self, objs):
+        return _bulk_upsert('ufs', 'sigla', objs)
+
+    def bulk_upsert_cidades(self, objs):
+        return _bulk_upsert('cidades', 'sigla_uf_nome_cidade', objs)
+
+    def remove(self, cep):
+        with _lock:
+            _collection('ceps').pop(cep, None)
+
+    def remove_uf(self, sigla):
+        with _lock:
+            _collection('ufs').pop(sigla, None)
+
+    def remove_cidade(self, sigla_uf_nome_cidade):
+        with _lock:
+            _collection('cidades').pop(sigla_uf_nome_cidade, None)
+
+    def acquire_lock(self, name, ttl):
+        now = datetime.utcnow()
+        with _lock:
+            locks = _collection('locks')
+            lock = locks.get(name)
+            if lock is not None and lock['expires_at'] > now:
+                return None
+            token = uuid.uuid4().hex
+            locks[name] = {
+                'owner': token,
+                'expires_at': now + timedelta(seconds=ttl),
+            }
+            return token
+
+    def release_lock(self, name, token):
+        with _lock:
+            locks = _collection('locks')
+            lock = locks.get(name)
+            if lock is not None and lock['owner'] == token:
+                del locks[name]
+
+    def is_locked(self, name):
+        lock = _get('locks', name)
+        return lock is not None and lock['expires_at'] > datetime.utcnow()
+
+
+class MemoryPackTrack(BasePackTrack):
+
+    def get_one(self, provider, track):
+        return _get('packtrack', (provider, track))
+
+    def get_all(self):
+        with _lock:
+            return copy.deepcopy(list(_collection('packtrack').values()))
+
+    def get_by_token(self, token):
+        with _lock:
+            for obj in _collection('packtrack').values():
+                if obj['token'] == token:
+                    return copy.deepcopy(obj)
+        return None
+
+    def get_due(self, now):
+        with _lock:
+            return copy.deepcopy([
+                obj for obj in _collection('packtrack').values()
+                if obj['_meta'].get('next_check_at') is not None and
+                obj['_meta']['next_check_at'] <= now])
+
+    def register(self, provider, track, callback):
+        with _lock:
+            docs = _collection('packtrack')
+            obj = docs.get((provider, track))
+            if obj is None:
+                obj = docs[(provider, track)] = {
+                    'servico': provider,
+                    'codigo': track,
+                    'token': str(ObjectId()),
+                    '_meta': {
+                        'callbacks': [],
+                        'created_at': datetime.utcnow(),
+                        'changed_at': None,
+                        'checked_at': None,
+                    },
+                }
+            obj['_meta']['next_check_at'] = datetime.utcnow()
+            obj['_meta'].pop('expires_at', None)
+            callbacks = obj['_meta'].setdefault('callbacks', [])
+            if callback not in callbacks:
+                callbacks.append(copy.deepcopy(callback))
+            return obj['token']
+
+    def save(self, provider, track, data):
+        now = datetime.utcnow()
+        with _lock:
+            docs = _collection('packtrack')
+            for key, obj in list(docs.items()):
+                expires_at = obj['_meta'].get('expires_at')
+                if expires_at is not None and expires_at <= now:
+                    del docs[key]
+            obj = docs.setdefault((provider, track), {
+                'servico': provider,
+                'codigo': track,
+                'token': str(ObjectId()),
+                '_meta': {
+                    'callbacks': [],
+                    'created_at': now,
+                    'changed_at': now,
+                    'next_check_at': None,
+                },
+            })
+            obj['historico'] = copy.deepcopy(data)
+            obj['_meta']['fingerprint'] = history_fingerprint(data)
+            obj['_meta']['checked_at'] = now
+            if not obj['_meta']['callbacks']:
+                obj['_meta']['expires_at'] = now + TRACK_CACHE_TTL
+
+    def update(self, provider, track, data, changed, next_check_at=MISSING,
+               new_events=None, at_head=False):
+        now = datetime.utcnow()
+        with _lock:
+            obj = _collection('packtrack').get((provider, track))
+            if obj is None:
+                return
+            obj['_meta']['checked_at'] = now
+            if next_check_at is not MISSING:
+                obj['_meta']['next_check_at'] = next_check_at
+            if changed:
+                obj['_meta']['changed_at'] = now
+                obj['_meta']['fingerprint'] = history_fingerprint(data)
+                obj['historico'] = copy.deepcopy(data)
+
+    def remove(self, provider, track):
+        with _lock:
+            _collection('packtrack').pop((provider, track), None)
+
+
+class MemoryDeliveries(BaseDeliveries):
+
+    def add(self, objs):
+        with _lock:
+            docs = _collection('deliveries')
+            for obj in objs:
+                docs[obj['_id']] = copy.deepcopy(obj)
+
+    def get_one(self, _id):
+        return _get('deliveries', _id)
+
+    def get_by_token(self, token):
+        with _lock:
+            return copy.deepcopy(sorted(
+                (obj for obj in _collection('deliveries').values()
+                 if obj.get('token') == token),
+                key=lambda obj: obj['created_at']))
+
+    def claim_due(self, now, lease, limit):
+        with _lock:
+            due = sorted(
+                (obj for obj in _collection('deliveries').values()
+                 if obj['next_attempt_at'] is not None and
+                 obj['next_attempt_at'] <= now),
+                key=lambda obj: obj['next_attempt_at'])[:limit]
+            for obj in due:
+                obj['next_attempt_at'] = now + lease
+            return copy.deepcopy(due)
+
+    def update(self, _id, fields):
+        with _lock:
+            obj = _collection('deliveries').get(_id)
+            if obj is not None:
+                obj.update(copy.deepcopy(fields))
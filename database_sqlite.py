@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Backend de armazenamento em SQLite (`POSTMON_DB_BACKEND=sqlite`).
+
+Cada colecao e uma tabela com a chave do documento e o documento
+codificado em BSON, preservando datas e o formato usado no MongoDB. O
+arquivo e definido por `POSTMON_DB_SQLITE_PATH` (padrao:
+`postmon.sqlite3`) e cada thread usa sua propria conexao.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import calendar
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import bson
+from bson import ObjectId
+
+from cache import MISSING
+from database import BaseDatabase, BaseDeliveries, BasePackTrack, \
+    TRACK_CACHE_TTL, _cidade_keys, _project, content_hash, \
+    history_fingerprint, is_notfound
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS ceps (cep TEXT PRIMARY KEY, doc BLOB);
+CREATE TABLE IF NOT EXISTS ufs (sigla TEXT PRIMARY KEY, nome TEXT, doc BLOB);
+CREATE INDEX IF NOT EXISTS ufs_nome ON ufs (nome);
+CREATE TABLE IF NOT EXISTS cidades (chave TEXT PRIMARY KEY, doc BLOB);
+CREATE TABLE IF NOT EXISTS meta (id TEXT PRIMARY KEY, doc BLOB);
+CREATE TABLE IF NOT EXISTS locks (
+    name TEXT PRIMARY KEY, owner TEXT, expires_at REAL);
+CREATE TABLE IF NOT EXISTS packtrack (
+    servico TEXT, codigo TEXT, token TEXT, next_check_at REAL,
+    expires_at REAL, doc BLOB, PRIMARY KEY (servico, codigo));
+CREATE INDEX IF NOT EXISTS packtrack_next_check_at
+    ON packtrack (next_check_at);
+CREATE INDEX IF NOT EXISTS packtrack_expires_at ON packtrack (expires_at);
+CREATE UNIQUE INDEX IF NOT EXISTS packtrack_token ON packtrack (token);
+CREATE TABLE IF NOT EXISTS deliveries (
+    id TEXT PRIMARY KEY, token TEXT, next_attempt_at REAL, doc BLOB);
+CREATE INDEX IF NOT EXISTS deliveries_next_attempt_at
+    ON deliveries (next_attempt_at);
+CREATE INDEX IF NOT EXISTS deliveries_token ON deliveries (token);
+'''
+
+# tabela -> (coluna, campo do documento) da chave
+_keys = {
+    'ufs': ('sigla', 'sigla'),
+    'cidades': ('chave', 'sigla_uf_nome_cidade'),
+}
+
+_local = threading.local()
+
+
+def _encode(doc):
+    return sqlite3.Binary(bson.encode(doc))
+
+
+def _decode(data):
+    return bson.decode(bytes(data))
+
+
+def _timestamp(dt):
+    """Segundos desde a epoch de uma data UTC, ou None"""
+    if dt is None:
+        return None
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def get_connection(path):
+    """Conexao da thread atual, recriada apos um fork"""
+    pid = os.getpid()
+    if getattr(_local, 'pid', None) != pid:
+        _local.connections = {}
+        _local.pid = pid
+
+    conn = _local.connections.get(path)
+    if conn is None:
+        # as transacoes sao controladas explicitamente em `_transaction`
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_schema)
+        _local.connections[path] = conn
+    return conn
+
+
+class _Base(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def _conn(self):
+        return get_connection(self.path)
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _get(self, sql, args, projection=None):
+        row = self._conn.execute(sql, args).fetchone()
+        if row is None:
+            return None
+        return _project(_decode(row[0]), projection)
+
+    def _iter(self, sql, args=()):
+        for row in self._conn.execute(sql, args):
+            yield _decode(row[0])
+
+
+class SQLiteDatabase(_Base, BaseDatabase):
+
+    _fields = [
+        'logradouro',
+        'bairro',
+        'cidade',
+        'estado',
+        'complemento'
+    ]
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get('POSTMON_DB_SQLITE_PATH',
+                                  'postmon.sqlite3')
+        super(SQLiteDatabase, self).__init__(path)
+        self.packtrack = SQLitePackTrack(path)
+        self.deliveries = SQLiteDeliveries(path)
+
+    def get_one(self, cep, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        return self._get('SELECT doc FROM ceps WHERE cep = ?', (cep,),
+                         projection)
+
+    def get_many(self, ceps, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        ceps = list(ceps)
+        if not ceps:
+            return {}
+        sql = 'SELECT doc FROM ceps WHERE cep IN (%s)' % (
+            ','.join('?' * len(ceps)))
+        return dict((r['cep'], _project(r, projection))
+                    for r in self._iter(sql, ceps))
+
+    def get_all_ceps(self):
+        return self._iter('SELECT doc FROM ceps')
+
+    def get_range(self, start, end, after=None, limit=None):
+        sql = 'SELECT doc FROM ceps WHERE cep >= ? AND cep <= ?'
+        if after is not None and after >= start:
+            sql = 'SELECT doc FROM ceps WHERE cep > ? AND cep <= ?'
+            start = after
+        count = 0
+        # o cursor e lido sob demanda, entao os registros "not found"
+        # sao descartados sem carregar o intervalo inteiro
+        for r in self._iter(sql + ' ORDER BY cep', (start, end)):
+            if limit and count >= limit:
+                return
+            if not is_notfound(r):
+                count += 1
+                yield r
+
+    def get_one_uf(self, sigla, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        return self._get('SELECT doc FROM ufs WHERE sigla = ?', (sigla,),
+                         projection)
+
+    def get_one_uf_by_nome(self, nome, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        return self._get('SELECT doc FROM ufs WHERE nome = ?', (nome,),
+                         projection)
+
+    def get_one_cidade(self, sigla_uf, nome_cidade, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        for key in _cidade_keys(sigla_uf, nome_cidade):
+            r = self._get('SELECT doc FROM cidades WHERE chave = ?', (key,),
+                          projection)
+            if r is not None:
+                return r
+        return None
+
+    def get_all_ufs(self):
+        return self._iter('SELECT doc FROM ufs')
+
+    def get_all_cidades(self):
+        return self._iter('SELECT doc FROM cidades')
+
+    def get_ibge_updated_at(self):
+        r = self._get("SELECT doc FROM meta WHERE id = 'ibge'", ())
+        return r and r.get('updated_at')
+
+    def mark_ibge_updated(self):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (id, doc) VALUES ('ibge', ?)",
+                (_encode({'updated_at': datetime.utcnow()}),))
+
+    def _insert_or_update(self, conn, obj):
+        row = conn.execute('SELECT doc FROM ceps WHERE cep = ?',
+                           (obj['cep'],)).fetchone()
+        current = _decode(row[0]) if row else None
+        doc = dict(current or {})
+        doc.update(obj)
+        for field in set(self._fields) - set(obj):
+            doc.pop(field, None)
+        conn.execute('INSERT OR REPLACE INTO ceps (cep, doc) VALUES (?, ?)',
+                     (obj['cep'], _encode(doc)))
+        if current is None:
+            return 'inserted', doc
+        return 'modified' if doc != current else 'unchanged', doc
+
+    def insert_or_update(self, obj, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        with self._transaction() as conn:
+            _, doc = self._insert_or_update(conn, obj)
+        return _project(doc, projection)
+
+    def bulk_insert_or_update(self, objs):
+        result = {'inserted': 0, 'modified': 0, 'unchanged': 0}
+        with self._transaction() as conn:
+            for obj in objs:
+                status, _ = self._insert_or_update(conn, obj)
+                result[status] += 1
+        return result
+
+    def _upsert(self, conn, table, obj, hash_=None):
+        column, field = _keys[table]
+        row = conn.execute(
+            'SELECT doc FROM %s WHERE %s = ?' % (table, column),
+            (obj[field],)).fetchone()
+        current = _decode(row[0]) if row else None
+        if hash_ is not None and current and current.get('_hash') == hash_:
+            return 'unchanged'
+
+        doc = dict(current or {})
+        doc.update(obj)
+        if hash_ is None:
+            # o documento muda fora do bulk, entao o _hash deixa de valer
+            doc.pop('_hash', None)
+        else:
+            doc['_hash'] = hash_
+        if table == 'ufs':
+            conn.execute(
+                'INSERT OR REPLACE INTO ufs (sigla, nome, doc) '
+                'VALUES (?, ?, ?)',
+                (doc['sigla'], doc.get('nome'), _encode(doc)))
+        else:
+            conn.execute(
+                'INSERT OR REPLACE INTO cidades (chave, doc) VALUES (?, ?)',
+                (doc['sigla_uf_nome_cidade'], _encode(doc)))
+        return 'modified' if current else 'inserted'
+
+    def _bulk_upsert(self, table, objs):
+        result = {'inserted': 0, 'modified': 0, 'unchanged': 0}
+        with self._transaction() as conn:
+            for obj in objs:
+                result[self._upsert(conn, table, obj, content_hash(obj))] += 1
+        return result
+
+    def insert_or_update_uf(self, obj, **kwargs):
+        with self._transaction() as conn:
+            self._upsert(conn, 'ufs', obj)
+
+    def insert_or_update_cidade(self, obj, **kwargs):
+        with self._transaction() as conn:
+            self._upsert(conn, 'cidades', obj)
+
+    def bulk_upsert_ufs(self, objs):
+        return self._bulk_upsert('ufs', objs)
+
+    def bulk_upsert_cidades(self, objs):
+        return self._bulk_upsert('cidades', objs)
+
+    def remove(self, cep):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM ceps WHERE cep = ?', (cep,))
+
+    def remove_uf(self, sigla):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM ufs WHERE sigla = ?', (sigla,))
+
+    def remove_cidade(self, sigla_uf_nome_cidade):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM cidades WHERE chave = ?',
+                         (sigla_uf_nome_cidade,))
+
+    def acquire_lock(self, name, ttl):
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._transaction() as conn:
+            conn.execute(
+                'DELETE FROM locks WHERE name = ? AND expires_at <= ?',
+                (name, now))
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO locks (name, owner, expires_at) '
+                'VALUES (?, ?, ?)', (name, token, now + ttl))
+            if not cursor.rowcount:
+                return None
+        return token
+
+    def release_lock(self, name, token):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM locks WHERE name = ? AND owner = ?',
+                         (name, token))
+
+    def is_locked(self, name):
+        row = self._conn.execute(
+            'SELECT 1 FROM locks WHERE name = ? AND expires_at > ?',
+            (name, time.time())).fetchone()
+        return row is not None
+
+
+class SQLitePackTrack(_Base, BasePackTrack):
+
+    def _get_doc(self, conn, provider, track):
+        row = conn.execute(
+            'SELECT doc FROM packtrack WHERE servico = ? AND codigo = ?',
+            (provider, track)).fetchone()
+        return _decode(row[0]) if row else None
+
+    def _put_doc(self, conn, obj):
+        next_check_at = _timestamp(obj['_meta'].get('next_check_at'))
+        expires_at = _timestamp(obj['_meta'].get('expires_at'))
+        conn.execute(
+            'INSERT OR REPLACE INTO packtrack '
+            '(servico, codigo, token, next_check_at, expires_at, doc) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (obj['servico'], obj['codigo'], obj['token'], next_check_at,
+             expires_at, _encode(obj)))
+
+    def get_one(self, provider, track):
+        return self._get_doc(self._conn, provider, track)
+
+    def get_by_token(self, token):
+        return self._get('SELECT doc FROM packtrack WHERE token = ?',
+                         (token,))
+
+    def get_all(self):
+        return self._iter('SELECT doc FROM packtrack')
+
+    def get_due(self, now):
+        return self._iter(
+            'SELECT doc FROM packtrack WHERE next_check_at <= ?',
+            (_timestamp(now),))
+
+    def register(self, provider, track, callback):
+        with self._transaction() as conn:
+            obj = self._get_doc(conn, provider, track)
+            if obj is None:
+                obj = {
+                    'servico': provider,
+                    'codigo': track,
+                    'token': str(ObjectId()),
+                    '_meta': {
+                        'callbacks': [],
+                        'created_at': datetime.utcnow(),
+                        'changed_at': None,
+                        'checked_at': None,
+                    },
+                }
+            obj['_meta']['next_check_at'] = datetime.utcnow()
+            obj['_meta'].pop('expires_at', None)
+            callbacks = obj['_meta'].setdefault('callbacks', [])
+            if callback not in callbacks:
+                callbacks.append(callback)
+            self._put_doc(conn, obj)
+        return obj['token']
+
+    def save(self, provider, track, data):
+        now = datetime.utcnow()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM packtrack WHERE expires_at <= ?',
+                         (_timestamp(now),))
+            obj = self._get_doc(conn, provider, track)
+            if obj is None:
+                obj = {
+                    'servico': provider,
+                    'codigo': track,
+                    'token': str(ObjectId()),
+                    '_meta': {
+                        'callbacks': [],
+                        'created_at': now,
+                        'changed_at': now,
+                        'next_check_at': None,
+                    },
+                }
+            obj['historico'] = data
+            obj['_meta']['fingerprint'] = history_fingerprint(data)
+            obj['_meta']['checked_at'] = now
+            if not obj['_meta']['callbacks']:
+                obj['_meta']['expires_at'] = now + TRACK_CACHE_TTL
+            self._put_doc(conn, obj)
+
+    def update(self, provider, track, data, changed, next_check_at=MISSING,
+               new_events=None, at_head=False):
+        now = datetime.utcnow()
+        with self._transaction() as conn:
+            obj = self._get_doc(conn, provider, track)
+            if obj is None:
+                return
+            obj['_meta']['checked_at'] = now
+            if next_check_at is not MISSING:
+                obj['_meta']['next_check_at'] = next_check_at
+            if changed:
+                obj['_meta']['changed_at'] = now
+                obj['_meta']['fingerprint'] = history_fingerprint(data)
+                obj['historico'] = data
+            self._put_doc(conn, obj)
+
+    def remove(self, provider, track):
+        with self._transaction() as conn:
+            conn.execute(
+                'DELETE FROM packtrack WHERE servico = ? AND codigo = ?',
+                (provider, track))
+
+
+class SQLiteDeliveries(_Base, BaseDeliveries):
+
+    def _put_doc(self, conn, obj):
+        conn.execute(
+            'INSERT OR REPLACE INTO deliveries '
+            '(id, token, next_attempt_at, doc) VALUES (?, ?, ?, ?)',
+            (obj['_id'], obj.get('token'), _timestamp(obj['next_attempt_at']),
+             _encode(obj)))
+
+    def add(self, objs):
+        with self._transaction() as conn:
+            for obj in objs:
+                self._put_doc(conn, obj)
+
+    def get_one(self, _id):
+        return self._get('SELECT doc FROM deliveries WHERE id = ?', (_id,))
+
+    def get_by_token(self, token):
+        return sorted(
+            self._iter('SELECT doc FROM deliveries WHERE token = ?',
+                       (token,)),
+            key=lambda obj: obj['created_at'])
+
+    def claim_due(self, now, lease, limit):
+        with self._transaction() as conn:
+            rows = conn.execute(
+                'SELECT doc FROM deliveries WHERE next_attempt_at <= ? '
+                'ORDER BY next_attempt_at LIMIT ?',
+                (_timestamp(now), limit)).fetchall()
+            claimed = [_decode(row[0]) for row in rows]
+            for obj in claimed:
+                obj['next_attempt_at'] = now + lease
+                self._put_doc(conn, obj)
+        return claimed
+
+    def update(self, _id, fields):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT doc FROM deliveries WHERE id = ?',
+                               (_id,)).fetchone()
+            if row is None:
+                return
+            obj = _decode(row[0])
+            obj.update(fields)
+            self._put_doc(conn, obj)
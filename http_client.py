@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cliente HTTP compartilhado pelas chamadas externas do Postmon.
+
+Todas as requisicoes usam uma mesma `requests.Session` por processo, com
+pool de conexoes por host e keep-alive, evitando um novo handshake TCP/TLS
+a cada chamada. Falhas de conexao e respostas 502/503/504 de requisicoes
+idempotentes sao repetidas com backoff exponencial, exceto quando quem
+chama ja tem sua propria politica de falha (`retry=False`).
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = float(os.environ.get('POSTMON_HTTP_TIMEOUT', 10))
+
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+
+def _build_session(retry):
+    total = int(os.environ.get('POSTMON_HTTP_RETRIES', 2)) if retry else 0
+    retries = Retry(
+        total=total,
+        backoff_factor=float(os.environ.get('POSTMON_HTTP_BACKOFF', 0.2)),
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=int(
+            os.environ.get('POSTMON_HTTP_POOL_CONNECTIONS', 10)),
+        pool_maxsize=int(os.environ.get('POSTMON_HTTP_POOL_MAXSIZE', 20)),
+        max_retries=retries,
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = 'Postmon/1.0'
+    return session
+
+
+def get_session(retry=True):
+    """Sessao do processo atual, recriada apos um fork"""
+    global _sessions, _sessions_pid
+
+    pid = os.getpid()
+    if _sessions_pid != pid or retry not in _sessions:
+        with _sessions_lock:
+            if _sessions_pid != pid:
+                _sessions = {}
+                _sessions_pid = pid
+            if retry not in _sessions:
+                _sessions[retry] = _build_session(retry)
+    return _sessions[retry]
+
+
+def request(method, url, retry=True, **kwargs):
+    kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+    return get_session(retry).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
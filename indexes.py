@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Indices das colecoes do MongoDB.
+
+`INDEXES` declara os indices de cada colecao e `QUERIES` as consultas
+feitas a cada requisicao ou tarefa, que devem sempre usar um indice.
+`ensure_indexes` cria os indices que faltam e `check_indexes` lista os
+indices ausentes ou diferentes do declarado e as consultas que varrem a
+colecao ou ordenam em memoria.
+
+Um indice existente com outras opcoes (p.ex. o antigo `ceps.cep` sem
+`unique`) nao e alterado na inicializacao; para recria-lo:
+
+    $ python indexes.py --check
+    $ python indexes.py --rebuild
+"""
+from datetime import datetime
+import argparse
+import logging
+import os
+
+import pymongo
+from pymongo.errors import OperationFailure, PyMongoError
+
+from CepTracker import _notfound_key
+
+logger = logging.getLogger(__name__)
+
+ASC = pymongo.ASCENDING
+
+# O `_meta.v_date` e gravado na hora local e o monitor de TTL do MongoDB
+# compara com UTC, entao a remocao dos registros "not found" tem uma
+# folga maior que qualquer fuso. A validade de 10 minutos continua sendo
+# verificada na leitura, por `expires_at`.
+NOTFOUND_PURGE_AFTER = int(
+    os.environ.get('POSTMON_NOTFOUND_PURGE_AFTER', 86400))
+
+# entregas de callbacks ficam na caixa de saida por 30 dias
+DELIVERIES_TTL = int(os.environ.get('POSTMON_WEBHOOK_RETENTION', 2592000))
+
+# colecao -> [(chaves, opcoes)]
+INDEXES = {
+    'ceps': [
+        ([('cep', ASC)], {'unique': True}),
+        ([('_meta.v_date', ASC)], {
+            'name': 'notfound_ttl',
+            'expireAfterSeconds': NOTFOUND_PURGE_AFTER,
+            'partialFilterExpression': {'_meta.' + _notfound_key: True},
+        }),
+    ],
+    'ufs': [
+        ([('sigla', ASC)], {'unique': True}),
+        ([('nome', ASC)], {}),
+    ],
+    'cidades': [
+        ([('sigla_uf_nome_cidade', ASC)], {'unique': True}),
+    ],
+    'packtrack': [
+        ([('servico', ASC), ('codigo', ASC)], {'unique': True}),
+        ([('_meta.next_check_at', ASC)], {}),
+        # somente os pacotes apenas em cache tem `_meta.expires_at`
+        ([('_meta.expires_at', ASC)], {'expireAfterSeconds': 0}),
+    ],
+    'locks': [
+        ([('expires_at', ASC)], {'expireAfterSeconds': 0}),
+    ],
+    'deliveries': [
+        ([('next_attempt_at', ASC)], {}),
+        ([('token', ASC), ('created_at', ASC)], {}),
+        ([('created_at', ASC)], {'expireAfterSeconds': DELIVERIES_TTL}),
+    ],
+}
+
+# (colecao, filtro, ordenacao)
+QUERIES = [
+    ('ceps', {'cep': '01310100'}, None),
+    ('ceps', {'cep': {'$gte': '01300000', '$lte': '01399999'}},
+     [('cep', ASC)]),
+    ('ufs', {'sigla': 'SP'}, None),
+    ('ufs', {'nome': u'São Paulo'}, None),
+    ('cidades', {'sigla_uf_nome_cidade': u'SP_SAO PAULO'}, None),
+    ('packtrack', {'servico': 'ect', 'codigo': 'SS123456789BR'}, None),
+    ('packtrack', {'_meta.next_check_at': {'$lte': datetime(2020, 1, 1)}},
+     None),
+    ('deliveries', {'next_attempt_at': {'$lte': datetime(2020, 1, 1)}},
+     [('next_attempt_at', ASC)]),
+    ('deliveries', {'token': '5d2e1e4f8b3c2a0001a1b2c3'},
+     [('created_at', ASC)]),
+]
+
+_options = ('unique', 'expireAfterSeconds', 'partialFilterExpression')
+
+
+def _keys(info):
+    return [(k, int(d)) for k, d in info['key']]
+
+
+def _find(existing, keys):
+    """Nome e informacoes do indice existente com as chaves `keys`"""
+    for name, info in existing.items():
+        if _keys(info) == keys:
+            return name, info
+    return None, None
+
+
+def _matches(info, options):
+    return all(info.get(o) == options.get(o) for o in _options)
+
+
+def _describe(collection, keys):
+    return u'{}({})'.format(
+        collection, u', '.join(u'{}: {}'.format(k, d) for k, d in keys))
+
+
+def _create(collection, keys, options):
+    try:
+        collection.create_index(keys, **options)
+    except OperationFailure as e:
+        # p.ex. CEPs duplicados impedem a criacao do indice unico
+        logger.error(u'Erro ao criar o indice %s: %s',
+                     _describe(collection.name, keys), e)
+        return False
+    return True
+
+
+def ensure_indexes(db, rebuild=False):
+    """
+    Cria os indices de `INDEXES` que ainda nao existem. Com `rebuild`,
+    os indices com as mesmas chaves e outras opcoes sao recriados.
+    """
+    for name, declared in sorted(INDEXES.items()):
+        collection = db[name]
+        existing = collection.index_information()
+        for keys, options in declared:
+            index, info = _find(existing, keys)
+            if info is None:
+                _create(collection, keys, options)
+                continue
+            if _matches(info, options):
+                continue
+            if not rebuild:
+                logger.warning(u'Indice %s difere do declarado, use '
+                               u'`python indexes.py --rebuild`',
+                               _describe(name, keys))
+                continue
+
+            logger.info(u'Recriando o indice %s', _describe(name, keys))
+            collection.drop_index(index)
+            if not _create(collection, keys, options):
+                # volta o indice anterior para nao deixar a colecao sem
+                # indice nenhum
+                old = dict((o, info[o]) for o in _options if o in info)
+                _create(collection, keys, dict(old, name=index))
+
+
+def _stages(plan):
+    yield plan['stage']
+    inputs = plan.get('inputStages', [])
+    if 'inputStage' in plan:
+        inputs = [plan['inputStage']]
+    for stage in inputs:
+        for s in _stages(stage):
+            yield s
+
+
+def _explain(collection, spec, sort):
+    cursor = collection.find(spec, sort=sort, limit=1)
+    plan = cursor.explain()['queryPlanner']['winningPlan']
+    # no slot based engine (MongoDB 6+) a arvore fica em `queryPlan`
+    return plan.get('queryPlan', plan)
+
+
+def check_indexes(db):
+    """
+    Lista os problemas encontrados: indices ausentes ou com opcoes
+    diferentes e consultas de `QUERIES` com COLLSCAN ou SORT em memoria.
+    """
+    problems = []
+    for name, declared in sorted(INDEXES.items()):
+        existing = db[name].index_information()
+        for keys, options in declared:
+            index, info = _find(existing, keys)
+            if info is None:
+                problems.append(u'indice ausente: {}'.format(
+                    _describe(name, keys)))
+            elif not _matches(info, options):
+                problems.append(u'indice {} com opcoes diferentes: {}'.format(
+                    _describe(name, keys),
+                    dict((o, info.get(o)) for o in _options)))
+
+    for name, spec, sort in QUERIES:
+        try:
+            stages = set(_stages(_explain(db[name], spec, sort)))
+        except (PyMongoError, KeyError, TypeError) as e:
+            problems.append(u'nao foi possivel analisar {} {}: {}'.format(
+                name, spec, e))
+            continue
+        for stage in ('COLLSCAN', 'SORT'):
+            if stage in stages:
+                problems.append(u'consulta com {} em {}: {}'.format(
+                    stage, name, spec))
+    return problems
+
+
+def _standalone(argv=None):
+    from database import MongoDB
+
+    parser = argparse.ArgumentParser(
+        description="Cria e verifica os indices do MongoDB")
+    parser.add_argument('--check', action='store_true',
+                        help="somente lista os problemas encontrados")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="recria os indices com opcoes diferentes")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    db = MongoDB()
+    if not args.check:
+        ensure_indexes(db._db, rebuild=args.rebuild)
+    problems = check_indexes(db._db)
+    for problem in problems:
+        print(problem)
+    if not problems:
+        print("Indices OK")
+
+
+if __name__ == "__main__":
+    _standalone()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Copia somente leitura das colecoes `ceps`, `ufs` e `cidades` em um unico
+arquivo binario, consultado via mmap sem depender do MongoDB.
+
+Formato do arquivo (little-endian):
+
+    cabecalho | tabela de valores | indice de ceps | indice de ufs |
+    indice de cidades
+
+Os valores sao os documentos codificados em BSON. O indice de ceps e um
+array ordenado de entradas de tamanho fixo (CEP com 8 digitos, offset e
+tamanho do valor); os indices de ufs e cidades guardam tambem offset e
+tamanho da chave, que fica na tabela de valores. As consultas sao buscas
+binarias direto no mmap, entao varios processos servindo o mesmo arquivo
+compartilham o page cache do sistema.
+
+Uso:
+
+    $ python snapshot.py postmon.snapshot
+    $ POSTMON_DB_SNAPSHOT=postmon.snapshot python PostmonServer.py
+"""
+from datetime import datetime
+import argparse
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+import bson
+
+from cache import LRUCache, MISSING
+from database import BaseDatabase, CEP_TTL, Database, _cidade_keys, \
+    _project, expires_at, is_notfound
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PMSNAP01'
+
+# magic, criado em, quantidade de ceps, ufs e cidades, offsets da tabela
+# de valores e dos indices
+_header = struct.Struct('<8sdIIIQQQQ')
+_cep_entry = struct.Struct('<8sQI')
+_key_entry = struct.Struct('<QIQI')
+
+_cep_re = re.compile(r'^[0-9]{8}$')
+
+
+class _Writer(object):
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+
+    def add(self, data):
+        offset = self.offset
+        self.f.write(data)
+        self.offset += len(data)
+        return offset, len(data)
+
+
+def _unique(entries):
+    """Entradas ordenadas, mantendo a primeira de cada chave"""
+    last = None
+    for entry in sorted(entries, key=lambda e: e[0]):
+        if entry[0] != last:
+            last = entry[0]
+            yield entry
+
+
+def _doc(r):
+    r = dict(r)
+    r.pop('_id', None)
+    r.pop('_hash', None)
+    return r
+
+
+def export(db, path):
+    """
+    Grava o snapshot de `db` em `path`. O arquivo e escrito ao lado e
+    renomeado no final, entao servidores com o arquivo antigo mapeado
+    continuam funcionando.
+
+    Retorna as quantidades de ceps, ufs e cidades exportados.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(b'\0' * _header.size)
+        values = _Writer(f)
+
+        ceps = []
+        for r in db.get_all_ceps():
+            cep = r.get('cep')
+            if not cep or not _cep_re.match(cep) or is_notfound(r):
+                continue
+            key = cep.encode('ascii')
+            value = values.add(bson.encode(_doc(r)))
+            ceps.append((key, _cep_entry.pack(key, *value)))
+
+        def keyed(docs, field):
+            entries = []
+            for r in docs:
+                key = r.get(field)
+                if not key:
+                    continue
+                key = key.encode('utf-8')
+                entry = values.add(key) + values.add(bson.encode(_doc(r)))
+                entries.append((key, _key_entry.pack(*entry)))
+            return entries
+
+        ufs = keyed(db.get_all_ufs(), 'sigla')
+        cidades = keyed(db.get_all_cidades(), 'sigla_uf_nome_cidade')
+
+        values_offset = _header.size
+        offsets = []
+        counts = []
+        for entries in (ceps, ufs, cidades):
+            offsets.append(values_offset + values.offset)
+            count = 0
+            for _, entry in _unique(entries):
+                values.add(entry)
+                count += 1
+            counts.append(count)
+
+        f.seek(0)
+        f.write(_header.pack(MAGIC, time.time(), counts[0], counts[1],
+                             counts[2], values_offset, *offsets))
+    os.rename(tmp, path)
+
+    result = dict(zip(('ceps', 'ufs', 'cidades'), counts))
+    logger.info("Snapshot gravado em %s: %s", path, result)
+    return result
+
+
+class _Snapshot(object):
+    """Arquivo mapeado em memoria, compartilhado pelo processo"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = _header.unpack_from(self.mm, 0)
+        if header[0] != MAGIC:
+            self.mm.close()
+            raise ValueError(u"Arquivo de snapshot invalido: %s" % path)
+        (_, created_at, self.n_ceps, self.n_ufs, self.n_cidades,
+         self.values, self.ceps, self.ufs, self.cidades) = header
+        self.created_at = datetime.utcfromtimestamp(created_at)
+
+        # CEPs consultados nas fontes externas depois do snapshot
+        self.overlay = LRUCache(
+            maxsize=int(os.environ.get('POSTMON_SNAPSHOT_OVERLAY_SIZE',
+                                       10000)),
+            ttl=CEP_TTL.total_seconds())
+
+    def value(self, offset, size):
+        start = self.values + offset
+        return bson.decode(self.mm[start:start + size])
+
+    def find_cep(self, cep):
+        if not _cep_re.match(cep or ''):
+            return None
+        key = cep.encode('ascii')
+        lo, hi = 0, self.n_ceps
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = _cep_entry.unpack_from(
+                self.mm, self.ceps + mid * _cep_entry.size)
+            if entry[0] < key:
+                lo = mid + 1
+            elif entry[0] > key:
+                hi = mid
+            else:
+                return self.value(entry[1], entry[2])
+        return None
+
+    def iter_ceps(self, start):
+        """Registros a partir do primeiro CEP >= `start`, em ordem"""
+        key = start.encode('ascii')
+        lo, hi = 0, self.n_ceps
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = _cep_entry.unpack_from(
+                self.mm, self.ceps + mid * _cep_entry.size)
+            if entry[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo, self.n_ceps):
+            entry = _cep_entry.unpack_from(
+                self.mm, self.ceps + i * _cep_entry.size)
+            yield entry[0].decode('ascii'), entry
+
+    def _key(self, entry):
+        start = self.values + entry[0]
+        return self.mm[start:start + entry[1]]
+
+    def find_key(self, table, count, key):
+        key = key.encode('utf-8')
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = _key_entry.unpack_from(
+                self.mm, table + mid * _key_entry.size)
+            current = self._key(entry)
+            if current < key:
+                lo = mid + 1
+            elif current > key:
+                hi = mid
+            else:
+                return self.value(entry[2], entry[3])
+        return None
+
+    def iter_table(self, table, count):
+        for i in range(count):
+            entry = _key_entry.unpack_from(
+                self.mm, table + i * _key_entry.size)
+            yield self.value(entry[2], entry[3])
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(path):
+    """Snapshot de `path`, mapeado uma unica vez por processo"""
+    snapshot = _snapshots.get(path)
+    if snapshot is None:
+        with _snapshots_lock:
+            snapshot = _snapshots.get(path)
+            if snapshot is None:
+                snapshot = _snapshots[path] = _Snapshot(path)
+    return snapshot
+
+
+class SnapshotDatabase(BaseDatabase):
+    """
+    Backend somente leitura sobre um arquivo gerado por `export`, com a
+    mesma interface de consulta dos demais backends.
+
+    CEPs gravados com `insert_or_update` (consultas as fontes externas
+    para CEPs fora do snapshot) ficam em um cache em memoria de ate
+    `POSTMON_SNAPSHOT_OVERLAY_SIZE` registros.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ['POSTMON_DB_SNAPSHOT']
+        self.path = path
+        self._snapshot = get_snapshot(path)
+
+    def get_one(self, cep, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        r = self._snapshot.overlay.get(cep)
+        if r is MISSING:
+            r = self._snapshot.find_cep(cep)
+        return _project(r, projection)
+
+    def get_range(self, start, end, after=None, limit=None):
+        # o snapshot nao tem registros "not found"; os CEPs consultados
+        # depois do export (overlay) ficam de fora
+        if after is not None and after >= start:
+            start = after
+        s = self._snapshot
+        count = 0
+        for cep, entry in s.iter_ceps(start):
+            if cep > end or (limit and count >= limit):
+                return
+            if cep == after:
+                continue
+            count += 1
+            yield s.value(entry[1], entry[2])
+
+    def get_one_uf(self, sigla, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        s = self._snapshot
+        return _project(s.find_key(s.ufs, s.n_ufs, sigla), projection)
+
+    def get_one_cidade(self, sigla_uf, nome_cidade, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        s = self._snapshot
+        for key in _cidade_keys(sigla_uf, nome_cidade):
+            r = s.find_key(s.cidades, s.n_cidades, key)
+            if r is not None:
+                return _project(r, projection)
+        return None
+
+    def get_all_ufs(self):
+        s = self._snapshot
+        return s.iter_table(s.ufs, s.n_ufs)
+
+    def get_all_cidades(self):
+        s = self._snapshot
+        return s.iter_table(s.cidades, s.n_cidades)
+
+    def get_ibge_updated_at(self):
+        return self._snapshot.created_at
+
+    def insert_or_update(self, obj, **kwargs):
+        projection = kwargs.get('fields', kwargs.get('projection'))
+        expiration = expires_at(obj)
+        if expiration:
+            ttl = (expiration - datetime.now()).total_seconds()
+            self._snapshot.overlay.set(obj['cep'], obj, ttl)
+        return _project(dict(obj), projection)
+
+    def remove(self, cep):
+        self._snapshot.overlay.delete(cep)
+
+
+def _standalone(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Exporta ceps, ufs e cidades para um snapshot")
+    parser.add_argument('path')
+    args = parser.parse_args(argv)
+
+    result = export(Database(), args.path)
+    print("Snapshot gravado em {}: {} ceps, {} ufs, {} cidades".format(
+        args.path, result['ceps'], result['ufs'], result['cidades']))
+
+
+if __name__ == "__main__":
+    _standalone()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+import mock
+
+from cache import LRUCache, MISSING
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache(maxsize=2, ttl=60)
+
+    def test_miss(self):
+        self.assertIs(MISSING, self.cache.get('a'))
+        self.assertEqual(1, self.cache.stats()['misses'])
+
+    def test_hit_returns_copy(self):
+        self.cache.set('a', {'cep': 'a'})
+        value = self.cache.get('a')
+        value['cep'] = 'b'
+        self.assertEqual({'cep': 'a'}, self.cache.get('a'))
+        self.assertEqual(2, self.cache.stats()['hits'])
+
+    def test_cache_none(self):
+        self.cache.set('a', None)
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertIs(MISSING, self.cache.get('b'))
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    @mock.patch('cache.time.time')
+    def test_ttl(self, _time):
+        _time.return_value = 1000
+        self.cache.set('a', 1, ttl=10)
+        _time.return_value = 1009
+        self.assertEqual(1, self.cache.get('a'))
+        _time.return_value = 1010
+        self.assertIs(MISSING, self.cache.get('a'))
+        self.assertEqual(1, self.cache.stats()['expirations'])
+
+    def test_disabled(self):
+        cache = LRUCache(maxsize=0, ttl=60)
+        cache.set('a', 1)
+        self.assertIs(MISSING, cache.get('a'))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from CepImporter import CepImporter, iter_rows, normalize
+from CepTracker import CepTracker
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def test_same_record_as_tracker(self):
+        viacep = {
+            'cep': '01330-000',
+            'logradouro': u'Rua Rui Barbosa',
+            'complemento': u'até 350',
+            'bairro': u'Bela Vista',
+            'localidade': u'São Paulo',
+            'uf': 'SP',
+        }
+        row = {
+            'CEP': '01330000',
+            'Logradouro': u'Rua Rui Barbosa',
+            'Complemento': u'até 350',
+            'Bairro': u'Bela Vista',
+            'Cidade': u'São Paulo',
+            'Estado': 'sp',
+        }
+        tracker = CepTracker()
+        with mock.patch.object(tracker, '_request', return_value=viacep):
+            expected = tracker.track('01330000')[0]
+
+        record = normalize(row, now=expected['_meta']['v_date'])
+        self.assertEqual(expected, record)
+
+    def test_missing_leading_zero(self):
+        record = normalize({'cep': 1330000, 'bairro': u'Bela Vista',
+                            'cidade': u'São Paulo', 'uf': 'SP'})
+        self.assertEqual('01330000', record['cep'])
+        self.assertNotIn('complemento', record)
+
+    def test_invalid_rows(self):
+        self.assertIsNone(normalize({'cep': '', 'cidade': u'São Paulo'}))
+        self.assertIsNone(normalize({'cep': '123456789'}))
+        # sem bairro o tracker gravaria como nao encontrado
+        self.assertIsNone(normalize({'cep': '65930000',
+                                     'cidade': u'Açailândia'}))
+
+
+class IterRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.dir, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'wb') as f:
+            f.write(content.encode('utf-8'))
+        return path
+
+    def test_csv(self):
+        path = self._write('ceps.csv', u'cep;bairro;cidade\n'
+                                       u'01330000;Bela Vista;São Paulo\n')
+        rows = list(iter_rows(path, delimiter=';'))
+        self.assertEqual([{'cep': u'01330000', 'bairro': u'Bela Vista',
+                           'cidade': u'São Paulo'}], rows)
+
+    def test_jsonl_gz(self):
+        lines = [{'cep': '01330000', 'cidade': u'São Paulo'},
+                 {'cep': '65930000'}]
+        content = u'\n'.join(json.dumps(line) for line in lines) + u'\n\n'
+        path = self._write('ceps.jsonl.gz', content)
+        self.assertEqual(lines, list(iter_rows(path)))
+
+    def test_jsonl_invalid_line(self):
+        content = u'{"cep": "01330000"}\n{"cep": \n{"cep": "65930000"}\n'
+        path = self._write('ceps.jsonl', content)
+        self.assertEqual([{'cep': '01330000'}, None, {'cep': '65930000'}],
+                         list(iter_rows(path)))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            list(iter_rows(self._write('ceps.txt', u'')))
+        # array JSON nao e lido como JSON lines
+        with self.assertRaises(ValueError):
+            list(iter_rows(self._write('ceps.json', u'[]')))
+
+
+class CepImporterTest(unittest.TestCase):
+
+    rows = [
+        {'cep': '01330000', 'bairro': u'Bela Vista', 'cidade': u'São Paulo',
+         'uf': 'SP'},
+        {'cep': '65930000', 'cidade': u'Açailândia', 'uf': 'MA'},
+        {'cep': '20040002', 'bairro': u'Centro', 'cidade': 'Rio de Janeiro',
+         'uf': 'RJ'},
+        {'cep': '30130010', 'bairro': u'Centro', 'cidade': 'Belo Horizonte',
+         'uf': 'MG'},
+    ]
+
+    def setUp(self):
+        self.db = mock.Mock()
+        self.db.bulk_insert_or_update.side_effect = lambda objs: {
+            'inserted': len(objs), 'modified': 0, 'unchanged': 0}
+
+    def test_run(self):
+        importer = CepImporter(self.db, batch_size=2, workers=2)
+        report = importer.run(iter(self.rows))
+
+        self.assertEqual(4, report['read'])
+        self.assertEqual(1, report['skipped'])
+        self.assertEqual(3, report['written'])
+        self.assertEqual(3, report['inserted'])
+        self.assertEqual(0, report['failed'])
+        self.assertIn('rate', report)
+
+        ceps = sorted(obj['cep']
+                      for call in self.db.bulk_insert_or_update.call_args_list
+                      for obj in call[0][0])
+        self.assertEqual(['01330000', '20040002', '30130010'], ceps)
+        self.assertEqual(2, self.db.bulk_insert_or_update.call_count)
+
+    def test_invalid_rows(self):
+        importer = CepImporter(self.db, batch_size=2, workers=2)
+        report = importer.run(iter([self.rows[0], None]))
+        self.assertEqual(2, report['read'])
+        self.assertEqual(1, report['skipped'])
+        self.assertEqual(1, report['written'])
+
+    def test_v_date_spread(self):
+        spread = timedelta(days=30)
+        importer = CepImporter(self.db, batch_size=10, spread=spread)
+        start = datetime.now()
+        importer.run(iter(self.rows * 5))
+
+        v_dates = [obj['_meta']['v_date']
+                   for call in self.db.bulk_insert_or_update.call_args_list
+                   for obj in call[0][0]]
+        self.assertEqual(15, len(v_dates))
+        self.assertGreater(len(set(v_dates)), 1)
+        for v_date in v_dates:
+            self.assertLessEqual(v_date, datetime.now())
+            self.assertGreaterEqual(v_date, start - spread)
+
+    def test_failed_batch(self):
+        self.db.bulk_insert_or_update.side_effect = Exception('mongo')
+        importer = CepImporter(self.db, batch_size=2, workers=2)
+        report = importer.run(iter(self.rows))
+
+        self.assertEqual(0, report['written'])
+        self.assertEqual(3, report['failed'])
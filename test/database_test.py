@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from datetime import datetime
 import unittest
 
+import mock
+
+import database
 from database import MongoDB
 
 
@@ -37,6 +41,50 @@ class MongoDbTest(unittest.TestCase):
         self.assertNotIn('bairro', result)
         self.assertNotIn('cidade', result)
 
+    def test_cache_invalidated_on_update(self):
+        self.db.insert_or_update({
+            'cep': 'UNIQUE_KEY',
+            'estado': 'A',
+            '_meta': {'v_date': datetime.now()},
+        })
+        self.assertEqual('A', self.db.get_one('UNIQUE_KEY')['estado'])
+
+        self.db.insert_or_update({
+            'cep': 'UNIQUE_KEY',
+            'estado': 'B',
+            '_meta': {'v_date': datetime.now()},
+        })
+        self.assertEqual('B', self.db.get_one('UNIQUE_KEY')['estado'])
+
+    def test_cache_projection(self):
+        self.db.insert_or_update({
+            'cep': 'UNIQUE_KEY',
+            'estado': 'A',
+            '_meta': {'v_date': datetime.now()},
+        })
+        self.db.get_one('UNIQUE_KEY')
+        result = self.db.get_one('UNIQUE_KEY', fields={'_id': False})
+        self.assertNotIn('_id', result)
+        self.assertEqual('A', result['estado'])
+
+    def test_bulk_insert_or_update(self):
+        self.db.get_one('UNIQUE_KEY')
+        result = self.db.bulk_insert_or_update([{
+            'cep': 'UNIQUE_KEY',
+            'estado': 'B',
+        }, {
+            'cep': 'UNIQUE_KEY_2',
+            'bairro': 'C',
+        }])
+        self.addCleanup(self.db.remove, 'UNIQUE_KEY_2')
+
+        self.assertEqual(1, result['inserted'])
+        self.assertEqual(1, result['modified'])
+        updated = self.db.get_one('UNIQUE_KEY')
+        self.assertEqual('B', updated['estado'])
+        self.assertNotIn('logradouro', updated)
+        self.assertEqual('C', self.db.get_one('UNIQUE_KEY_2')['bairro'])
+
     def tearDown(self):
         self.db.remove('UNIQUE_KEY')
 
@@ -101,3 +149,61 @@ class CidadeTest(unittest.TestCase):
 
         result = self.db.get_one_cidade(u'SP', u'São Paulo')
         self.assertEqual('2000', result['area_km2'])
+
+
+class ClientTest(unittest.TestCase):
+
+    def test_shared_client(self):
+        self.assertIs(MongoDB()._client, MongoDB()._client)
+
+    def test_new_client_after_fork(self):
+        client = database.get_client()
+        with mock.patch('database.os.getpid') as _getpid:
+            _getpid.return_value = -1
+            self.assertIsNot(client, database.get_client())
+            self.assertEqual(-1, database.pool_stats()['pid'])
+        database.get_client()
+
+    def test_pool_stats(self):
+        MongoDB().get_one('UNIQUE_KEY')
+        stats = database.pool_stats()
+        self.assertTrue(stats['connected'])
+        self.assertIn('max_pool_size', stats)
+        self.assertIn('connections_in_use', stats)
+
+    def test_pool_stats_from_client(self):
+        database.get_client()
+        expected = database.pool_stats()['max_pool_size']
+        # opcoes alteradas depois de criado o cliente nao valem para ele
+        with mock.patch.dict('os.environ', {
+                'POSTMON_DB_MAX_POOL_SIZE': str(expected + 1),
+                'POSTMON_DB_READ_PREFERENCE': 'nearest'}):
+            stats = database.pool_stats()
+        self.assertEqual(expected, stats['max_pool_size'])
+        self.assertNotEqual('nearest', stats['read_preference'])
+
+
+class LockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MongoDB()
+
+    def tearDown(self):
+        self.db._db.locks.delete_many({})
+
+    def test_lock(self):
+        token = self.db.acquire_lock('test', ttl=30)
+        self.assertTrue(token)
+        self.assertTrue(self.db.is_locked('test'))
+        self.assertIsNone(self.db.acquire_lock('test', ttl=30))
+
+        self.db.release_lock('test', 'other')
+        self.assertTrue(self.db.is_locked('test'))
+        self.db.release_lock('test', token)
+        self.assertFalse(self.db.is_locked('test'))
+        self.assertTrue(self.db.acquire_lock('test', ttl=30))
+
+    def test_expired_lock(self):
+        self.db.acquire_lock('test', ttl=-1)
+        self.assertFalse(self.db.is_locked('test'))
+        self.assertTrue(self.db.acquire_lock('test', ttl=30))
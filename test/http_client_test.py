@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+import mock
+
+import http_client
+
+
+class HttpClientTest(unittest.TestCase):
+
+    def test_shared_session(self):
+        self.assertIs(http_client.get_session(), http_client.get_session())
+
+    def test_session_without_retry(self):
+        session = http_client.get_session(retry=False)
+        self.assertIsNot(http_client.get_session(), session)
+        adapter = session.get_adapter('https://viacep.com.br')
+        self.assertEqual(0, adapter.max_retries.total)
+
+    def test_new_session_after_fork(self):
+        session = http_client.get_session()
+        with mock.patch('http_client.os.getpid') as _getpid:
+            _getpid.return_value = -1
+            self.assertIsNot(session, http_client.get_session())
+
+    @mock.patch('http_client.get_session')
+    def test_default_timeout(self, _session):
+        http_client.get('http://example.com')
+        _session.return_value.request.assert_called_with(
+            'GET', 'http://example.com', timeout=http_client.DEFAULT_TIMEOUT)
+
+    @mock.patch('http_client.get_session')
+    def test_post(self, _session):
+        http_client.post('http://example.com', data='x', timeout=1)
+        _session.assert_called_with(True)
+        _session.return_value.request.assert_called_with(
+            'POST', 'http://example.com', data='x', timeout=1)
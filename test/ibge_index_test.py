@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+import mock
+
+from cache import MISSING
+from IbgeIndex import IbgeIndex
+
+
+class IbgeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mock.Mock()
+        self.db.get_ibge_updated_at.return_value = 1
+        self.db.get_all_ufs.side_effect = lambda: [{
+            '_id': 'x',
+            'sigla': 'SP',
+            'nome': u'São Paulo',
+        }]
+        self.db.get_all_cidades.side_effect = lambda: [{
+            '_id': 'y',
+            'sigla_uf': 'SP',
+            'nome': u'São Paulo',
+            'sigla_uf_nome_cidade': u'SP_SAO PAULO',
+            'area_km2': '1099',
+        }, {
+            'sigla_uf': 'SP',
+            'nome': u'Embu (Embu das Artes)',
+            'sigla_uf_nome_cidade': u'SP_EMBU EMBU DAS ARTES',
+            'area_km2': '70',
+        }]
+        self.index = IbgeIndex(check_interval=0)
+        self.index.load(self.db)
+
+    def test_get_uf(self):
+        result = self.index.get_uf('SP', fields={'_id': False,
+                                                 'sigla': False})
+        self.assertEqual({'nome': u'São Paulo'}, result)
+        self.assertIs(MISSING, self.index.get_uf('XX'))
+
+    def test_get_cidade(self):
+        result = self.index.get_cidade('SP', u'São Paulo')
+        self.assertEqual('1099', result['area_km2'])
+        self.assertNotIn('_id', result)
+
+    def test_get_cidade_alt(self):
+        result = self.index.get_cidade('SP', u'Outro lugar (São Paulo)')
+        self.assertEqual('1099', result['area_km2'])
+
+    def test_get_cidade_alias(self):
+        result = self.index.get_cidade('SP', u'Embu das Artes')
+        self.assertEqual('70', result['area_km2'])
+
+    def test_get_cidade_missing(self):
+        self.assertIs(MISSING, self.index.get_cidade('SP', u'Xyz'))
+
+    def test_result_is_copy(self):
+        self.index.get_uf('SP')['nome'] = 'X'
+        self.assertEqual(u'São Paulo', self.index.get_uf('SP')['nome'])
+
+    @mock.patch('IbgeIndex.threading.Thread')
+    def test_refresh(self, _thread):
+        _thread.side_effect = lambda target, args: mock.Mock(
+            start=lambda: target(*args))
+
+        self.index.refresh(self.db)
+        self.assertEqual(1, self.db.get_all_ufs.call_count)
+
+        self.db.get_ibge_updated_at.return_value = 2
+        self.db.get_all_ufs.side_effect = lambda: [{'sigla': 'RJ'}]
+        self.index.refresh(self.db)
+        self.assertIs(MISSING, self.index.get_uf('SP'))
+        self.assertEqual({'sigla': 'RJ'}, self.index.get_uf('RJ'))
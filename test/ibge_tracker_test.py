@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+import mock
+
+from database import MongoDB
+from IbgeTracker import IbgeTracker, _iter_json_items
+
+
+class IbgeTrackerTest(unittest.TestCase):
+
+    ufs = [{
+        'sigla': 'SP',
+        'codigo_ibge': '35',
+        'nome': u'São Paulo',
+    }, {
+        'sigla': 'RJ',
+        'codigo_ibge': '33',
+        'nome': u'Rio de Janeiro',
+    }]
+
+    cidades = [{
+        'codigo_ibge_uf': '35',
+        'sigla_uf': 'SP',
+        'nome': u'São Paulo',
+        'area_km2': '1099',
+    }, {
+        'codigo_ibge_uf': '35',
+        'sigla_uf': 'SP',
+        'nome': u'Araraquara',
+        'area_km2': '1003',
+    }, {
+        'codigo_ibge_uf': '33',
+        'sigla_uf': 'RJ',
+        'nome': u'Macaé',
+        'area_km2': '1216',
+    }]
+
+    def setUp(self):
+        self.db = MongoDB()
+        self.tracker = IbgeTracker(batch_size=2)
+        self.tracker._get_info_ufs = lambda siglas: [
+            dict(uf) for uf in self.ufs]
+        self.tracker._get_info_cidades = lambda: [
+            dict(cidade) for cidade in self.cidades]
+
+    def tearDown(self):
+        self.db._db.ufs.delete_many({})
+        self.db._db.cidades.delete_many({})
+        self.db._db.meta.delete_many({})
+
+    def test_track(self):
+        report = self.tracker.track(self.db)
+        self.assertEqual({'inserted': 2, 'modified': 0, 'unchanged': 0},
+                         report['ufs'])
+        self.assertEqual({'inserted': 3, 'modified': 0, 'unchanged': 0},
+                         report['cidades'])
+        self.assertIn('elapsed', report)
+
+        result = self.db.get_one_cidade('RJ', u'Macaé')
+        self.assertEqual('1216', result['area_km2'])
+        self.assertEqual('RJ_MACAE', result['sigla_uf_nome_cidade'])
+        self.assertTrue(self.db.get_ibge_updated_at())
+
+    def test_track_unchanged(self):
+        self.tracker.track(self.db)
+        with mock.patch.object(self.db, 'mark_ibge_updated') as _mark:
+            report = self.tracker.track(self.db)
+        self.assertEqual({'inserted': 0, 'modified': 0, 'unchanged': 3},
+                         report['cidades'])
+        self.assertFalse(_mark.called)
+
+    def test_track_modified(self):
+        self.tracker.track(self.db)
+        self.cidades = list(self.cidades)
+        self.cidades[0] = dict(self.cidades[0], area_km2='2000')
+        report = self.tracker.track(self.db)
+        self.assertEqual({'inserted': 0, 'modified': 1, 'unchanged': 2},
+                         report['cidades'])
+        result = self.db.get_one_cidade('SP', u'São Paulo')
+        self.assertEqual('2000', result['area_km2'])
+
+    def test_update_outside_bulk(self):
+        self.tracker.track(self.db)
+        self.db.insert_or_update_uf({'sigla': 'SP', 'codigo_ibge': '99'})
+        report = self.tracker.track(self.db)
+        self.assertEqual(1, report['ufs']['modified'])
+        self.assertEqual('35', self.db.get_one_uf('SP')['codigo_ibge'])
+
+
+class IbgeStreamTest(unittest.TestCase):
+
+    def _chunks(self, data, size):
+        data = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_iter_json_items(self):
+        data = [{'nome': u'Macaé', 'n': i} for i in range(50)]
+        data += [None, 123, u'São', [1, 2]]
+        for size in (1, 3, 7, 1000):
+            items = list(_iter_json_items(self._chunks(data, size)))
+            self.assertEqual(data, items)
+
+    def test_empty_array(self):
+        self.assertEqual([], list(_iter_json_items([b' [ ', b'] '])))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, list, _iter_json_items([b'{}']))
+        self.assertRaises(ValueError, list, _iter_json_items([b'[{"a": 1']))
+
+    def test_lazy(self):
+        chunks = iter([b'[{"a": 1},', b'{"a": 2}]'])
+        items = _iter_json_items(chunks)
+        self.assertEqual({'a': 1}, next(items))
+        self.assertEqual(b'{"a": 2}]', next(chunks))
+
+
+class IbgeLocalSourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MongoDB()
+
+    def tearDown(self):
+        self.db._db.ufs.delete_many({})
+        self.db._db.cidades.delete_many({})
+        self.db._db.meta.delete_many({})
+
+    def test_track_local_source(self):
+        tracker = IbgeTracker(source='test/assets/ibge')
+        report = tracker.track(self.db)
+        self.assertEqual(2, report['ufs']['inserted'])
+        self.assertEqual(3, report['cidades']['inserted'])
+        result = self.db.get_one_cidade('RJ', u'Macaé')
+        self.assertEqual('3302403', result['codigo_ibge'])
+
+    @mock.patch('IbgeTracker.http_client.get')
+    def test_stream_url(self, _get):
+        _get.return_value.iter_content.return_value = [
+            b'[{"sigla": "SP"}', b', {"sigla": "RJ"}]']
+        tracker = IbgeTracker(source='https://example.com/ibge/')
+        items = list(tracker._get_info_ufs({}))
+        self.assertEqual([{'sigla': 'SP'}, {'sigla': 'RJ'}], items)
+        _get.assert_called_with('https://example.com/ibge/ufs.json',
+                                stream=True)
+        self.assertTrue(_get.return_value.close.called)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+import mock
+
+import indexes
+from database import MongoDB
+
+
+class EnsureIndexesTest(unittest.TestCase):
+
+    def setUp(self):
+        client = MongoDB()._client
+        self.db = client['postmon_indexes_test']
+        self.addCleanup(client.drop_database, 'postmon_indexes_test')
+
+    def _index(self, collection, keys):
+        existing = self.db[collection].index_information()
+        return indexes._find(existing, keys)[1]
+
+    def test_create(self):
+        indexes.ensure_indexes(self.db)
+        self.assertTrue(self._index('ceps', [('cep', 1)])['unique'])
+        self.assertTrue(self._index(
+            'packtrack', [('servico', 1), ('codigo', 1)])['unique'])
+        self.assertEqual(0, self._index(
+            'locks', [('expires_at', 1)])['expireAfterSeconds'])
+
+    def test_rebuild(self):
+        self.db.ceps.create_index('cep')
+
+        indexes.ensure_indexes(self.db)
+        self.assertNotIn('unique', self._index('ceps', [('cep', 1)]))
+
+        indexes.ensure_indexes(self.db, rebuild=True)
+        self.assertTrue(self._index('ceps', [('cep', 1)])['unique'])
+
+
+class CheckIndexesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collections = {}
+        self.db = mock.MagicMock()
+        self.db.__getitem__.side_effect = self._collection
+
+    def _collection(self, name):
+        if name not in self.collections:
+            collection = self.collections[name] = mock.Mock()
+            collection.name = name
+            collection.index_information.return_value = dict(
+                ('index_%d' % i, dict(options, key=keys))
+                for i, (keys, options) in enumerate(indexes.INDEXES[name]))
+            explain = collection.find.return_value.explain
+            explain.return_value = {'queryPlanner': {'winningPlan': {
+                'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}}}
+        return self.collections[name]
+
+    def test_ok(self):
+        self.assertEqual([], indexes.check_indexes(self.db))
+
+    def test_missing(self):
+        self._collection('ufs').index_information.return_value = {}
+        problems = indexes.check_indexes(self.db)
+        self.assertEqual([u'indice ausente: ufs(sigla: 1)',
+                          u'indice ausente: ufs(nome: 1)'], problems)
+
+    def test_options(self):
+        self._collection('ceps').index_information.return_value = {
+            'cep_1': {'key': [('cep', 1.0)]},
+        }
+        problems = indexes.check_indexes(self.db)
+        self.assertIn('ceps(cep: 1) com opcoes diferentes', problems[0])
+        self.assertIn('indice ausente: ceps(_meta.v_date: 1)', problems[1])
+
+    def test_collscan(self):
+        cursor = self._collection('cidades').find.return_value
+        cursor.explain.return_value = {'queryPlanner': {'winningPlan': {
+            'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}}}
+        problems = indexes.check_indexes(self.db)
+        self.assertEqual(2, len(problems))
+        self.assertIn('COLLSCAN em cidades', problems[0])
+        self.assertIn('SORT em cidades', problems[1])
+
+    def test_slot_based_plan(self):
+        cursor = self._collection('cidades').find.return_value
+        cursor.explain.return_value = {'queryPlanner': {'winningPlan': {
+            'queryPlan': {'stage': 'SORT',
+                          'inputStage': {'stage': 'COLLSCAN'}},
+            'slotBasedPlan': {'slots': '', 'stages': ''}}}}
+        problems = indexes.check_indexes(self.db)
+        self.assertEqual(2, len(problems))
+        self.assertIn('COLLSCAN em cidades', problems[0])
+        self.assertIn('SORT em cidades', problems[1])
+
+    def test_unknown_plan(self):
+        cursor = self._collection('cidades').find.return_value
+        cursor.explain.return_value = {'queryPlanner': {'winningPlan': {
+            'slotBasedPlan': {}}}}
+        problems = indexes.check_indexes(self.db)
+        self.assertEqual(1, len(problems))
+        self.assertIn('nao foi possivel analisar cidades', problems[0])
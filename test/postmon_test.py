@@ -3,19 +3,22 @@
 from datetime import datetime, timedelta
 import json
 import re
+import time
 import unittest
 import mock
 
 import webtest
 import bottle
-from bson.objectid import ObjectId
 from packtrack import correios
+import requests
 from requests import RequestException
 
 import CepTracker
+import database
 import PackTracker
+import PostmonServer
 from PostmonServer import expired, jsonp_query_key
-from database import MongoDb
+from database import Database
 
 bottle.DEBUG = True
 
@@ -122,6 +125,141 @@ class CepTrackerMockTest(CepTrackerTest):
             return json.load(f)
 
 
+class CepTrackerStrategyTest(unittest.TestCase):
+
+    def _provider(self, name, delay=0, error=None):
+        def request(cep):
+            self.called.append(name)
+            time.sleep(delay)
+            if error:
+                raise error
+            return {'provider': name}
+        return (name, request)
+
+    def setUp(self):
+        CepTracker._provider_stats.clear()
+
+    def _tracker(self, strategy, *providers):
+        self.called = []
+        tracker = CepTracker.CepTracker(strategy=strategy, hedge_delay=0.05)
+        tracker._providers = lambda: list(providers)
+        return tracker
+
+    def test_sequential_fallback(self):
+        tracker = self._tracker(
+            'sequential',
+            self._provider('A', error=RequestException()),
+            self._provider('B'))
+        self.assertEqual({'provider': 'B'}, tracker._request('01330000'))
+        self.assertEqual(['A', 'B'], self.called)
+
+    def test_sequential_all_fail(self):
+        tracker = self._tracker(
+            'sequential',
+            self._provider('A', error=RequestException()),
+            self._provider('B', error=ValueError()))
+        self.assertRaises(ValueError, tracker._request, '01330000')
+
+    def test_hedged_fast_first(self):
+        tracker = self._tracker(
+            'hedged', self._provider('A'), self._provider('B'))
+        self.assertEqual({'provider': 'A'}, tracker._request('01330000'))
+        self.assertEqual(['A'], self.called)
+
+    def test_hedged_slow_first(self):
+        tracker = self._tracker(
+            'hedged', self._provider('A', delay=1), self._provider('B'))
+        self.assertEqual({'provider': 'B'}, tracker._request('01330000'))
+        self.assertEqual(['A', 'B'], self.called)
+
+    def test_race(self):
+        tracker = self._tracker(
+            'race',
+            self._provider('A', delay=1),
+            self._provider('B', delay=0.01),
+            self._provider('C', error=RequestException()))
+        start = time.time()
+        self.assertEqual({'provider': 'B'}, tracker._request('01330000'))
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_race_all_fail(self):
+        tracker = self._tracker(
+            'race',
+            self._provider('A', error=RequestException()),
+            self._provider('B', error=RequestException()))
+        self.assertRaises(RequestException, tracker._request, '01330000')
+
+    def test_invalid_strategy(self):
+        self.assertRaises(ValueError, CepTracker.CepTracker, 'xxx')
+
+    def test_latency_recorded(self):
+        tracker = self._tracker('sequential', self._provider('Stats'))
+        tracker._request('01330000')
+        stats = CepTracker.provider_stats()['Stats']
+        self.assertEqual(1, stats['requests'])
+        self.assertIsNotNone(stats['p99'])
+
+
+class CepTrackerHealthTest(CepTrackerStrategyTest):
+
+    def _fail(self, tracker, times):
+        for _ in range(times):
+            try:
+                tracker._request('01330000')
+            except Exception:
+                pass
+
+    def test_circuit_opens(self):
+        tracker = self._tracker(
+            'sequential',
+            self._provider('A', error=RequestException()),
+            self._provider('B', error=RequestException()))
+        self._fail(tracker, 5)
+        self.assertEqual('open', CepTracker.provider_stats()['A']['circuit'])
+
+        self.called = []
+        self.assertRaises(CepTracker.CircuitOpenError,
+                          tracker._request, '01330000')
+        self.assertEqual([], self.called)
+
+    def test_circuit_half_open(self):
+        tracker = self._tracker(
+            'sequential', self._provider('A', error=RequestException()))
+        breaker = CepTracker._get_provider_stats('A').breaker
+        breaker.reset_timeout = 0.01
+        self._fail(tracker, 5)
+        self.assertEqual('open', breaker.state)
+
+        time.sleep(0.02)
+        tracker._providers = lambda: [self._provider('A')]
+        self.assertEqual({'provider': 'A'}, tracker._request('01330000'))
+        self.assertEqual('closed', breaker.state)
+
+    def test_http_4xx_is_not_failure(self):
+        response = mock.Mock(status_code=404)
+        error = requests.exceptions.HTTPError(response=response)
+        tracker = self._tracker(
+            'sequential', self._provider('A', error=error))
+        self._fail(tracker, 10)
+        self.assertEqual('closed', CepTracker.provider_stats()['A']['circuit'])
+
+    def test_adaptive_order(self):
+        tracker = self._tracker(
+            'sequential',
+            self._provider('A', delay=0.05),
+            self._provider('B'))
+        tracker._request('01330000')
+        tracker._providers = lambda: [self._provider('B'),
+                                      self._provider('A', delay=0.05)]
+        tracker._request('01330000')
+
+        tracker._providers = lambda: [self._provider('A', delay=0.05),
+                                      self._provider('B')]
+        self.called = []
+        self.assertEqual({'provider': 'B'}, tracker._request('01330000'))
+        self.assertEqual(['B'], self.called)
+
+
 class PostmonWebTest(unittest.TestCase, PostmonBaseTest):
 
     '''
@@ -180,7 +318,7 @@ class PostmonV1WebTest(PostmonWebTest):
     '''
     @classmethod
     def setUpClass(cls):
-        cls.db = MongoDb()
+        cls.db = Database()
         cls.db.insert_or_update_uf({
             'sigla': 'SP',
             'campo': 'valor',
@@ -192,8 +330,8 @@ class PostmonV1WebTest(PostmonWebTest):
 
     @classmethod
     def tearDownClass(cls):
-        cls.db._db.cidades.remove()
-        cls.db._db.ufs.remove()
+        cls.db.remove_cidade(u'SP_SAO PAULO')
+        cls.db.remove_uf('SP')
 
     def setUp(self):
         super(PostmonV1WebTest, self).setUp()
@@ -346,6 +484,264 @@ class PostmonV1Errors(PostmonErrors):
                                                     expect_errors, use_v1)
 
 
+class PostmonSingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Database()
+        self.token = None
+
+    def tearDown(self):
+        self.db.remove('01330000')
+        self.db.release_lock('cep:01330000', self.token)
+
+    @mock.patch('PostmonServer.SINGLEFLIGHT_MONGO', True)
+    @mock.patch('PostmonServer._get_info_from_source')
+    def test_wait_other_process(self, _mock):
+        self.token = self.db.acquire_lock('cep:01330000', ttl=30)
+        self.db.insert_or_update({
+            'cep': '01330000',
+            'cidade': u'São Paulo',
+            'estado': 'SP',
+            '_meta': {'v_date': datetime.now()},
+        })
+        result = PostmonServer._refresh_cep(self.db, '01330000')
+        self.assertEqual('SP', result['estado'])
+        self.assertFalse(_mock.called)
+
+    @mock.patch('PostmonServer.SINGLEFLIGHT_MONGO', True)
+    @mock.patch('PostmonServer._get_info_from_source')
+    def test_lock_released(self, _mock):
+        _mock.return_value = [{
+            'cep': '01330000',
+            'cidade': u'São Paulo',
+            'estado': 'SP',
+            '_meta': {'v_date': datetime.now()},
+        }]
+        result = PostmonServer._refresh_cep(self.db, '01330000')
+        self.assertEqual('SP', result['estado'])
+        self.assertFalse(self.db.is_locked('cep:01330000'))
+
+
+class PostmonStaleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = webtest.TestApp(bottle.app())
+        self.db = Database()
+        self.db.insert_or_update({
+            'cep': '01330000',
+            'bairro': 'Antigo',
+            'cidade': u'São Paulo',
+            'estado': 'SP',
+            '_meta': {'v_date': datetime.now() - timedelta(weeks=27)},
+        })
+
+    def tearDown(self):
+        self.db.remove('01330000')
+
+    def _source(self, cep):
+        return [{
+            'cep': cep,
+            'bairro': 'Novo',
+            'cidade': u'São Paulo',
+            'estado': 'SP',
+            '_meta': {'v_date': datetime.now()},
+        }]
+
+    def _wait_revalidation(self):
+        for _ in range(100):
+            if not PostmonServer._revalidating:
+                return
+            time.sleep(0.01)
+
+    @mock.patch('PostmonServer.STALE_GRACE', timedelta(weeks=4))
+    @mock.patch('PostmonServer._get_info_from_source')
+    def test_serve_stale(self, _mock):
+        _mock.side_effect = self._source
+        response = self.app.get('/v1/cep/01330000')
+        self.assertEqual('Antigo', response.json['bairro'])
+        self.assertEqual('public, max-age=0, stale-while-revalidate=60',
+                         response.headers['Cache-Control'])
+
+        self._wait_revalidation()
+        _mock.assert_called_once_with('01330000')
+        response = self.app.get('/v1/cep/01330000')
+        self.assertEqual('Novo', response.json['bairro'])
+        self.assertEqual('public, max-age=2592000',
+                         response.headers['Cache-Control'])
+
+    @mock.patch('PostmonServer.STALE_GRACE', timedelta(weeks=4))
+    @mock.patch('CepTracker.CepTracker._request')
+    def test_stale_kept_on_source_error(self, _mock):
+        _mock.side_effect = IOError('fonte fora do ar')
+        response = self.app.get('/v1/cep/01330000')
+        self.assertEqual('Antigo', response.json['bairro'])
+
+        self._wait_revalidation()
+        _mock.assert_called_once_with('01330000')
+        response = self.app.get('/v1/cep/01330000')
+        self.assertEqual('Antigo', response.json['bairro'])
+        self.assertEqual('SP', response.json['estado'])
+        self._wait_revalidation()
+
+    @mock.patch('PostmonServer.STALE_GRACE', timedelta(days=1))
+    @mock.patch('PostmonServer._get_info_from_source')
+    def test_beyond_grace(self, _mock):
+        _mock.side_effect = self._source
+        response = self.app.get('/v1/cep/01330000')
+        self.assertEqual('Novo', response.json['bairro'])
+
+    @mock.patch('PostmonServer._get_info_from_source')
+    def test_disabled(self, _mock):
+        _mock.side_effect = self._source
+        response = self.app.get('/v1/cep/01330000')
+        self.assertEqual('Novo', response.json['bairro'])
+
+
+class PostmonBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = webtest.TestApp(bottle.app())
+        self.db = Database()
+        self.db.insert_or_update({
+            'cep': '01330000',
+            'logradouro': 'Rua Rocha',
+            'bairro': 'Bela Vista',
+            'cidade': u'São Paulo',
+            'estado': 'SP',
+            '_meta': {'v_date': datetime.now()},
+        })
+
+    def tearDown(self):
+        self.db.remove('01330000')
+        self.db.remove('12245230')
+
+    def _source(self, cep):
+        if cep != '12245230':
+            return [{'cep': cep, '_meta': {
+                'v_date': datetime.now(),
+                CepTracker._notfound_key: True,
+            }}]
+        return [{
+            'cep': cep,
+            'logradouro': u'Avenida Tivoli',
+            'bairro': u'Vila Betânia',
+            'cidade': u'São José dos Campos',
+            'estado': 'SP',
+            '_meta': {'v_date': datetime.now()},
+        }]
+
+    @mock.patch('PostmonServer._get_info_from_source')
+    def test_post(self, _mock):
+        _mock.side_effect = self._source
+        ceps = ['01330000', '12245230', '99999999', 'XX']
+        response = self.app.post('/v1/cep/batch', json.dumps({'ceps': ceps}),
+                                 headers={'Content-Type': 'application/json'})
+        result = response.json['ceps']
+
+        self.assertEqual(ceps, [r['cep'] for r in result])
+        self.assertEqual('Bela Vista', result[0]['bairro'])
+        self.assertNotIn('_meta', result[0])
+        self.assertEqual(u'Vila Betânia', result[1]['bairro'])
+        self.assertEqual(404, result[2]['status'])
+        self.assertEqual(400, result[3]['status'])
+        # somente os CEPs fora do cache vao para a fonte externa
+        self.assertEqual(['12245230', '99999999'],
+                         sorted(c[0][0] for c in _mock.call_args_list))
+
+    @mock.patch('PostmonServer._get_info_from_source')
+    def test_get(self, _mock):
+        _mock.side_effect = RequestException
+        response = self.app.get('/v1/cep/batch?ceps=01330-000,88888888')
+        result = response.json['ceps']
+        self.assertEqual('01330000', result[0]['cep'])
+        self.assertEqual(503, result[1]['status'])
+
+    def test_xml(self):
+        import xmltodict
+        response = self.app.get('/v1/cep/batch?ceps=01330000&format=xml')
+        result = xmltodict.parse(response.body)['result']['ceps']
+        self.assertEqual('Bela Vista', result['bairro'])
+
+    def test_empty(self):
+        response = self.app.get('/v1/cep/batch', expect_errors=True)
+        self.assertEqual('400 Parametro ceps obrigatorio', response.status)
+
+    def test_invalid_json(self):
+        response = self.app.post('/v1/cep/batch', 'notjson',
+                                 headers={'Content-Type': 'application/json'},
+                                 expect_errors=True)
+        self.assertEqual('400 Parametro ceps obrigatorio', response.status)
+
+    @mock.patch('PostmonServer.BATCH_MAX_CEPS', 1)
+    def test_max_ceps(self):
+        response = self.app.get('/v1/cep/batch?ceps=01330000,12245230',
+                                expect_errors=True)
+        self.assertEqual('400 Maximo de 1 CEPs por consulta',
+                         response.status)
+
+
+class PostmonRangeTest(unittest.TestCase):
+
+    ceps = ['01310100', '01310200', '01330000', '01400000']
+
+    def setUp(self):
+        self.app = webtest.TestApp(bottle.app())
+        self.db = Database()
+        for cep in self.ceps:
+            self.db.insert_or_update({
+                'cep': cep,
+                'bairro': 'Bela Vista',
+                'cidade': u'São Paulo',
+                'estado': 'SP',
+                '_meta': {'v_date': datetime.now()},
+            })
+
+    def tearDown(self):
+        for cep in self.ceps:
+            self.db.remove(cep)
+
+    def test_range(self):
+        response = self.app.get(
+            '/v1/cep/range?inicio=01310000&fim=01339-999')
+        result = response.json
+        self.assertEqual(self.ceps[:3], [r['cep'] for r in result['ceps']])
+        self.assertNotIn('_meta', result['ceps'][0])
+        self.assertIsNone(result['proximo'])
+
+    def test_pagination(self):
+        url = '/v1/cep/range?inicio=01310000&fim=01339999&limite=2'
+        result = self.app.get(url).json
+        self.assertEqual(self.ceps[:2], [r['cep'] for r in result['ceps']])
+        self.assertEqual('01310200', result['proximo'])
+
+        result = self.app.get(url + '&cursor=' + result['proximo']).json
+        self.assertEqual(['01330000'], [r['cep'] for r in result['ceps']])
+        self.assertIsNone(result['proximo'])
+
+    def test_prefix(self):
+        result = self.app.get('/v1/cep/prefix/0131').json
+        self.assertEqual(self.ceps[:2], [r['cep'] for r in result['ceps']])
+
+    @mock.patch('PostmonServer.RANGE_MAX_LIMIT', 1)
+    def test_max_limit(self):
+        result = self.app.get('/v1/cep/prefix/013?limite=100').json
+        self.assertEqual(['01310100'], [r['cep'] for r in result['ceps']])
+        self.assertEqual('01310100', result['proximo'])
+
+    def test_errors(self):
+        urls = [
+            '/v1/cep/range',
+            '/v1/cep/range?inicio=01310000&fim=0131',
+            '/v1/cep/range?inicio=01339999&fim=01310000',
+            '/v1/cep/prefix/013?limite=0',
+            '/v1/cep/prefix/013?cursor=abc',
+            '/v1/cep/prefix/013?format=xml',
+        ]
+        for url in urls:
+            response = self.app.get(url, expect_errors=True)
+            self.assertEqual(400, response.status_int, url)
+
+
 class TestExpired(unittest.TestCase):
 
     def test_empty(self):
@@ -382,9 +778,26 @@ class TestExpired(unittest.TestCase):
         self.assertTrue(expired(obj))
 
 
+class PostmonUpdateFromSourceTest(unittest.TestCase):
+
+    @mock.patch('PostmonServer._get_info_from_source')
+    def test_no_reread(self, _mock):
+        _mock.return_value = [
+            {'cep': '75064590', 'bairro': 'A'},
+            {'cep': '75064590', 'bairro': 'B'},
+        ]
+        db = mock.Mock()
+        db.insert_or_update.side_effect = lambda item, **kwargs: dict(item)
+
+        result = PostmonServer._update_from_source(db, '75064590')
+        self.assertEqual('B', result['bairro'])
+        self.assertEqual(2, db.insert_or_update.call_count)
+        self.assertFalse(db.get_one.called)
+
+
 class TestDatabase(unittest.TestCase):
     def test_insert_notfound(self):
-        db = MongoDb()
+        db = Database()
         cep = u'11111111'
         db.remove(cep)
         db.insert_or_update({
@@ -406,15 +819,83 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(expected, result)
 
 
+class NextCheckTest(unittest.TestCase):
+
+    now = datetime(2020, 1, 10)
+    historico = [{'situacao': 'Postado'}]
+
+    def _next(self, changed_at, changed=False, historico=historico):
+        obj = {'_meta': {'created_at': datetime(2020, 1, 1),
+                         'changed_at': changed_at}}
+        return PackTracker.next_check_at(obj, historico, changed, self.now)
+
+    def test_changed(self):
+        self.assertEqual(self.now + PackTracker.CHECK_MIN_INTERVAL,
+                         self._next(None, changed=True))
+
+    def test_backoff(self):
+        changed_at = self.now - timedelta(hours=6)
+        self.assertEqual(self.now + timedelta(hours=3),
+                         self._next(changed_at))
+        # sem mudancas desde o registro
+        self.assertEqual(self.now + PackTracker.CHECK_MAX_INTERVAL,
+                         self._next(None))
+
+    def test_delivered(self):
+        historico = self.historico + [{'situacao': u'Objeto entregue'}]
+        self.assertIsNone(self._next(None, True, historico))
+
+    def test_not_delivered(self):
+        historico = self.historico + [{
+            'situacao': u'Objeto não entregue - destinatário ausente'}]
+        self.assertFalse(PackTracker.delivered(historico))
+        self.assertIsNotNone(self._next(None, True, historico))
+
+    def test_delivered_not_last(self):
+        historico = [{'situacao': u'Objeto entregue ao destinatário'},
+                     {'situacao': u'Objeto em trânsito - por favor aguarde'}]
+        self.assertFalse(PackTracker.delivered(historico))
+        self.assertIsNotNone(self._next(None, True, historico))
+
+
+class DeltaTest(unittest.TestCase):
+
+    postado = {'situacao': 'Postado'}
+    encaminhado = {'situacao': 'Encaminhado'}
+    entregue = {'situacao': 'Entregue'}
+
+    def test_head(self):
+        self.assertEqual(
+            ([self.entregue], True),
+            PackTracker.delta([self.encaminhado, self.postado],
+                              [self.entregue, self.encaminhado, self.postado]))
+
+    def test_tail(self):
+        historico = [self.postado, self.encaminhado]
+        self.assertEqual(([self.encaminhado], False),
+                         PackTracker.delta([self.postado], historico))
+
+    def test_not_append(self):
+        # evento anterior removido
+        self.assertEqual(
+            ([self.entregue], None),
+            PackTracker.delta([self.encaminhado, self.postado],
+                              [self.entregue, self.postado]))
+        self.assertEqual(([self.postado], None),
+                         PackTracker.delta(None, [self.postado]))
+        self.assertEqual(([], None),
+                         PackTracker.delta([self.postado], [self.postado]))
+
+
 class PackTrackTest(unittest.TestCase):
 
     def setUp(self):
-        db = MongoDb()
-        self.collection = db.packtrack._collection
+        self.db = Database()
         self.app = webtest.TestApp(bottle.app())
+        PostmonServer._tokens_cache.clear()
 
     def tearDown(self):
-        self.collection.remove()
+        self.db.packtrack.remove('ect', 'test')
 
     def _get(self, track, provider='ect', expect_errors=False):
         url = '/v1/rastreio/{}/{}'.format(provider, track)
@@ -448,12 +929,97 @@ class PackTrackTest(unittest.TestCase):
         response = self._get("test")
         self.assertEqual(data[0], response)
 
+    @mock.patch('PackTracker.correios')
+    def test_get_cached(self, _mock):
+        _mock.return_value = [{'situacao': 'Postado'}]
+        self.assertEqual(_mock.return_value, self._get('test')['historico'])
+        self.assertEqual(_mock.return_value, self._get('test')['historico'])
+        self.assertEqual(1, _mock.call_count)
+
+        with mock.patch('PostmonServer.TRACK_MAX_AGE', timedelta(0)):
+            self._get('test')
+        self.assertEqual(2, _mock.call_count)
+
+    @mock.patch('PostmonServer._report_executor')
+    @mock.patch('PackTracker.correios')
+    def test_get_registered(self, _mock, _executor):
+        _mock.return_value = [{'situacao': 'Postado'}]
+        self._post('test', {'callback': 'http://example.com'})
+
+        self.assertEqual(_mock.return_value, self._get('test')['historico'])
+        # a consulta conta como verificacao e avisa os callbacks
+        self.assertTrue(_executor.submit.called)
+        obj = self.db.packtrack.get_one('ect', 'test')
+        self.assertEqual(_mock.return_value, obj['historico'])
+        self.assertEqual([{'callback': 'http://example.com'}],
+                         obj['_meta']['callbacks'])
+        self.assertGreater(obj['_meta']['next_check_at'], datetime.utcnow())
+
     @mock.patch('PackTracker.correios')
     def test_get_404(self, _mock):
-        _mock.side_effect = AttributeError
+        _mock.side_effect = ValueError
         response = self._get("test", expect_errors=True)
         self.assertEqual('404 Pacote test nao encontrado', response.status)
 
+    @mock.patch('PackTracker.packtrack')
+    def test_correios_not_found(self, _mock):
+        # o scraping do packtrack falha com AttributeError
+        _mock.Correios.track.side_effect = AttributeError
+        with self.assertRaises(ValueError):
+            PackTracker.correios('test')
+
+    @mock.patch('PostmonServer.Database')
+    @mock.patch('PackTracker.correios')
+    def test_get_without_packtrack(self, _mock, _database):
+        # backend snapshot: sem armazenamento dos pacotes
+        _database.return_value = mock.Mock(packtrack=None)
+        _mock.return_value = [{'situacao': 'Postado'}]
+        self.assertEqual(_mock.return_value, self._get('test')['historico'])
+        response = self.app.post(
+            '/v1/rastreio/ect/batch', json.dumps(['test']),
+            headers={'Content-Type': 'application/json'})
+        self.assertEqual(_mock.return_value,
+                         response.json['pacotes'][0]['historico'])
+        response = self.app.get('/v1/rastreio/5d2e1e4f8b3c2a0001a1b2c3',
+                                expect_errors=True)
+        self.assertEqual(404, response.status_int)
+
+    def test_get_token(self):
+        callback = {'callback': 'http://example.com', 'myid': 1}
+        token = self._post('test', callback)['token']
+        self.db.packtrack.update('ect', 'test', [{'situacao': 'Postado'}],
+                                 changed=True)
+        deliveries = [{'url': 'http://example.com', 'status': 'pending',
+                       'attempts': 2, 'last_error': 'timeout'}]
+
+        with mock.patch.object(type(self.db.deliveries), 'get_by_token',
+                               return_value=deliveries) as _mock:
+            response = self.app.get('/v1/rastreio/' + token).json
+            self.app.get('/v1/rastreio/' + token)
+        self.assertEqual(1, _mock.call_count)
+
+        self.assertEqual('test', response['codigo'])
+        self.assertEqual([{'situacao': 'Postado'}], response['historico'])
+        self.assertTrue(response['verificado_em'])
+        self.assertEqual([{
+            'callback': 'http://example.com',
+            'status': 'pending',
+            'tentativas': 2,
+            'erro': 'timeout',
+        }], response['callbacks'])
+
+        # um novo registro invalida o cache
+        self._post('test', {'callback': 'http://example.org'})
+        response = self.app.get('/v1/rastreio/' + token).json
+        self.assertEqual([None, None],
+                         [c['status'] for c in response['callbacks']])
+
+    def test_get_token_404(self):
+        response = self.app.get('/v1/rastreio/5d2e1e4f8b3c2a0001a1b2c3',
+                                expect_errors=True)
+        self.assertEqual('404 Token 5d2e1e4f8b3c2a0001a1b2c3 nao encontrado',
+                         response.status)
+
     def test_get_another_provider(self):
         response = self._get("test", provider="google", expect_errors=True)
         self.assertEqual('404 Servico google nao encontrado', response.status)
@@ -479,7 +1045,8 @@ class PackTrackTest(unittest.TestCase):
         response = self._post('test', data[1])
         self.assertEqual(token, response['token'])
 
-        obj = self.collection.find_one(ObjectId(token))
+        obj = self.db.packtrack.get_one('ect', 'test')
+        self.assertEqual(token, obj['token'])
         self.assertEqual(data, obj['_meta']['callbacks'])
 
     def test_register_same_callback(self):
@@ -491,7 +1058,8 @@ class PackTrackTest(unittest.TestCase):
         token = response['token']
         response = self._post('test', data)
 
-        obj = self.collection.find_one(ObjectId(token))
+        obj = self.db.packtrack.get_one('ect', 'test')
+        self.assertEqual(token, obj['token'])
         self.assertEqual([data], obj['_meta']['callbacks'])
 
     @mock.patch('PackTracker.correios')
@@ -528,7 +1096,47 @@ class PackTrackTest(unittest.TestCase):
         changed = PackTracker.run('ect', 'test')
         self.assertFalse(changed)
 
-    @mock.patch('PackTracker.requests.post')
+    @mock.patch('PackTracker.correios')
+    def test_run_loaded(self, _mock):
+        _mock.return_value = [{'situacao': 'Postado'}]
+        self._post('test', {'callback': 'http://example.com'})
+        obj = self.db.packtrack.get_one('ect', 'test')
+
+        db = mock.Mock(wraps=self.db)
+        db.packtrack = mock.Mock(wraps=self.db.packtrack)
+        self.assertTrue(PackTracker.run('ect', 'test', obj=obj, db=db))
+        self.assertFalse(db.packtrack.get_one.called)
+        self.assertEqual(_mock.return_value, obj['historico'])
+        obj = self.db.packtrack.get_one('ect', 'test')
+        self.assertEqual(_mock.return_value, obj['historico'])
+        self.assertGreater(obj['_meta']['next_check_at'], datetime.utcnow())
+
+    @mock.patch('webhooks.http_client.post')
+    @mock.patch('PackTracker.correios')
+    def test_run_events(self, _mock, _mock_requests):
+        postado = {'situacao': 'Postado'}
+        encaminhado = {'situacao': 'Encaminhado'}
+        self._post('test', {'callback': 'http://example.com'})
+
+        _mock.return_value = [postado]
+        self.assertEqual([postado], PackTracker.run('ect', 'test'))
+        self.assertEqual([], PackTracker.run('ect', 'test'))
+
+        _mock.return_value = [encaminhado, postado]
+        events = PackTracker.run('ect', 'test')
+        self.assertEqual([encaminhado], events)
+        obj = self.db.packtrack.get_one('ect', 'test')
+        self.assertEqual([encaminhado, postado], obj['historico'])
+        self.assertEqual(
+            database.history_fingerprint([encaminhado, postado]),
+            obj['_meta']['fingerprint'])
+
+        # os callbacks recebem somente os eventos novos
+        PackTracker.report('ect', 'test', events=events)
+        data = json.loads(_mock_requests.call_args[1]['data'])
+        self.assertEqual([encaminhado], data['historico'])
+
+    @mock.patch('webhooks.http_client.post')
     def test_report(self, _mock_requests):
 
         input_data = {
@@ -565,3 +1173,67 @@ class PackTrackTest(unittest.TestCase):
             u'situacao': status.situacao,
             u'data': status.data,
         }], data['historico'])
+
+
+class PackTrackBatchTest(unittest.TestCase):
+
+    tracks = ['test1', 'test2', 'test3']
+
+    def setUp(self):
+        self.db = Database()
+        self.app = webtest.TestApp(bottle.app())
+        self.db.packtrack.save('ect', 'test1', [{'situacao': 'Postado'}])
+
+    def tearDown(self):
+        for track in self.tracks:
+            self.db.packtrack.remove('ect', track)
+
+    def _post(self, data, expect_errors=False):
+        return self.app.post('/v1/rastreio/ect/batch', json.dumps(data),
+                             headers={'Content-Type': 'application/json'},
+                             expect_errors=expect_errors)
+
+    @mock.patch('PackTracker.correios')
+    def test_post(self, _mock):
+        def correios(track, auth=None):
+            if track == 'test3':
+                raise ValueError
+            return [{'situacao': 'Encaminhado'}]
+
+        _mock.side_effect = correios
+        result = self._post({'codigos': self.tracks + ['test1']})
+        result = result.json['pacotes']
+
+        self.assertEqual(self.tracks, [r['codigo'] for r in result])
+        self.assertEqual([{'situacao': 'Postado'}], result[0]['historico'])
+        self.assertEqual([{'situacao': 'Encaminhado'}],
+                         result[1]['historico'])
+        self.assertEqual(404, result[2]['status'])
+        # somente os pacotes fora do cache vao para os Correios
+        self.assertEqual(['test2', 'test3'],
+                         sorted(c[0][0] for c in _mock.call_args_list))
+        obj = self.db.packtrack.get_one('ect', 'test2')
+        self.assertEqual(result[1]['historico'], obj['historico'])
+
+    @mock.patch('PackTracker.correios')
+    def test_unavailable(self, _mock):
+        _mock.side_effect = RequestException
+        result = self._post(['test1', 'test2']).json['pacotes']
+        self.assertEqual('test1', result[0]['codigo'])
+        self.assertEqual(503, result[1]['status'])
+
+    def test_empty(self):
+        response = self._post({}, expect_errors=True)
+        self.assertEqual('400 Parametro codigos obrigatorio', response.status)
+
+    def test_invalid_json(self):
+        response = self.app.post('/v1/rastreio/ect/batch', 'notjson',
+                                 headers={'Content-Type': 'application/json'},
+                                 expect_errors=True)
+        self.assertEqual('400 Parametro codigos obrigatorio', response.status)
+
+    @mock.patch('PostmonServer.TRACK_BATCH_MAX', 1)
+    def test_max(self):
+        response = self._post(self.tracks, expect_errors=True)
+        self.assertEqual('400 Maximo de 1 codigos por consulta',
+                         response.status)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+import mock
+
+import PostmonTaskScheduler
+
+
+class TrackPacksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.objs = [{'servico': 'ect', 'codigo': 'SS%09dBR' % i}
+                     for i in range(20)]
+        self.db = mock.Mock()
+        self.db.packtrack.get_due.return_value = iter(self.objs)
+        patcher = mock.patch('PostmonTaskScheduler.Database',
+                             return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('PostmonTaskScheduler.PackTracker')
+    def test_track_packs(self, _mock):
+        # o registro de chamadas do mock nao e seguro entre threads
+        lock = threading.Lock()
+        runs = []
+        reports = []
+
+        def run(provider, track, **kwargs):
+            with lock:
+                runs.append(kwargs)
+            if int(track[2:11]) % 2:
+                return [{'situacao': track}]
+            return []
+
+        def report(provider, track, **kwargs):
+            with lock:
+                reports.append(kwargs)
+
+        _mock.run.side_effect = run
+        _mock.report.side_effect = report
+        result = PostmonTaskScheduler.track_packs(concurrency=4)
+
+        self.assertEqual({'changed': 10, 'unchanged': 10, 'failed': 0},
+                         result)
+        self.assertEqual(20, len(runs))
+        self.assertEqual(10, len(reports))
+        # o documento lido no cursor e reaproveitado
+        for kwargs in runs:
+            self.assertIn(kwargs['obj'], self.objs)
+            self.assertIs(self.db, kwargs['db'])
+        self.assertFalse(self.db.packtrack.get_one.called)
+        # os callbacks recebem somente os eventos novos
+        for kwargs in reports:
+            self.assertEqual(kwargs['obj']['codigo'],
+                             kwargs['events'][0]['situacao'])
+
+    @mock.patch('PostmonTaskScheduler.PackTracker')
+    def test_concurrency(self, _mock):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def run(provider, track, **kwargs):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return False
+
+        _mock.run.side_effect = run
+        PostmonTaskScheduler.track_packs(concurrency=3)
+        self.assertEqual(3, running[1])
+
+    @mock.patch('PostmonTaskScheduler.PackTracker')
+    def test_failure(self, _mock):
+        _mock.run.side_effect = lambda provider, track, **kw: 1 / 0
+        result = PostmonTaskScheduler.track_packs(concurrency=2)
+        self.assertEqual(20, result['failed'])
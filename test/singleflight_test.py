@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+
+from singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.group = SingleFlight()
+        self.calls = []
+        self.release = threading.Event()
+
+    def _fn(self, value):
+        self.calls.append(value)
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return {'value': value}
+
+    def _run(self, value, results):
+        try:
+            results.append(self.group.do('key', self._fn, value))
+        except Exception as ex:
+            results.append(ex)
+
+    def _concurrent(self, value, count=5):
+        results = []
+        threads = [threading.Thread(target=self._run, args=(value, results))
+                   for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        while not self.group.in_flight('key'):
+            time.sleep(0.001)
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single_call(self):
+        results = self._concurrent(1)
+        self.assertEqual([1], self.calls)
+        self.assertEqual([{'value': 1}] * 5, results)
+        # cada chamador recebe sua propria copia
+        self.assertEqual(5, len(set(id(r) for r in results)))
+        self.assertFalse(self.group.in_flight('key'))
+
+    def test_error_shared(self):
+        error = ValueError()
+        results = self._concurrent(error)
+        self.assertEqual([error], self.calls)
+        self.assertEqual([error] * 5, results)
+
+    def test_sequential_calls(self):
+        self.release.set()
+        self.group.do('key', self._fn, 1)
+        self.group.do('key', self._fn, 2)
+        self.assertEqual([1, 2], self.calls)
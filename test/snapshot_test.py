@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from CepTracker import _notfound_key
+import snapshot
+from snapshot import SnapshotDatabase, export
+
+
+class SnapshotTest(unittest.TestCase):
+
+    v_date = datetime(2020, 1, 1, 12, 0)
+
+    ceps = [{
+        '_id': 1,
+        'cep': '20040002',
+        'bairro': u'Centro',
+        'cidade': u'Rio de Janeiro',
+        'estado': 'RJ',
+        '_meta': {'v_date': v_date},
+    }, {
+        'cep': '01330000',
+        'logradouro': u'Rua Rui Barbosa',
+        'bairro': u'Bela Vista',
+        'cidade': u'São Paulo',
+        'estado': 'SP',
+        '_meta': {'v_date': v_date},
+    }, {
+        'cep': '99999999',
+        '_meta': {'v_date': v_date, _notfound_key: True},
+    }, {
+        'cep': 'UNIQUE_KEY',
+    }]
+
+    ufs = [
+        {'_id': 1, 'sigla': 'SP', 'nome': u'São Paulo'},
+        {'sigla': 'RJ', 'nome': u'Rio de Janeiro', '_hash': 'abc'},
+    ]
+
+    cidades = [{
+        'sigla_uf': 'SP',
+        'nome': u'São Paulo',
+        'sigla_uf_nome_cidade': 'SP_SAO PAULO',
+    }, {
+        'sigla_uf': 'MG',
+        'nome': u'Itabirinha (Itabirinha de Mantena)',
+        'sigla_uf_nome_cidade': 'MG_ITABIRINHA ITABIRINHA DE MANTENA',
+    }]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'postmon.snapshot')
+
+        db = mock.Mock()
+        db.get_all_ceps.return_value = [dict(c) for c in self.ceps]
+        db.get_all_ufs.return_value = [dict(u) for u in self.ufs]
+        db.get_all_cidades.return_value = [dict(c) for c in self.cidades]
+        self.result = export(db, self.path)
+
+        self.db = SnapshotDatabase(self.path)
+        self.addCleanup(snapshot._snapshots.clear)
+
+    def test_export(self):
+        self.assertEqual({'ceps': 2, 'ufs': 2, 'cidades': 2}, self.result)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_get_one(self):
+        expected = dict(self.ceps[1])
+        self.assertEqual(expected, self.db.get_one('01330000'))
+
+        result = self.db.get_one('20040002', fields={'_meta': False})
+        self.assertEqual({'cep': '20040002', 'bairro': u'Centro',
+                          'cidade': u'Rio de Janeiro', 'estado': 'RJ'},
+                         result)
+
+    def test_get_one_missing(self):
+        self.assertIsNone(self.db.get_one('99999999'))
+        self.assertIsNone(self.db.get_one('00000000'))
+        self.assertIsNone(self.db.get_one('UNIQUE_KEY'))
+
+    def test_get_many(self):
+        result = self.db.get_many(['01330000', '20040002', '00000000'])
+        self.assertEqual(['01330000', '20040002'], sorted(result))
+
+    def test_get_range(self):
+        result = self.db.get_range('00000000', '99999999')
+        self.assertEqual(['01330000', '20040002'],
+                         [r['cep'] for r in result])
+
+        result = self.db.get_range('00000000', '99999999', limit=1)
+        self.assertEqual(['01330000'], [r['cep'] for r in result])
+        result = self.db.get_range('00000000', '99999999', after='01330000')
+        self.assertEqual(['20040002'], [r['cep'] for r in result])
+        self.assertEqual([], list(self.db.get_range('01330001', '20040001')))
+
+    def test_get_one_uf(self):
+        self.assertEqual({'sigla': 'RJ', 'nome': u'Rio de Janeiro'},
+                         self.db.get_one_uf('RJ'))
+        self.assertIsNone(self.db.get_one_uf('XX'))
+
+    def test_get_one_cidade(self):
+        result = self.db.get_one_cidade('SP', u'São Paulo')
+        self.assertEqual(u'São Paulo', result['nome'])
+        result = self.db.get_one_cidade('SP', u'Sampa (São Paulo)')
+        self.assertEqual(u'São Paulo', result['nome'])
+        result = self.db.get_one_cidade(
+            'MG', u'Itabirinha (Itabirinha de Mantena)')
+        self.assertEqual('MG', result['sigla_uf'])
+        self.assertIsNone(self.db.get_one_cidade('RJ', u'São Paulo'))
+
+    def test_get_all(self):
+        self.assertEqual(2, len(list(self.db.get_all_ufs())))
+        self.assertEqual(2, len(list(self.db.get_all_cidades())))
+
+    def test_overlay(self):
+        record = {
+            'cep': '65930000',
+            'bairro': u'Centro',
+            '_meta': {'v_date': datetime.now()},
+        }
+        self.db.insert_or_update(record)
+        self.assertEqual(u'Centro', self.db.get_one('65930000')['bairro'])
+        # o mmap e o cache sao compartilhados pelo processo
+        other = SnapshotDatabase(self.path)
+        self.assertEqual(u'Centro', other.get_one('65930000')['bairro'])
+
+        expired = {
+            'cep': '65930001',
+            '_meta': {'v_date': datetime.now() - timedelta(weeks=52)},
+        }
+        self.db.insert_or_update(expired)
+        self.assertIsNone(self.db.get_one('65930001'))
+
+    def test_invalid_file(self):
+        path = os.path.join(self.dir, 'invalid')
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 1024)
+        with self.assertRaises(ValueError):
+            SnapshotDatabase(path)
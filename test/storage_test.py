@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import database
+import database_memory
+from CepTracker import _notfound_key
+from database import Database, MongoDB
+from database_memory import MemoryDatabase
+from database_sqlite import SQLiteDatabase
+
+
+class StorageTestMixin(object):
+    """Comportamento esperado de todos os backends de armazenamento"""
+
+    # o backend remove os pacotes apenas em cache expirados ao gravar
+    purges_cache = True
+
+    def test_insert_or_update(self):
+        self.db.insert_or_update({
+            'cep': '99999001',
+            'logradouro': 'A',
+            'bairro': 'A',
+            '_meta': {'v_date': datetime(2020, 1, 1)},
+        })
+        written = self.db.insert_or_update({'cep': '99999001', 'bairro': 'B'},
+                                           fields={'_id': False})
+
+        result = self.db.get_one('99999001', fields={'_id': False})
+        self.assertEqual(result, written)
+        self.assertEqual('B', result['bairro'])
+        self.assertNotIn('logradouro', result)
+        self.assertEqual(datetime(2020, 1, 1), result['_meta']['v_date'])
+
+        result = self.db.get_one('99999001', fields={'_meta': False})
+        self.assertNotIn('_meta', result)
+
+        self.db.remove('99999001')
+        self.assertIsNone(self.db.get_one('99999001'))
+
+    def test_get_many(self):
+        self.db.insert_or_update({'cep': '99999001', 'bairro': 'A'})
+        self.db.insert_or_update({'cep': '99999002', 'bairro': 'B'})
+
+        result = self.db.get_many(['99999001', '99999002', '99999003'],
+                                  fields={'_id': False})
+        self.assertEqual(['99999001', '99999002'], sorted(result))
+        self.assertEqual('B', result['99999002']['bairro'])
+
+    def test_bulk_insert_or_update(self):
+        self.db.insert_or_update({'cep': '99999001', 'bairro': 'A'})
+        result = self.db.bulk_insert_or_update([
+            {'cep': '99999001', 'bairro': 'B'},
+            {'cep': '99999002', 'bairro': 'C'},
+        ])
+        self.assertEqual(1, result['inserted'])
+        self.assertEqual(1, result['modified'])
+        self.assertEqual('B', self.db.get_one('99999001')['bairro'])
+
+        ceps = [r['cep'] for r in self.db.get_all_ceps()]
+        self.assertIn('99999002', ceps)
+
+    def test_get_range(self):
+        self.db.bulk_insert_or_update([
+            {'cep': '99999003', 'bairro': 'C'},
+            {'cep': '99999001', 'bairro': 'A'},
+            {'cep': '99999002', '_meta': {_notfound_key: True}},
+        ])
+
+        result = self.db.get_range('99999000', '99999009')
+        self.assertEqual(['99999001', '99999003'],
+                         [r['cep'] for r in result])
+        result = self.db.get_range('99999001', '99999001')
+        self.assertEqual(['99999001'], [r['cep'] for r in result])
+
+        result = list(self.db.get_range('99999000', '99999009', limit=1))
+        self.assertEqual(['99999001'], [r['cep'] for r in result])
+        result = self.db.get_range('99999000', '99999009', after='99999001')
+        self.assertEqual(['99999003'], [r['cep'] for r in result])
+
+    def test_uf(self):
+        self.db.insert_or_update_uf({'sigla': 'ZZ', 'nome': 'Teste'})
+        self.assertEqual('Teste', self.db.get_one_uf('ZZ')['nome'])
+        self.assertEqual('ZZ', self.db.get_one_uf_by_nome('Teste')['sigla'])
+        self.assertIsNone(self.db.get_one_uf('ZY'))
+
+        result = self.db.bulk_upsert_ufs([{'sigla': 'ZZ', 'nome': 'Novo'}])
+        self.assertEqual(1, result['modified'])
+        result = self.db.bulk_upsert_ufs([{'sigla': 'ZZ', 'nome': 'Novo'}])
+        self.assertEqual(1, result['unchanged'])
+        self.assertIn('ZZ', [uf['sigla'] for uf in self.db.get_all_ufs()])
+
+        self.db.remove_uf('ZZ')
+        self.assertIsNone(self.db.get_one_uf('ZZ'))
+
+    def test_cidade(self):
+        cidade = {
+            'sigla_uf': 'ZZ',
+            'nome': u'Cidade Teste',
+            'sigla_uf_nome_cidade': 'ZZ_CIDADE TESTE',
+        }
+        self.db.insert_or_update_cidade(cidade)
+        result = self.db.get_one_cidade('ZZ', u'Cidade Teste',
+                                        fields={'_id': False})
+        self.assertEqual(cidade, result)
+        result = self.db.get_one_cidade('ZZ', u'Outra (Cidade Teste)')
+        self.assertEqual(u'Cidade Teste', result['nome'])
+        self.assertIsNone(self.db.get_one_cidade('ZZ', u'Outra'))
+
+        result = self.db.bulk_upsert_cidades([dict(cidade)])
+        self.assertEqual(1, result['modified'])
+        result = self.db.bulk_upsert_cidades([dict(cidade)])
+        self.assertEqual(1, result['unchanged'])
+
+        self.db.remove_cidade('ZZ_CIDADE TESTE')
+        self.assertIsNone(self.db.get_one_cidade('ZZ', u'Cidade Teste'))
+
+    def test_ibge_updated_at(self):
+        self.db.mark_ibge_updated()
+        self.assertIsInstance(self.db.get_ibge_updated_at(), datetime)
+
+    def test_lock(self):
+        token = self.db.acquire_lock('storage_test', ttl=30)
+        self.assertTrue(token)
+        self.assertTrue(self.db.is_locked('storage_test'))
+        self.assertIsNone(self.db.acquire_lock('storage_test', ttl=30))
+
+        self.db.release_lock('storage_test', 'outro')
+        self.assertTrue(self.db.is_locked('storage_test'))
+        self.db.release_lock('storage_test', token)
+        self.assertFalse(self.db.is_locked('storage_test'))
+
+    def test_expired_lock(self):
+        self.assertTrue(self.db.acquire_lock('storage_test', ttl=-1))
+        self.assertFalse(self.db.is_locked('storage_test'))
+        self.assertTrue(self.db.acquire_lock('storage_test', ttl=30))
+
+    def test_packtrack(self):
+        callback = {'callback': 'http://example.com'}
+        token = self.db.packtrack.register('ect', 'TS123456789BR', callback)
+        self.assertTrue(token)
+        self.assertEqual(token, self.db.packtrack.register(
+            'ect', 'TS123456789BR', callback))
+
+        obj = self.db.packtrack.get_one('ect', 'TS123456789BR')
+        self.assertEqual(token, obj['token'])
+        self.assertEqual([callback], obj['_meta']['callbacks'])
+        self.assertIsNone(obj['_meta']['checked_at'])
+        self.assertEqual(obj, self.db.packtrack.get_by_token(token))
+        self.assertIsNone(self.db.packtrack.get_by_token('x' + token))
+
+        historico = [{'situacao': 'Entregue'}]
+        self.db.packtrack.update('ect', 'TS123456789BR', historico,
+                                 changed=True)
+        obj = self.db.packtrack.get_one('ect', 'TS123456789BR')
+        self.assertEqual(historico, obj['historico'])
+        self.assertTrue(obj['_meta']['changed_at'])
+
+        codigos = [o['codigo'] for o in self.db.packtrack.get_all()]
+        self.assertIn('TS123456789BR', codigos)
+
+        self.db.packtrack.remove('ect', 'TS123456789BR')
+        self.assertIsNone(self.db.packtrack.get_one('ect', 'TS123456789BR'))
+
+    def test_packtrack_due(self):
+        callback = {'callback': 'http://example.com'}
+        self.db.packtrack.register('ect', 'TS123456789BR', callback)
+        now = datetime.utcnow()
+
+        def due():
+            return [o['codigo'] for o in self.db.packtrack.get_due(now)]
+
+        self.assertIn('TS123456789BR', due())
+
+        self.db.packtrack.update('ect', 'TS123456789BR', None, changed=False,
+                                 next_check_at=now + timedelta(hours=1))
+        self.assertNotIn('TS123456789BR', due())
+        # sem `next_check_at` o agendamento continua o mesmo
+        self.db.packtrack.update('ect', 'TS123456789BR', None, changed=False)
+        self.assertNotIn('TS123456789BR', due())
+
+        self.db.packtrack.update('ect', 'TS123456789BR', None, changed=False,
+                                 next_check_at=None)
+        self.assertNotIn('TS123456789BR', due())
+        self.db.packtrack.update('ect', 'TS123456789BR', None, changed=False,
+                                 next_check_at=now - timedelta(seconds=1))
+        self.assertIn('TS123456789BR', due())
+
+    def test_packtrack_events(self):
+        postado = {'situacao': 'Postado'}
+        encaminhado = {'situacao': 'Encaminhado'}
+        entregue = {'situacao': 'Entregue'}
+        callback = {'callback': 'http://example.com'}
+        self.db.packtrack.register('ect', 'TS123456789BR', callback)
+        self.db.packtrack.update('ect', 'TS123456789BR', [postado],
+                                 changed=True)
+
+        def check(historico):
+            obj = self.db.packtrack.get_one('ect', 'TS123456789BR')
+            self.assertEqual(historico, obj['historico'])
+            self.assertEqual(database.history_fingerprint(historico),
+                             obj['_meta']['fingerprint'])
+
+        check([postado])
+        historico = [encaminhado, postado]
+        self.db.packtrack.update('ect', 'TS123456789BR', historico,
+                                 changed=True, new_events=[encaminhado],
+                                 at_head=True)
+        check(historico)
+        historico = [encaminhado, postado, entregue]
+        self.db.packtrack.update('ect', 'TS123456789BR', historico,
+                                 changed=True, new_events=[entregue])
+        check(historico)
+
+        # o historico gravado nao e o esperado: grava o historico inteiro
+        historico = [entregue, postado]
+        self.db.packtrack.update('ect', 'TS123456789BR', historico,
+                                 changed=True, new_events=[entregue],
+                                 at_head=True)
+        check(historico)
+
+    def test_packtrack_save(self):
+        historico = [{'situacao': 'Postado'}]
+        self.db.packtrack.save('ect', 'TS123456789BR', historico)
+
+        def due():
+            now = datetime.utcnow()
+            return [o['codigo'] for o in self.db.packtrack.get_due(now)]
+
+        obj = self.db.packtrack.get_one('ect', 'TS123456789BR')
+        self.assertEqual(historico, obj['historico'])
+        self.assertEqual([], obj['_meta']['callbacks'])
+        self.assertTrue(obj['_meta']['checked_at'])
+        self.assertGreater(obj['_meta']['expires_at'], datetime.utcnow())
+        # apenas cache: fica fora do agendamento ate ser registrado
+        self.assertNotIn('TS123456789BR', due())
+        found = self.db.packtrack.get_many(
+            'ect', ['TS123456789BR', 'TS000000000BR'])
+        self.assertEqual(['TS123456789BR'], list(found))
+        self.assertEqual(historico, found['TS123456789BR']['historico'])
+
+        callback = {'callback': 'http://example.com'}
+        token = self.db.packtrack.register('ect', 'TS123456789BR', callback)
+        obj = self.db.packtrack.get_one('ect', 'TS123456789BR')
+        self.assertEqual(token, obj['token'])
+        self.assertEqual(historico, obj['historico'])
+        self.assertIn('TS123456789BR', due())
+        # registrado, o pacote nao expira mais
+        self.assertNotIn('expires_at', obj['_meta'])
+        self.db.packtrack.save('ect', 'TS123456789BR', historico)
+        obj = self.db.packtrack.get_one('ect', 'TS123456789BR')
+        self.assertNotIn('expires_at', obj['_meta'])
+
+    def test_packtrack_save_expired(self):
+        if not self.purges_cache:
+            self.skipTest('removidos pelo indice TTL do MongoDB')
+        historico = [{'situacao': 'Postado'}]
+        expired = timedelta(seconds=-1)
+        with mock.patch('database_memory.TRACK_CACHE_TTL', expired), \
+                mock.patch('database_sqlite.TRACK_CACHE_TTL', expired):
+            self.db.packtrack.save('ect', 'TS000000000BR', historico)
+        self.db.packtrack.register('ect', 'TS123456789BR',
+                                   {'callback': 'http://example.com'})
+        self.db.packtrack.save('ect', 'TS123456789BR', historico)
+        self.assertIsNone(self.db.packtrack.get_one('ect', 'TS000000000BR'))
+        self.assertTrue(self.db.packtrack.get_one('ect', 'TS123456789BR'))
+
+    def test_deliveries(self):
+        now = datetime.utcnow()
+        lease = timedelta(minutes=5)
+        self.db.deliveries.add([
+            {'_id': 'storage_test_1', 'url': 'http://a', 'attempts': 0,
+             'token': 'storage_test', 'created_at': now,
+             'next_attempt_at': now - timedelta(seconds=2)},
+            {'_id': 'storage_test_2', 'url': 'http://b', 'attempts': 0,
+             'token': 'storage_test', 'created_at': now - lease,
+             'next_attempt_at': now - timedelta(seconds=1)},
+            {'_id': 'storage_test_3', 'url': 'http://c', 'attempts': 0,
+             'next_attempt_at': None},
+        ])
+
+        claimed = self.db.deliveries.claim_due(now, lease, 1)
+        self.assertEqual(['storage_test_1'], [d['_id'] for d in claimed])
+        claimed = self.db.deliveries.claim_due(now, lease, 10)
+        self.assertEqual(['storage_test_2'], [d['_id'] for d in claimed])
+        self.assertEqual([], self.db.deliveries.claim_due(now, lease, 10))
+
+        self.db.deliveries.update('storage_test_1', {
+            'attempts': 1,
+            'next_attempt_at': now,
+        })
+        obj = self.db.deliveries.get_one('storage_test_1')
+        self.assertEqual(1, obj['attempts'])
+        self.assertEqual('http://a', obj['url'])
+        claimed = self.db.deliveries.claim_due(now, lease, 10)
+        self.assertEqual(['storage_test_1'], [d['_id'] for d in claimed])
+
+        deliveries = self.db.deliveries.get_by_token('storage_test')
+        self.assertEqual(['storage_test_2', 'storage_test_1'],
+                         [d['_id'] for d in deliveries])
+
+
+class MongoStorageTest(StorageTestMixin, unittest.TestCase):
+
+    purges_cache = False
+
+    def setUp(self):
+        self.db = MongoDB()
+        self.addCleanup(self._cleanup)
+
+    def _cleanup(self):
+        _db = self.db._db
+        for cep in ('99999001', '99999002', '99999003'):
+            self.db.remove(cep)
+        _db.ufs.delete_many({'sigla': 'ZZ'})
+        _db.cidades.delete_many({'sigla_uf': 'ZZ'})
+        _db.locks.delete_many({'_id': 'storage_test'})
+        _db.packtrack.delete_many(
+            {'codigo': {'$in': ['TS123456789BR', 'TS000000000BR']}})
+        _db.deliveries.delete_many({'_id': {'$regex': '^storage_test'}})
+        database._ufs_cache.clear()
+        database._cidades_cache.clear()
+
+    def test_packtrack_push(self):
+        postado = {'situacao': 'Postado'}
+        encaminhado = {'situacao': 'Encaminhado'}
+        entregue = {'situacao': 'Entregue'}
+        self.db.packtrack.register('ect', 'TS123456789BR',
+                                   {'callback': 'http://example.com'})
+        self.db.packtrack.update('ect', 'TS123456789BR', [postado],
+                                 changed=True)
+
+        pushed = []
+        push = self.db.packtrack._push
+
+        def spy(*args):
+            pushed.append(push(*args))
+            return pushed[-1]
+
+        def update(historico, new_events, at_head=False):
+            del pushed[:]
+            with mock.patch.object(self.db.packtrack, '_push', spy):
+                self.db.packtrack.update(
+                    'ect', 'TS123456789BR', historico, changed=True,
+                    new_events=new_events, at_head=at_head)
+            obj = self.db.packtrack.get_one('ect', 'TS123456789BR')
+            self.assertEqual(historico, obj['historico'])
+            self.assertEqual(database.history_fingerprint(historico),
+                             obj['_meta']['fingerprint'])
+            return pushed == [True]
+
+        # somente os eventos novos, no inicio e no fim
+        self.assertTrue(update([encaminhado, postado], [encaminhado], True))
+        self.assertTrue(update([encaminhado, postado, entregue], [entregue]))
+        # historico gravado diferente do esperado: regrava inteiro
+        self.assertFalse(update([entregue, postado], [entregue], True))
+
+    def test_packtrack_cursor(self):
+        cursor = mock.MagicMock()
+        cursor.__iter__.return_value = iter([
+            {'_id': 1, 'codigo': 'TS000000001BR'},
+            {'_id': 2, 'codigo': 'TS000000002BR'},
+        ])
+        with mock.patch.object(self.db.packtrack, '_collection') as _mock:
+            _mock.find.return_value = cursor
+            objs = self.db.packtrack.get_due(datetime.utcnow())
+            self.assertEqual('1', next(objs)['token'])
+            # leitura interrompida: o cursor e fechado mesmo assim
+            objs.close()
+
+        kwargs = _mock.find.call_args[1]
+        self.assertTrue(kwargs['no_cursor_timeout'])
+        self.assertEqual(database.STREAM_BATCH_SIZE, kwargs['batch_size'])
+        self.assertTrue(cursor.close.called)
+
+
+class MemoryStorageTest(StorageTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        database_memory.clear()
+        self.addCleanup(database_memory.clear)
+        self.db = MemoryDatabase()
+
+    def test_shared(self):
+        self.db.insert_or_update({'cep': '99999001', 'bairro': 'A'})
+        self.assertEqual('A', MemoryDatabase().get_one('99999001')['bairro'])
+
+
+class SQLiteStorageTest(StorageTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.db = SQLiteDatabase(os.path.join(self.dir, 'postmon.sqlite3'))
+
+
+class DatabaseFactoryTest(unittest.TestCase):
+
+    def test_default(self):
+        with mock.patch.dict(os.environ, {'POSTMON_DB_BACKEND': ''}):
+            self.assertIsInstance(Database(), MongoDB)
+
+    def test_backend(self):
+        env = {
+            'POSTMON_DB_BACKEND': 'sqlite',
+            'POSTMON_DB_SQLITE_PATH': ':memory:',
+        }
+        with mock.patch.dict(os.environ, {'POSTMON_DB_BACKEND': 'memory'}):
+            self.assertIsInstance(Database(), MemoryDatabase)
+        with mock.patch.dict(os.environ, env):
+            self.assertIsInstance(Database(), SQLiteDatabase)
+
+    def test_invalid(self):
+        with mock.patch.dict(os.environ, {'POSTMON_DB_BACKEND': 'redis'}):
+            with self.assertRaises(ValueError):
+                Database()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+import time
+import unittest
+
+import mock
+import requests
+
+import database_memory
+from database_memory import MemoryDatabase
+import webhooks
+
+
+def _http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(response=response)
+
+
+class WebhooksTest(unittest.TestCase):
+
+    def setUp(self):
+        database_memory.clear()
+        self.addCleanup(database_memory.clear)
+        self.db = MemoryDatabase()
+        patcher = mock.patch('webhooks.http_client.post')
+        self.post = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _enqueue(self, *urls):
+        return webhooks.enqueue(self.db, [
+            {'url': url, 'data': '{}', 'token': 'abc'} for url in urls])
+
+    def _get(self, delivery):
+        return self.db.deliveries.get_one(delivery['_id'])
+
+    def test_deliver(self):
+        deliveries = self._enqueue('http://a.example.com/1',
+                                   'http://b.example.com/2')
+        result = webhooks.deliver(self.db, deliveries)
+
+        self.assertEqual(2, result[webhooks.DELIVERED])
+        self.assertEqual(2, self.post.call_count)
+        self.post.assert_any_call(
+            'http://a.example.com/1', data='{}', timeout=webhooks.TIMEOUT,
+            retry=False, headers={'Content-Type': 'application/json'})
+        obj = self._get(deliveries[0])
+        self.assertEqual(webhooks.DELIVERED, obj['status'])
+        self.assertEqual(1, obj['attempts'])
+        self.assertIsNone(obj['next_attempt_at'])
+        self.assertEqual(1, webhooks.delivery_stats()['a.example.com'][
+            'requests'])
+
+    def test_retry(self):
+        self.post.side_effect = requests.exceptions.Timeout('lento')
+        delivery, = self._enqueue('http://example.com')
+        result = webhooks.deliver(self.db, [delivery])
+
+        self.assertEqual(1, result[webhooks.PENDING])
+        obj = self._get(delivery)
+        self.assertEqual(1, obj['attempts'])
+        self.assertEqual('lento', obj['last_error'])
+        self.assertGreater(obj['next_attempt_at'], datetime.utcnow())
+        # nada vencido ainda
+        self.assertEqual(0, sum(webhooks.deliver_due(self.db).values()))
+
+        self.post.side_effect = None
+        later = obj['next_attempt_at'] + timedelta(seconds=1)
+        with mock.patch('webhooks.datetime') as _datetime:
+            _datetime.utcnow.return_value = later
+            result = webhooks.deliver_due(self.db)
+        self.assertEqual(1, result[webhooks.DELIVERED])
+        self.assertEqual(2, self._get(delivery)['attempts'])
+
+    @mock.patch('webhooks.MAX_ATTEMPTS', 1)
+    def test_max_attempts(self):
+        self.post.side_effect = requests.exceptions.ConnectionError()
+        delivery, = self._enqueue('http://example.com')
+        webhooks.deliver(self.db, [delivery])
+        obj = self._get(delivery)
+        self.assertEqual(webhooks.FAILED, obj['status'])
+        self.assertIsNone(obj['next_attempt_at'])
+
+    def test_permanent_error(self):
+        self.post.return_value.raise_for_status.side_effect = \
+            _http_error(404)
+        delivery, = self._enqueue('http://example.com')
+        webhooks.deliver(self.db, [delivery])
+        self.assertEqual(webhooks.FAILED, self._get(delivery)['status'])
+
+        self.post.return_value.raise_for_status.side_effect = \
+            _http_error(503)
+        delivery, = self._enqueue('http://example.com')
+        webhooks.deliver(self.db, [delivery])
+        self.assertEqual(webhooks.PENDING, self._get(delivery)['status'])
+
+    @mock.patch('webhooks._limiter', webhooks.HostLimiter(0))
+    def test_host_saturated(self):
+        delivery, = self._enqueue('http://example.com')
+        start = time.time()
+        webhooks.deliver(self.db, [delivery])
+        # adiada sem esperar o timeout das requisicoes
+        self.assertLess(time.time() - start, webhooks.TIMEOUT)
+
+        self.assertFalse(self.post.called)
+        obj = self._get(delivery)
+        self.assertEqual(0, obj['attempts'])
+        self.assertLessEqual(obj['next_attempt_at'], datetime.utcnow())
+
+    def test_backoff(self):
+        self.assertEqual(webhooks.BACKOFF, webhooks.backoff(1))
+        self.assertEqual(webhooks.BACKOFF * 4, webhooks.backoff(3))
+        self.assertEqual(webhooks.BACKOFF_MAX, webhooks.backoff(30))
+
+
+class HostLimiterTest(unittest.TestCase):
+
+    def test_limit(self):
+        limiter = webhooks.HostLimiter(1)
+        self.assertTrue(limiter.acquire('a', 0))
+        self.assertTrue(limiter.acquire('b', 0))
+        self.assertFalse(limiter.acquire('a', 0.01))
+        limiter.release('a')
+        self.assertTrue(limiter.acquire('a', 0))
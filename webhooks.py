@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Entrega dos callbacks dos pacotes rastreados.
+
+Cada entrega e gravada na caixa de saida (`db.deliveries`) antes do
+envio. Os envios rodam em um pool de ate `POSTMON_WEBHOOK_WORKERS`
+threads, com timeout de `POSTMON_WEBHOOK_TIMEOUT` segundos e no maximo
+`POSTMON_WEBHOOK_PER_HOST` requisicoes simultaneas por host (as demais
+ficam para o reenvio, sem esperar o host liberar). As falhas
+sao reagendadas com backoff exponencial e reenviadas pela tarefa
+`deliver_webhooks` do scheduler, ate `POSTMON_WEBHOOK_MAX_ATTEMPTS`
+tentativas.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+import logging
+import os
+import threading
+import time
+
+from bson import ObjectId
+import requests
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import http_client
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = float(os.environ.get('POSTMON_WEBHOOK_TIMEOUT', 5))
+WORKERS = int(os.environ.get('POSTMON_WEBHOOK_WORKERS', 10))
+PER_HOST = int(os.environ.get('POSTMON_WEBHOOK_PER_HOST', 2))
+MAX_ATTEMPTS = int(os.environ.get('POSTMON_WEBHOOK_MAX_ATTEMPTS', 8))
+BACKOFF = timedelta(
+    seconds=int(os.environ.get('POSTMON_WEBHOOK_BACKOFF', 60)))
+BACKOFF_MAX = timedelta(
+    seconds=int(os.environ.get('POSTMON_WEBHOOK_BACKOFF_MAX', 21600)))
+# enquanto esta sendo enviada a entrega fica reservada por este tempo,
+# para que a tarefa de reenvio nao a pegue ao mesmo tempo
+LEASE = timedelta(seconds=int(os.environ.get('POSTMON_WEBHOOK_LEASE', 300)))
+
+PENDING = 'pending'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS)
+
+
+class HostLimiter(object):
+    """Limita as requisicoes simultaneas para um mesmo host"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._active = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, host, timeout):
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._active.get(host, 0) >= self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self._active[host] = self._active.get(host, 0) + 1
+            return True
+
+    def release(self, host):
+        with self._cond:
+            self._active[host] -= 1
+            if not self._active[host]:
+                del self._active[host]
+            self._cond.notify_all()
+
+
+_limiter = HostLimiter(PER_HOST)
+
+
+class DeliveryStats(object):
+    """Latencia e falhas das ultimas entregas para um host"""
+
+    def __init__(self, samples=1000):
+        self._latencies = deque(maxlen=samples)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.deferred = 0
+
+    def record(self, latency, ok):
+        with self._lock:
+            self._latencies.append(latency)
+            self.requests += 1
+            if not ok:
+                self.failures += 1
+
+    def record_deferred(self):
+        with self._lock:
+            self.deferred += 1
+
+    def percentile(self, p):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * p / 100.0))
+        return latencies[index]
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'deferred': self.deferred,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _get_stats(host):
+    with _stats_lock:
+        if host not in _stats:
+            _stats[host] = DeliveryStats()
+        return _stats[host]
+
+
+def delivery_stats():
+    return dict((host, stats.as_dict()) for host, stats in _stats.items())
+
+
+def backoff(attempts):
+    """Espera antes da tentativa seguinte a `attempts` tentativas"""
+    return min(BACKOFF * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+def enqueue(db, messages):
+    """
+    Grava na caixa de saida as mensagens (`url`, `data` e `token`) e
+    retorna as entregas, ja reservadas para envio imediato com
+    `deliver`.
+    """
+    now = datetime.utcnow()
+    deliveries = [{
+        '_id': str(ObjectId()),
+        'url': message['url'],
+        'data': message['data'],
+        'token': message.get('token'),
+        'status': PENDING,
+        'attempts': 0,
+        'last_error': None,
+        'created_at': now,
+        'next_attempt_at': now + LEASE,
+    } for message in messages]
+    if deliveries:
+        db.deliveries.add(deliveries)
+    return deliveries
+
+
+def _post(delivery):
+    """Envia a entrega e retorna o erro, ou None em caso de sucesso"""
+    headers = {'Content-Type': 'application/json'}
+    try:
+        response = http_client.post(delivery['url'], headers=headers,
+                                    data=delivery['data'], timeout=TIMEOUT,
+                                    retry=False)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        return e
+    return None
+
+
+def _permanent(error):
+    """Erros 4xx, exceto timeout e excesso de requisicoes, nao se repetem"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return False
+    status = response.status_code
+    return 400 <= status < 500 and status not in (408, 429)
+
+
+def attempt(db, delivery):
+    """Faz uma tentativa de entrega e retorna o novo `status`"""
+    host = urlparse(delivery['url']).netloc
+    stats = _get_stats(host)
+    if not _limiter.acquire(host, 0):
+        # host saturado: fica para a proxima execucao do reenvio, sem
+        # ocupar uma thread do pool esperando o host liberar
+        stats.record_deferred()
+        db.deliveries.update(delivery['_id'], {
+            'next_attempt_at': datetime.utcnow(),
+        })
+        return PENDING
+
+    start = time.time()
+    try:
+        error = _post(delivery)
+    finally:
+        _limiter.release(host)
+    stats.record(time.time() - start, error is None)
+
+    now = datetime.utcnow()
+    attempts = delivery['attempts'] + 1
+    fields = {'attempts': attempts, 'last_attempt_at': now}
+    if error is None:
+        fields.update(status=DELIVERED, next_attempt_at=None)
+    elif attempts >= MAX_ATTEMPTS or _permanent(error):
+        logger.warning(u'Desistindo da entrega %s para %s: %s',
+                       delivery['_id'], delivery['url'], error)
+        fields.update(status=FAILED, next_attempt_at=None,
+                      last_error=u'%s' % error)
+    else:
+        logger.info(u'Falha na entrega %s para %s, tentativa %d: %s',
+                    delivery['_id'], delivery['url'], attempts, error)
+        fields.update(next_attempt_at=now + backoff(attempts),
+                      last_error=u'%s' % error)
+    db.deliveries.update(delivery['_id'], fields)
+    delivery.update(fields)
+    return delivery['status']
+
+
+def deliver(db, deliveries):
+    """
+    Envia as entregas em paralelo e retorna as quantidades por `status`
+    """
+    futures = [_executor.submit(attempt, db, d) for d in deliveries]
+    counts = {PENDING: 0, DELIVERED: 0, FAILED: 0}
+    for future in wait(futures).done:
+        try:
+            counts[future.result()] += 1
+        except Exception:
+            logger.exception(u'Erro ao entregar callback')
+            counts[PENDING] += 1
+    return counts
+
+
+def deliver_due(db):
+    """Reenvia as entregas com a proxima tentativa vencida"""
+    counts = {PENDING: 0, DELIVERED: 0, FAILED: 0}
+    # as entregas adiadas nesta execucao ficam para a proxima
+    now = datetime.utcnow()
+    while True:
+        deliveries = db.deliveries.claim_due(now, LEASE, WORKERS * 2)
+        if not deliveries:
+            break
+        for status, count in deliver(db, deliveries).items():
+            counts[status] += count
+    return counts